@@ -1,8 +1,9 @@
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException, Depends, status
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException, Depends, Query, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import JSONResponse
-import redis
+from fastapi.responses import JSONResponse, StreamingResponse
+from redis import asyncio as aioredis
+from contextlib import asynccontextmanager
 import uuid
 import json
 import httpx
@@ -19,6 +20,19 @@ from models import *
 from security_scanner import *
 from email_service import *
 from notification_engine import *
+from notification_rules import *
+from capture_store import *
+from session_keys import *
+from cache import *
+from session_cache import *
+from exporters import *
+from search_index import *
+from ingestion import *
+from live_updates import *
+from capture_log import *
+from notification_rules import *
+from notification_sinks import *
+from user_cache import *
 
 # Structure for running ouI donr security scans
 class SecurityScanRequest(BaseModel):
@@ -63,7 +77,48 @@ def is_request_allowed(session_filters: dict, request: Request) -> bool:
     
     return True
 
-app = FastAPI(title="API Testing Suite")
+redis_url = os.getenv('UPSTASH_REDIS_URL', 'redis://localhost:6379')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '200'))
+
+if 'upstash.io' in redis_url:
+    # Upstash requires SSL - use rediss:// instead of redis://
+    redis_url = redis_url.replace('redis://', 'rediss://')
+    redis_pool = aioredis.BlockingConnectionPool.from_url(
+        redis_url, max_connections=REDIS_MAX_CONNECTIONS, ssl_cert_reqs=None
+    )
+else:
+    # Local development
+    redis_pool = aioredis.BlockingConnectionPool.from_url(
+        redis_url, max_connections=REDIS_MAX_CONNECTIONS
+    )
+redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Own the Redis and outbound HTTP connection pools and background listeners for the lifetime of the app."""
+    invalidation_listener = asyncio.create_task(invalidation_bus.listen(redis_client))
+    background = [invalidation_listener]
+    # Webhook alerts share one pool of keep-alive connections
+    http_client = create_http_client()
+    if NOTIFICATION_WORKERS:
+        # Rules are evaluated off the capture path, at most NOTIFICATION_WORKERS at a time
+        notification_engine = NotificationEngine(redis_client, email_service,
+                                                 default_sinks(email_service, http_client))
+        background.append(asyncio.create_task(run_consumer_pool(
+            redis_client, NOTIFICATION_GROUP, notification_engine.evaluate_capture, NOTIFICATION_WORKERS
+        )))
+        background.append(asyncio.create_task(notification_engine.run_digest_flusher()))
+    yield
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await manager.close()
+    email_service.close()
+    await http_client.aclose()
+    await redis_client.aclose()
+    await redis_pool.disconnect()
+
+app = FastAPI(title="API Testing Suite", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -73,59 +128,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-redis_url = os.getenv('UPSTASH_REDIS_URL', 'redis://localhost:6379')
-
-if 'upstash.io' in redis_url:
-    # Upstash requires SSL - use rediss:// instead of redis://
-    redis_url = redis_url.replace('redis://', 'rediss://')
-    redis_client = redis.from_url(redis_url, ssl_cert_reqs=None)
-else:
-    # Local development
-    redis_client = redis.from_url(redis_url)
 security = HTTPBearer()
 
 # WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, session_id: str):
-        await websocket.accept()
-        if session_id not in self.active_connections:
-            self.active_connections[session_id] = []
-        self.active_connections[session_id].append(websocket)
-
-    def disconnect(self, websocket: WebSocket, session_id: str):
-        if session_id in self.active_connections:
-            self.active_connections[session_id].remove(websocket)
-            if not self.active_connections[session_id]:
-                del self.active_connections[session_id]
-
-    async def send_to_session(self, session_id: str, message: str):
-        if session_id in self.active_connections:
-            for connection in self.active_connections[session_id]:
-                try:
-                    await connection.send_text(message)
-                except:
-                    self.active_connections[session_id].remove(connection)
-
 manager = ConnectionManager()
 
 # Authentication dependency
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
-    email = verify_token(token)
-    
-    # Get user from Redis
-    user_data = redis_client.get(f"user:{email}")
-    if not user_data:
+    # Repeat requests with the same token are answered from the in-process cache
+    user = await user_cache.get(redis_client, credentials.credentials)
+    if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
-    
-    user = json.loads(user_data)
-    return User(**user)
+    return user
 
 # Optional authentication (for public webhook endpoints)
 async def get_current_user_optional(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
@@ -136,14 +153,6 @@ async def get_current_user_optional(credentials: Optional[HTTPAuthorizationCrede
     except:
         return None
 
-# Notification helper function
-async def run_notification_evaluation(notification_engine, session_id: str, webhook_data: dict):
-    """Run notification evaluation asynchronously"""
-    try:
-        notification_engine.evaluate_conditions(session_id, webhook_data)
-    except Exception as e:
-        print(f"Notification evaluation failed for session {session_id}: {e}")
-
 # Security scanning functionality  
 @app.post("/api/security-scan")
 async def run_security_scan(
@@ -198,7 +207,7 @@ async def run_security_scan(
         
         # Convert enum values for JSON serialization
         scan_data_json = json.dumps(scan_data, default=str)
-        redis_client.setex(f"security_scan:{scan_id}", 86400 * 7, scan_data_json)
+        await redis_client.setex(f"security_scan:{scan_id}", 86400 * 7, scan_data_json)
         
         return {
             "scan_id": scan_id,
@@ -214,7 +223,7 @@ async def run_security_scan(
 @app.get("/api/security-scan/{scan_id}")
 async def get_security_scan(scan_id: str, current_user: User = Depends(get_current_user)):
     """Retrieve security scan results"""
-    scan_data = redis_client.get(f"security_scan:{scan_id}")
+    scan_data = await redis_client.get(f"security_scan:{scan_id}")
     if not scan_data:
         raise HTTPException(status_code=404, detail="Scan not found")
     
@@ -235,7 +244,7 @@ async def list_security_scans(current_user: User = Depends(get_current_user)):
 @app.post("/auth/register", response_model=Token)
 async def register(user_data: UserCreate):
     # Check if user already exists
-    if redis_client.exists(f"user:{user_data.email}"):
+    if await redis_client.exists(f"user:{user_data.email}"):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
@@ -251,12 +260,15 @@ async def register(user_data: UserCreate):
         "full_name": user_data.full_name,
         "hashed_password": hashed_password,
         "created_at": datetime.now().isoformat(),
-        "is_active": True
+        "is_active": True,
+        "plan": "free"
     }
     
     # Store user in Redis
-    redis_client.set(f"user:{user_data.email}", json.dumps(user))
-    redis_client.set(f"user_id:{user_id}", user_data.email)
+    await redis_client.set(f"user:{user_data.email}", json.dumps(user))
+    await redis_client.set(f"user_id:{user_id}", user_data.email)
+    # A record re-created under the same email must not be served from a stale cache entry
+    await user_cache.invalidate(redis_client, user_data.email)
     
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -274,7 +286,7 @@ async def create_notification_rule(
     """Create a new notification rule"""
     
     # Verify user owns the session
-    session_data = redis_client.get(f"session:{rule_data.session_id}")
+    session_data = await redis_client.get(f"session:{rule_data.session_id}")
     if not session_data:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -282,6 +294,11 @@ async def create_notification_rule(
     if session["owner_id"] != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
+    for url in rule_data.webhook_urls:
+        problem = await check_webhook_destination(str(url))
+        if problem:
+            raise HTTPException(status_code=400, detail=f"Invalid webhook URL {url}: {problem}")
+    
     # Create rule
     rule_id = str(uuid.uuid4())[:8]
     rule = NotificationRule(
@@ -292,76 +309,46 @@ async def create_notification_rule(
         operator=rule_data.operator,
         value=rule_data.value,
         email_recipients=rule_data.email_recipients,
+        webhook_urls=rule_data.webhook_urls,
         cooldown_minutes=rule_data.cooldown_minutes,
+        digest_minutes=rule_data.digest_minutes,
+        dedup_fields=rule_data.dedup_fields,
         created_at=datetime.now().isoformat()
     )
     
     print(f"📝 Created rule object: {rule}")
     
     # Save to Redis
-    existing_rules = redis_client.get(f"notification_rules:{rule_data.session_id}")
+    existing_rules = await redis_client.get(f"notification_rules:{rule_data.session_id}")
     rules = json.loads(existing_rules) if existing_rules else []
     print(f"📦 Existing rules count: {len(rules)}")
     
-    rules.append(rule.dict())
+    rules.append(rule.model_dump(mode="json"))
     print(f"📦 New rules count: {len(rules)}")
     
     # Save to Redis with debug
     redis_key = f"notification_rules:{rule_data.session_id}"
-    redis_result = redis_client.set(redis_key, json.dumps(rules))
+    redis_result = await redis_client.set(redis_key, json.dumps(rules))
     print(f"💾 Redis save result: {redis_result}")
     print(f"💾 Redis key: {redis_key}")
     
     # Verify it was saved
-    saved_data = redis_client.get(redis_key)
+    saved_data = await redis_client.get(redis_key)
     if saved_data:
         saved_rules = json.loads(saved_data)
         print(f"✅ Verified: {len(saved_rules)} rules saved to Redis")
     else:
         print(f"❌ ERROR: No data found in Redis after save!")
     
-    return rule
-
-# Push notification routes
-@app.get("/notifications/rules/{session_id}")
-async def get_notification_rules(
-    session_id: str,
-    current_user: User = Depends(get_current_user)
-):
-    """Get all notification rules for a session"""
-    
-    # Verify user owns the session
-    session_data = redis_client.get(f"session:{session_id}")
-    if not session_data:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = json.loads(session_data)
-    if session["owner_id"] != current_user.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
-    
-    rules_data = redis_client.get(f"notification_rules:{session_id}")
-    if not rules_data:
-        return []
-    
-    return json.loads(rules_data)
-
-@app.delete("/notifications/rules/{rule_id}")
-async def delete_notification_rule(
-    rule_id: str,
-    current_user: User = Depends(get_current_user)
-):
-    """Delete a notification rule"""
-    
-    # Find and verify ownership
-    # Implementation depends on your needs
+    # Workers recompile the session's rules on next use
+    await rule_sets.invalidate(redis_client, rule_data.session_id)
     
-    return {"message": "Rule deleted successfully"}
-
+    return rule
 
 @app.post("/auth/login", response_model=Token)
 async def login(user_data: UserLogin):
     # Get user from Redis
-    stored_user = redis_client.get(f"user:{user_data.email}")
+    stored_user = await redis_client.get(f"user:{user_data.email}")
     if not stored_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -404,31 +391,41 @@ async def create_session(session_data: SessionCreate, current_user: User = Depen
         "request_count": 0,
         "is_active": True,
         "lifespan": session_data.lifespan,
-        "filters": session_data.filters or {}
+        "filters": session_data.filters or {},
+        "retention": get_retention_limits(session_data.lifespan, current_user.plan).dict()
     }
     
     # Use dynamic TTL based on lifespan
     ttl_seconds = get_lifespan_seconds(session_data.lifespan)
     
-    redis_client.set(f"session:{session_id}", json.dumps(session))
-    redis_client.sadd(f"user_sessions:{current_user.id}", session_id)
-    redis_client.expire(f"session:{session_id}", ttl_seconds)
-    redis_client.expire(f"requests:{session_id}", ttl_seconds)
+    await redis_client.set(f"session:{session_id}", json.dumps(session))
+    await redis_client.sadd(f"user_sessions:{current_user.id}", session_id)
+    await redis_client.expire(f"session:{session_id}", ttl_seconds)
+    await session_cache.invalidate(redis_client, session_id)
     
     return Session(**session)
 
 @app.get("/sessions", response_model=List[Session])
 async def get_user_sessions(current_user: User = Depends(get_current_user)):
-    session_ids = redis_client.smembers(f"user_sessions:{current_user.id}")
+    session_ids = await redis_client.smembers(f"user_sessions:{current_user.id}")
     sessions = []
     
-    for session_id in session_ids:
-        session_data = redis_client.get(f"session:{session_id.decode()}")
+    # Fetch every session and its stats in a single round trip
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for session_id in session_ids:
+            pipe.get(f"session:{session_id.decode()}")
+            pipe.hgetall(session_key("session_stats", session_id.decode()))
+        results = await pipe.execute()
+    
+    for session_data, stats in zip(results[::2], results[1::2]):
         if session_data:
             session = json.loads(session_data)
-            # Add request count
-            request_count = redis_client.llen(f"requests:{session_id.decode()}")
-            session["request_count"] = request_count
+            # Add live counters kept by the capture path; sessions not captured
+            # to since the stats hash was introduced still carry their own count
+            session["request_count"] = int(stats.get(b"request_count", session.get("request_count", 0)))
+            session["evicted_count"] = int(stats.get(b"evicted_count", 0))
+            if b"last_request" in stats:
+                session["last_request"] = stats[b"last_request"].decode()
             sessions.append(Session(**session))
     
     # Sort by created_at desc
@@ -438,7 +435,7 @@ async def get_user_sessions(current_user: User = Depends(get_current_user)):
 @app.delete("/sessions/{session_id}")
 async def delete_session(session_id: str, current_user: User = Depends(get_current_user)):
     # Check if session exists and user owns it
-    session_data = redis_client.get(f"session:{session_id}")
+    session_data = await redis_client.get(f"session:{session_id}")
     if not session_data:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -447,22 +444,52 @@ async def delete_session(session_id: str, current_user: User = Depends(get_curre
         raise HTTPException(status_code=403, detail="Not authorized to delete this session")
     
     # Delete session and related data
-    redis_client.delete(f"session:{session_id}")
-    redis_client.delete(f"requests:{session_id}")
-    redis_client.delete(f"replays:{session_id}")
-    redis_client.srem(f"user_sessions:{current_user.id}", session_id)
+    await redis_client.delete(f"session:{session_id}")
+    await CaptureStore(redis_client).delete_session_data(session_id)
+    await redis_client.delete(f"replays:{session_id}")
+    await redis_client.srem(f"user_sessions:{current_user.id}", session_id)
+    await session_cache.invalidate(redis_client, session_id)
     
     return {"message": "Session deleted successfully"}
 
+@app.put("/sessions/{session_id}/filters", response_model=Session)
+async def update_session_filters(session_id: str, filters: SessionFilters, current_user: User = Depends(get_current_user)):
+    # Check if session exists and user owns it
+    session_data = await redis_client.get(f"session:{session_id}")
+    if not session_data:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    session = json.loads(session_data)
+    if session["owner_id"] != current_user.id:
+        raise HTTPException(status_code=403, detail="Not authorized to update this session")
+    
+    session["filters"] = filters.dict(exclude_none=True)
+    await redis_client.set(f"session:{session_id}", json.dumps(session), keepttl=True)
+    await session_cache.invalidate(redis_client, session_id)
+    
+    return Session(**session)
+
 # Keep existing webhook endpoints but add session ownership verification
 @app.websocket("/ws/{session_id}")
-async def websocket_endpoint(websocket: WebSocket, session_id: str):
-    await manager.connect(websocket, session_id)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    session_id: str,
+    batch_ms: int = Query(0, ge=0, le=1000),
+    batch_max: int = Query(100, ge=1, le=1000),
+    since: Optional[int] = Query(None, ge=0)
+):
+    # batch_ms > 0 opts in to JSON array frames of up to batch_max events;
+    # since=<seq> replays captures missed after that seq before going live
+    viewer = await manager.connect(redis_client, websocket, session_id,
+                                   batch_window_ms=batch_ms, batch_max=batch_max, since=since)
     try:
-        while True:
+        # Stops when the client goes away or the viewer is evicted as too slow
+        while not viewer.closed:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(websocket, session_id)
+        pass
+    finally:
+        await manager.disconnect(viewer)
 
 @app.api_route("/hooks/{session_id}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def capture_webhook(session_id: str, request: Request):
@@ -470,22 +497,12 @@ async def capture_webhook(session_id: str, request: Request):
     start_time = time.time()
     
     # Verify session exists (but don't require authentication for webhook endpoints)
-    session_data = redis_client.get(f"session:{session_id}")
-    if not session_data:
+    session = await session_cache.get(redis_client, session_id)
+    if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # Parse session data FIRST
-    session = json.loads(session_data)
-    
     # GET REAL-TIME REQUEST DATA
     try:
-        # Get request body
-        body = await request.body()
-        try:
-            body_text = body.decode('utf-8') if body else ""
-        except UnicodeDecodeError:
-            body_text = f"<binary data: {len(body)} bytes>"
-        
         # Get client IP (handle different deployment scenarios)
         client_ip = (
             request.headers.get("x-forwarded-for", "").split(",")[0].strip() or
@@ -497,134 +514,51 @@ async def capture_webhook(session_id: str, request: Request):
         status_code = 200  # Default success
         error_message = None
         
-        # Apply filters if they exist (your existing filter logic)
-        session_filters = session.get("filters", {})
-        if session_filters:
-            method = request.method
-            
-            # Check blocked IPs
-            if "blocked_ips" in session_filters and session_filters["blocked_ips"]:
-                if client_ip in session_filters["blocked_ips"]:
-                    status_code = 403
-                    error_message = "IP address blocked"
-                    # Calculate response time before returning
-                    response_time_ms = (time.time() - start_time) * 1000
-                    
-                    # PREPARE WEBHOOK DATA FOR NOTIFICATIONS
-                    webhook_data = {
-                        "method": request.method,
-                        "ip": client_ip,
-                        "headers": dict(request.headers),
-                        "body": body_text,
-                        "query_params": dict(request.query_params),
-                        "status_code": status_code,
-                        "response_time_ms": response_time_ms,
-                        "timestamp": datetime.now().isoformat(),
-                        "session_id": session_id,
-                        "error_message": error_message
-                    }
-                    
-                    # EVALUATE NOTIFICATION CONDITIONS
-                    notification_engine = NotificationEngine(redis_client, email_service)
-                    try:
-                        notification_engine.evaluate_conditions(session_id, webhook_data)
-                    except Exception as e:
-                        print(f"Notification evaluation failed: {e}")
-                    
-                    return {"status": "filtered", "reason": error_message}
+        # Apply the session's precompiled IP/method filters from headers alone,
+        # before any of the body is read
+        rejection = session.filters.check(client_ip, request.method)
+        if rejection:
+            status_code, error_message = rejection
+            # Calculate response time before returning
+            response_time_ms = (time.time() - start_time) * 1000
             
-            # Check allowed IPs (if specified, only these are allowed)
-            if "allowed_ips" in session_filters and session_filters["allowed_ips"]:
-                if client_ip not in session_filters["allowed_ips"]:
-                    status_code = 403
-                    error_message = "IP address not in allowlist"
-                    response_time_ms = (time.time() - start_time) * 1000
-                    
-                    webhook_data = {
-                        "method": request.method,
-                        "ip": client_ip,
-                        "headers": dict(request.headers),
-                        "body": body_text,
-                        "query_params": dict(request.query_params),
-                        "status_code": status_code,
-                        "response_time_ms": response_time_ms,
-                        "timestamp": datetime.now().isoformat(),
-                        "session_id": session_id,
-                        "error_message": error_message
-                    }
-                    
-                    notification_engine = NotificationEngine(redis_client, email_service)
-                    try:
-                        notification_engine.evaluate_conditions(session_id, webhook_data)
-                    except Exception as e:
-                        print(f"Notification evaluation failed: {e}")
-                    
-                    return {"status": "filtered", "reason": error_message}
+            # Filtered requests aren't stored. Rules on their headers and
+            # query are checked here, since the log event doesn't carry them;
+            # the notification consumer checks the rest
+            rule_set = await rule_sets.get(redis_client, session_id)
+            matched = rule_set.matching({
+                "headers": dict(request.headers),
+                "query_params": dict(request.query_params),
+            }, fields=FILTERED_REQUEST_FIELDS) if rule_set.rules else []
+            await CaptureStore(redis_client).log_event(session_id, {
+                "timestamp": datetime.now().isoformat(),
+                "method": request.method,
+                "ip": client_ip,
+                "status_code": status_code,
+                "response_time_ms": round(response_time_ms, 2)
+            }, error_message, [rule.id for rule in matched])
             
-            # Check allowed methods (if specified, only these are allowed)
-            if "allowed_methods" in session_filters and session_filters["allowed_methods"]:
-                if method not in session_filters["allowed_methods"]:
-                    status_code = 405
-                    error_message = "Method not allowed"
-                    response_time_ms = (time.time() - start_time) * 1000
-                    
-                    webhook_data = {
-                        "method": request.method,
-                        "ip": client_ip,
-                        "headers": dict(request.headers),
-                        "body": body_text,
-                        "query_params": dict(request.query_params),
-                        "status_code": status_code,
-                        "response_time_ms": response_time_ms,
-                        "timestamp": datetime.now().isoformat(),
-                        "session_id": session_id,
-                        "error_message": error_message
-                    }
-                    
-                    notification_engine = NotificationEngine(redis_client, email_service)
-                    try:
-                        notification_engine.evaluate_conditions(session_id, webhook_data)
-                    except Exception as e:
-                        print(f"Notification evaluation failed: {e}")
-                    
-                    return {"status": "filtered", "reason": error_message}
+            return {"status": "filtered", "reason": error_message}
+
+        # Stream the body in, hashing all of it but keeping only the head
+        body = await read_body(request, session.retention.max_body_bytes)
+        body_text = body.text()
 
+    except BodyTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         # Handle request processing errors
         status_code = 500
         error_message = f"Request processing error: {str(e)}"
+        body = IngestedBody()
         body_text = ""
         client_ip = "unknown"
     
     # CALCULATE FINAL RESPONSE TIME
     response_time_ms = (time.time() - start_time) * 1000
     
-    # PREPARE COMPLETE WEBHOOK DATA FOR NOTIFICATIONS
-    webhook_data = {
-        "method": request.method,
-        "ip": client_ip,
-        "headers": dict(request.headers),
-        "body": body_text,
-        "query_params": dict(request.query_params),
-        "status_code": status_code,
-        "response_time_ms": round(response_time_ms, 2),
-        "timestamp": datetime.now().isoformat(),
-        "session_id": session_id,
-        "error_message": error_message,
-        "user_agent": request.headers.get("user-agent", ""),
-        "content_type": request.headers.get("content-type", ""),
-        "content_length": len(body_text)
-    }
-    
-    # EVALUATE NOTIFICATION CONDITIONS (Main success path)
-    notification_engine = NotificationEngine(redis_client, email_service)
-    try:
-        # Run notification evaluation asynchronously to not block response
-        asyncio.create_task(
-            run_notification_evaluation(notification_engine, session_id, webhook_data)
-        )
-    except Exception as e:
-        print(f"Failed to start notification evaluation: {e}")
+    # Notification rules are evaluated by the capture log's "notifications"
+    # consumer group once the request is committed
     
     # YOUR EXISTING REQUEST STORAGE LOGIC
     request_data = {
@@ -639,17 +573,23 @@ async def capture_webhook(session_id: str, request: Request):
         "response_time_ms": round(response_time_ms, 2)
     }
     
-    # Store in Redis with expiration
-    redis_client.lpush(f"requests:{session_id}", json.dumps(request_data))
-    redis_client.expire(f"requests:{session_id}", 3600)  # 1 hour expiration
+    # Keep large bodies out of the record that every listing and push carries
+    body_blob = offload_body(request_data, body.data, body.size, body.sha256)
     
-    # Update session stats
-    session["request_count"] = session.get("request_count", 0) + 1
-    session["last_request"] = datetime.now().isoformat()
-    redis_client.set(f"session:{session_id}", json.dumps(session))
+    # Store the request and update session stats in one atomic round trip
+    request_count = await CaptureStore(redis_client).commit(
+        session_id, request_data, get_lifespan_seconds(session.lifespan), session.retention, body_blob,
+        error_message
+    )
+    if request_count is None:
+        # Session expired while cached
+        session_cache.discard(session_id)
+        raise HTTPException(status_code=404, detail="Session not found")
     
-    # Send real-time update via WebSocket
-    await manager.send_to_session(session_id, request_data)
+    # Send real-time update to viewers on every worker via Redis pub/sub,
+    # tagged with the seq a reconnecting viewer resumes from
+    request_data["seq"] = request_count
+    await manager.publish(redis_client, session_id, json.dumps(request_data))
     
     # Return appropriate response
     if status_code >= 400:
@@ -661,24 +601,149 @@ async def capture_webhook(session_id: str, request: Request):
     return {"status": "captured", "request_id": request_data["id"]}
 
 @app.get("/sessions/{session_id}/requests")
-async def get_session_requests(session_id: str, current_user: User = Depends(get_current_user)):
+async def get_session_requests(
+    session_id: str,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    method: Optional[str] = None,
+    status_code: Optional[int] = None,
+    ip: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
     # Verify user owns the session
-    session_data = redis_client.get(f"session:{session_id}")
-    if not session_data:
+    session = await session_cache.get(redis_client, session_id)
+    if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    session = json.loads(session_data)
-    if session["owner_id"] != current_user.id:
+    if session.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to view this session")
     
-    requests_key = f"requests:{session_id}"
-    stored_requests = redis_client.lrange(requests_key, 0, -1)
+    try:
+        before_seq = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     
-    requests = []
-    for req_data in stored_requests:
-        requests.append(json.loads(req_data))
+    request_filter = None
+    if any(value is not None for value in (method, status_code, ip, since, until)):
+        request_filter = RequestFilter(method, status_code, ip, since, until)
     
-    return {"requests": requests}
+    requests, next_seq = await CaptureStore(redis_client).list_requests(
+        session_id, limit, before_seq, request_filter
+    )
+    
+    return {
+        "requests": requests,
+        "next_cursor": encode_cursor(next_seq) if next_seq else None
+    }
+
+@app.get("/sessions/{session_id}/stats")
+async def get_session_stats(
+    session_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Capture counters and the current request rate for a session"""
+    session = await session_cache.get(redis_client, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    if session.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not authorized to view this session")
+    
+    capture_store = CaptureStore(redis_client)
+    stats = await redis_client.hgetall(session_key("session_stats", session_id))
+    return {
+        "request_count": int(stats.get(b"request_count", session.record.get("request_count", 0))),
+        "evicted_count": int(stats.get(b"evicted_count", 0)),
+        "stored_bytes": int(stats.get(b"bytes", 0)),
+        "last_request": stats[b"last_request"].decode() if b"last_request" in stats else None,
+        "requests_per_minute": round(await capture_store.request_rate(session_id), 1)
+    }
+
+@app.get("/sessions/{session_id}/requests/{request_id}/body")
+async def get_request_body(session_id: str, request_id: str, current_user: User = Depends(get_current_user)):
+    """Stream the full body of a request whose body was offloaded at capture time"""
+    session = await session_cache.get(redis_client, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    if session.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not authorized to view this session")
+    
+    body = await CaptureStore(redis_client).read_body(session_id, request_id)
+    if not body:
+        raise HTTPException(status_code=404, detail="No offloaded body for this request")
+    
+    content_type, chunks = body
+    return StreamingResponse(chunks, media_type=content_type)
+
+@app.get("/sessions/{session_id}/search")
+async def search_session_requests(
+    session_id: str,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Find captured requests whose body or searchable header values contain every term in q"""
+    session = await session_cache.get(redis_client, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    if session.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not authorized to view this session")
+    
+    try:
+        before_seq = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    terms = tokenize(q)
+    if not terms:
+        return {"results": [], "next_cursor": None}
+    
+    requests, next_seq = await CaptureStore(redis_client).list_requests(
+        session_id, limit, before_seq, RequestFilter(terms=terms)
+    )
+    
+    # Newest matches first
+    return {
+        "results": [
+            {
+                "id": r["id"],
+                "seq": r["seq"],
+                "timestamp": r["timestamp"],
+                "method": r["method"],
+                "status_code": r["status_code"]
+            }
+            for r in requests
+        ],
+        "next_cursor": encode_cursor(next_seq) if next_seq else None
+    }
+
+@app.get("/sessions/{session_id}/export")
+async def export_session_requests(
+    session_id: str,
+    format: str = Query("ndjson", pattern="^(ndjson|har|csv)$"),
+    current_user: User = Depends(get_current_user)
+):
+    # Verify user owns the session
+    session = await session_cache.get(redis_client, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    if session.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not authorized to export this session")
+    
+    media_type, extension, serializer = EXPORT_FORMATS[format]
+    records = CaptureStore(redis_client).iter_requests(session_id)
+    
+    return StreamingResponse(
+        serializer(records, session_id),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="session-{session_id}.{extension}"'}
+    )
 
 # Keep existing replay endpoints...
 # (Add the replay endpoints from before with session ownership verification)
@@ -687,6 +752,17 @@ async def get_session_requests(session_id: str, current_user: User = Depends(get
 async def root():
     return {"message": "Webhook Debugger API is running!"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """In-process cache and email counters for this worker and shared capture log backlog"""
+    return {
+        "session_cache": session_cache.stats(),
+        "rule_cache": rule_sets.stats(),
+        "user_cache": user_cache.stats(),
+        "email": email_service.stats(),
+        "capture_log": await capture_log_metrics(redis_client, [NOTIFICATION_GROUP])
+    }
+
 # Legacy endpoint for backward compatibility (creates anonymous session)
 @app.post("/webhooks")
 async def create_legacy_webhook_session():
@@ -702,7 +778,7 @@ async def create_legacy_webhook_session():
         "request_count": 0,
         "is_active": True
     }
-    redis_client.setex(f"session:{session_id}", 86400, json.dumps(session_data))
+    await redis_client.setex(f"session:{session_id}", 86400, json.dumps(session_data))
     
     return {
         "session_id": session_id, 
@@ -725,18 +801,18 @@ async def create_environment(environment_data: EnvironmentCreate, current_user:
     }
     
     # Store environment
-    redis_client.set(f"environment:{env_id}", json.dumps(environment))
-    redis_client.sadd(f"user_environments:{current_user.id}", env_id)
+    await redis_client.set(f"environment:{env_id}", json.dumps(environment))
+    await redis_client.sadd(f"user_environments:{current_user.id}", env_id)
     
     return Environment(**environment)
 
 @app.get("/environments", response_model=List[Environment])
 async def get_user_environments(current_user: User = Depends(get_current_user)):
-    env_ids = redis_client.smembers(f"user_environments:{current_user.id}")
+    env_ids = await redis_client.smembers(f"user_environments:{current_user.id}")
     environments = []
     
-    for env_id in env_ids:
-        env_data = redis_client.get(f"environment:{env_id.decode()}")
+    env_keys = [f"environment:{env_id.decode()}" for env_id in env_ids]
+    for env_data in (await redis_client.mget(env_keys) if env_keys else []):
         if env_data:
             environments.append(Environment(**json.loads(env_data)))
     
@@ -745,7 +821,7 @@ async def get_user_environments(current_user: User = Depends(get_current_user)):
 @app.put("/environments/{env_id}", response_model=Environment)
 async def update_environment(env_id: str, environment_data: EnvironmentCreate, current_user: User = Depends(get_current_user)):
     # Check if environment exists and user owns it
-    env_data = redis_client.get(f"environment:{env_id}")
+    env_data = await redis_client.get(f"environment:{env_id}")
     if not env_data:
         raise HTTPException(status_code=404, detail="Environment not found")
     
@@ -760,13 +836,13 @@ async def update_environment(env_id: str, environment_data: EnvironmentCreate, c
         "variables": [var.dict() for var in environment_data.variables]
     })
     
-    redis_client.set(f"environment:{env_id}", json.dumps(environment))
+    await redis_client.set(f"environment:{env_id}", json.dumps(environment))
     return Environment(**environment)
 
 @app.delete("/environments/{env_id}")
 async def delete_environment(env_id: str, current_user: User = Depends(get_current_user)):
     # Check if environment exists and user owns it
-    env_data = redis_client.get(f"environment:{env_id}")
+    env_data = await redis_client.get(f"environment:{env_id}")
     if not env_data:
         raise HTTPException(status_code=404, detail="Environment not found")
     
@@ -775,8 +851,8 @@ async def delete_environment(env_id: str, current_user: User = Depends(get_curre
         raise HTTPException(status_code=403, detail="Not authorized to delete this environment")
     
     # Delete environment
-    redis_client.delete(f"environment:{env_id}")
-    redis_client.srem(f"user_environments:{current_user.id}", env_id)
+    await redis_client.delete(f"environment:{env_id}")
+    await redis_client.srem(f"user_environments:{current_user.id}", env_id)
     
     return {"message": "Environment deleted successfully"}
 
@@ -797,18 +873,18 @@ async def create_collection(collection_data: CollectionCreate, current_user: Use
     }
     
     # Store collection
-    redis_client.set(f"collection:{collection_id}", json.dumps(collection))
-    redis_client.sadd(f"user_collections:{current_user.id}", collection_id)
+    await redis_client.set(f"collection:{collection_id}", json.dumps(collection))
+    await redis_client.sadd(f"user_collections:{current_user.id}", collection_id)
     
     return Collection(**collection)
 
 @app.get("/collections", response_model=List[Collection])
 async def get_user_collections(current_user: User = Depends(get_current_user)):
-    collection_ids = redis_client.smembers(f"user_collections:{current_user.id}")
+    collection_ids = await redis_client.smembers(f"user_collections:{current_user.id}")
     collections = []
     
-    for collection_id in collection_ids:
-        collection_data = redis_client.get(f"collection:{collection_id.decode()}")
+    collection_keys = [f"collection:{collection_id.decode()}" for collection_id in collection_ids]
+    for collection_data in (await redis_client.mget(collection_keys) if collection_keys else []):
         if collection_data:
             collections.append(Collection(**json.loads(collection_data)))
     
@@ -816,7 +892,7 @@ async def get_user_collections(current_user: User = Depends(get_current_user)):
 
 @app.get("/collections/{collection_id}", response_model=Collection)
 async def get_collection(collection_id: str, current_user: User = Depends(get_current_user)):
-    collection_data = redis_client.get(f"collection:{collection_id}")
+    collection_data = await redis_client.get(f"collection:{collection_id}")
     if not collection_data:
         raise HTTPException(status_code=404, detail="Collection not found")
     
@@ -829,7 +905,7 @@ async def get_collection(collection_id: str, current_user: User = Depends(get_cu
 @app.post("/collections/{collection_id}/requests", response_model=CollectionRequest)
 async def add_request_to_collection(collection_id: str, request_data: CollectionRequestCreate, current_user: User = Depends(get_current_user)):
     # Check if collection exists and user owns it
-    collection_data = redis_client.get(f"collection:{collection_id}")
+    collection_data = await redis_client.get(f"collection:{collection_id}")
     if not collection_data:
         raise HTTPException(status_code=404, detail="Collection not found")
     
@@ -849,14 +925,14 @@ async def add_request_to_collection(collection_id: str, request_data: Collection
     
     # Add request to collection
     collection["requests"].append(new_request)
-    redis_client.set(f"collection:{collection_id}", json.dumps(collection))
+    await redis_client.set(f"collection:{collection_id}", json.dumps(collection))
     
     return CollectionRequest(**new_request)
 
 @app.delete("/collections/{collection_id}")
 async def delete_collection(collection_id: str, current_user: User = Depends(get_current_user)):
     # Check if collection exists and user owns it
-    collection_data = redis_client.get(f"collection:{collection_id}")
+    collection_data = await redis_client.get(f"collection:{collection_id}")
     if not collection_data:
         raise HTTPException(status_code=404, detail="Collection not found")
     
@@ -865,8 +941,8 @@ async def delete_collection(collection_id: str, current_user: User = Depends(get
         raise HTTPException(status_code=403, detail="Not authorized to delete this collection")
     
     # Delete collection
-    redis_client.delete(f"collection:{collection_id}")
-    redis_client.srem(f"user_collections:{current_user.id}", collection_id)
+    await redis_client.delete(f"collection:{collection_id}")
+    await redis_client.srem(f"user_collections:{current_user.id}", collection_id)
     
     return {"message": "Collection deleted successfully"}
 
@@ -878,7 +954,7 @@ async def execute_collection_request(
     current_user: User = Depends(get_current_user)
 ):
     # Get collection
-    collection_data = redis_client.get(f"collection:{collection_id}")
+    collection_data = await redis_client.get(f"collection:{collection_id}")
     if not collection_data:
         raise HTTPException(status_code=404, detail="Collection not found")
     
@@ -899,7 +975,7 @@ async def execute_collection_request(
     # Get environment variables if environment is set
     variables = {}
     if collection.get("environment_id"):
-        env_data = redis_client.get(f"environment:{collection['environment_id']}")
+        env_data = await redis_client.get(f"environment:{collection['environment_id']}")
         if env_data:
             environment = json.loads(env_data)
             for var in environment["variables"]:
@@ -951,7 +1027,7 @@ async def get_notification_rules(
 ):
     """Get all notification rules for a session"""
     # Verify user owns the session
-    session_data = redis_client.get(f"session:{session_id}")
+    session_data = await redis_client.get(f"session:{session_id}")
     if not session_data:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -959,11 +1035,18 @@ async def get_notification_rules(
     if session["owner_id"] != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    rules_data = redis_client.get(f"notification_rules:{session_id}")
+    rules_data = await redis_client.get(f"notification_rules:{session_id}")
     if not rules_data:
         return []
     
-    return json.loads(rules_data)
+    # Trigger times are kept apart from the rules so firing never rewrites them
+    rules = json.loads(rules_data)
+    triggers = await redis_client.hgetall(f"notification_triggers:{session_id}")
+    for rule in rules:
+        triggered = triggers.get(rule["id"].encode())
+        if triggered:
+            rule["last_triggered"] = triggered.decode()
+    return rules
 
 @app.delete("/notifications/rules/{rule_id}")
 async def delete_notification_rule(
@@ -972,11 +1055,11 @@ async def delete_notification_rule(
 ):
     """Delete a notification rule"""
     # Find the rule across all sessions for this user
-    user_sessions = redis_client.smembers(f"user_sessions:{current_user.id}")
+    user_sessions = await redis_client.smembers(f"user_sessions:{current_user.id}")
     
     for session_id in user_sessions:
         session_id = session_id.decode() if isinstance(session_id, bytes) else session_id
-        rules_data = redis_client.get(f"notification_rules:{session_id}")
+        rules_data = await redis_client.get(f"notification_rules:{session_id}")
         
         if rules_data:
             rules = json.loads(rules_data)
@@ -985,7 +1068,8 @@ async def delete_notification_rule(
             
             if len(rules) < original_count:
                 # Rule was found and removed
-                redis_client.set(f"notification_rules:{session_id}", json.dumps(rules))
+                await redis_client.set(f"notification_rules:{session_id}", json.dumps(rules))
+                await rule_sets.invalidate(redis_client, session_id)
                 return {"message": "Rule deleted successfully"}
     
     raise HTTPException(status_code=404, detail="Rule not found")
\ No newline at end of file
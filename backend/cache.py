@@ -0,0 +1,106 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+INVALIDATION_CHANNEL = "cache_invalidations"
+
+class LRUTTLCache:
+    """Bounded LRU cache whose entries also expire after a fixed TTL"""
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 30.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class CacheInvalidationBus:
+    """Broadcast cache invalidations to every worker over Redis pub/sub.
+
+    Messages are "<namespace>:<key>"; each cache registers a handler for its
+    namespace. Invalidations are applied locally before publishing so the
+    writing worker never serves its own stale entry.
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, Callable[[str], None]] = {}
+        self.resets: Dict[str, Callable[[], None]] = {}
+
+    def register(self, namespace: str, handler: Callable[[str], None],
+                 reset: Callable[[], None]):
+        self.handlers[namespace] = handler
+        self.resets[namespace] = reset
+
+    def apply(self, message: str):
+        namespace, _, key = message.partition(":")
+        handler = self.handlers.get(namespace)
+        if handler:
+            handler(key)
+
+    async def publish(self, redis_client, namespace: str, key: str):
+        message = f"{namespace}:{key}"
+        self.apply(message)
+        await redis_client.publish(INVALIDATION_CHANNEL, message)
+
+    async def listen(self, redis_client):
+        """Apply invalidations published by other workers until cancelled"""
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Anything published while we were disconnected is lost
+                for reset in self.resets.values():
+                    reset()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        data = message["data"]
+                        self.apply(data.decode() if isinstance(data, bytes) else data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Cache invalidation listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+invalidation_bus = CacheInvalidationBus()
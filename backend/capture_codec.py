@@ -0,0 +1,175 @@
+import json
+import zlib
+from typing import Any, Dict, Iterable, List, Optional
+
+import msgpack
+
+from cache import LRUTTLCache
+from session_keys import session_key
+
+# Record layouts, told apart by the first byte. Entries written before the
+# codec existed are plain JSON objects and therefore start with "{".
+FORMAT_MSGPACK = 1
+FORMAT_MSGPACK_ZLIB = 2
+
+# Packed records at least this large are worth compressing
+COMPRESS_MIN_BYTES = 512
+COMPRESS_LEVEL = 6
+
+# Header values that repeat across deliveries and are interned alongside
+# the header names. Anything else is stored inline; per-request values
+# (timestamps, ids, proxy chains) would only fill the dictionary.
+INTERNED_VALUE_HEADERS = frozenset({
+    "accept", "accept-encoding", "accept-language", "cache-control", "connection",
+    "content-encoding", "content-type", "host", "origin", "user-agent",
+    "x-forwarded-proto", "x-forwarded-port", "x-github-event"
+})
+
+# Upper bound on interned strings per session
+MAX_DICTIONARY_SIZE = 4096
+
+# Assigns ids to strings in the session's header dictionary. Ids start at 1,
+# 0 means the dictionary is full and the string must be stored inline. The
+# dictionary expires with the session record.
+#
+# KEYS[1] session record, KEYS[2] header dictionary hash (in the record's slot,
+# see session_keys.py)
+# ARGV[1] max dictionary size, ARGV[2] fallback TTL (ms), ARGV[3..] strings
+INTERN_SCRIPT = """
+local ids = {}
+local size = tonumber(redis.call('HGET', KEYS[2], '#') or '0')
+for i = 3, #ARGV do
+    local id = redis.call('HGET', KEYS[2], 's:' .. ARGV[i])
+    if not id then
+        if size < tonumber(ARGV[1]) then
+            size = redis.call('HINCRBY', KEYS[2], '#', 1)
+            redis.call('HSET', KEYS[2], 's:' .. ARGV[i], size, 'i:' .. size, ARGV[i])
+            id = size
+        else
+            id = 0
+        end
+    end
+    ids[#ids + 1] = tonumber(id)
+end
+
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl < 0 then
+    ttl = tonumber(ARGV[2])
+end
+redis.call('PEXPIRE', KEYS[2], ttl)
+return ids
+"""
+
+class HeaderDictionary:
+    """This worker's copy of one session's interned strings"""
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.strings: Dict[int, str] = {}
+        # Set once Redis reports the dictionary full; it never shrinks while
+        # the session lives, so new strings are stored inline without asking
+        self.full = False
+
+    def add(self, string: str, string_id: int):
+        self.ids[string] = string_id
+        self.strings[string_id] = string
+
+# Ids never change once assigned, so local copies only need bounding
+header_dictionaries = LRUTTLCache(max_size=10000, ttl_seconds=3600)
+
+class CaptureCodec:
+    """Versioned compact encoding for stored capture records"""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._intern = redis_client.register_script(INTERN_SCRIPT)
+
+    def _dictionary(self, session_id: str) -> HeaderDictionary:
+        dictionary = header_dictionaries.get(session_id)
+        if dictionary is None:
+            dictionary = HeaderDictionary()
+            header_dictionaries.set(session_id, dictionary)
+        return dictionary
+
+    async def encode(self, session_id: str, record: Dict[str, Any],
+                     fallback_ttl_seconds: int) -> bytes:
+        dictionary = self._dictionary(session_id)
+        headers = record.get("headers", {})
+
+        wanted = []
+        for name, value in headers.items():
+            wanted.append(name)
+            if name in INTERNED_VALUE_HEADERS:
+                wanted.append(value)
+        missing = [s for s in dict.fromkeys(wanted) if s not in dictionary.ids]
+        if missing and not dictionary.full:
+            ids = await self._intern(
+                keys=[f"session:{session_id}", session_key("header_dict", session_id)],
+                args=[MAX_DICTIONARY_SIZE, fallback_ttl_seconds * 1000, *missing],
+            )
+            for string, string_id in zip(missing, ids):
+                if string_id:
+                    dictionary.add(string, string_id)
+                else:
+                    dictionary.full = True
+
+        packed_headers = []
+        for name, value in headers.items():
+            packed_value = value
+            if name in INTERNED_VALUE_HEADERS:
+                packed_value = dictionary.ids.get(value, value)
+            packed_headers.append([dictionary.ids.get(name, name), packed_value])
+
+        payload = dict(record)
+        payload["headers"] = packed_headers
+        packed = msgpack.packb(payload, use_bin_type=True)
+        if len(packed) >= COMPRESS_MIN_BYTES:
+            return bytes([FORMAT_MSGPACK_ZLIB]) + zlib.compress(packed, COMPRESS_LEVEL)
+        return bytes([FORMAT_MSGPACK]) + packed
+
+    async def decode_many(self, session_id: str, raw_records: Iterable[Optional[bytes]]
+                          ) -> List[Optional[Dict[str, Any]]]:
+        """Decode stored records in order; missing entries stay None"""
+        payloads = []
+        for raw in raw_records:
+            if raw is None:
+                payloads.append(None)
+            elif raw[0] == FORMAT_MSGPACK_ZLIB:
+                payloads.append(msgpack.unpackb(zlib.decompress(raw[1:]), raw=False))
+            elif raw[0] == FORMAT_MSGPACK:
+                payloads.append(msgpack.unpackb(raw[1:], raw=False))
+            else:
+                payloads.append(json.loads(raw))
+
+        dictionary = None
+        for payload in payloads:
+            if payload is None or isinstance(payload.get("headers"), dict):
+                continue
+            if dictionary is None:
+                dictionary = await self._load_dictionary(session_id, payloads)
+            payload["headers"] = {
+                self._lookup(dictionary, name): self._lookup(dictionary, value)
+                for name, value in payload["headers"]
+            }
+        return payloads
+
+    async def _load_dictionary(self, session_id: str, payloads: List[Optional[Dict[str, Any]]]
+                               ) -> HeaderDictionary:
+        dictionary = self._dictionary(session_id)
+        needed = {
+            part
+            for payload in payloads if payload and isinstance(payload.get("headers"), list)
+            for pair in payload["headers"] for part in pair
+            if isinstance(part, int)
+        }
+        if needed - dictionary.strings.keys():
+            stored = await self.redis.hgetall(session_key("header_dict", session_id))
+            for field, string in stored.items():
+                if field.startswith(b"i:"):
+                    dictionary.add(string.decode(), int(field[2:]))
+        return dictionary
+
+    def _lookup(self, dictionary: HeaderDictionary, part: Any) -> str:
+        if isinstance(part, int):
+            return dictionary.strings.get(part, "")
+        return part
@@ -0,0 +1,258 @@
+import asyncio
+import os
+import socket
+import time
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from redis.exceptions import ResponseError
+
+# Every capture is appended to one shard of a global stream, the log that
+# background consumers (notifications and any later ones) read through
+# consumer groups. The per-session request list stays the browsable store:
+# log entries only carry the capture's seq and scalar fields, so they hold no
+# headers or bodies past the session's retention caps or its deletion.
+CAPTURE_LOG_SHARDS = int(os.getenv("CAPTURE_LOG_SHARDS", "4"))
+# Approximate entries kept per shard
+CAPTURE_LOG_MAXLEN = int(os.getenv("CAPTURE_LOG_MAXLEN", "100000"))
+
+# Entries a consumer took but never acknowledged are reclaimed after this long
+CLAIM_IDLE_MS = int(os.getenv("CAPTURE_LOG_CLAIM_IDLE_MS", "180000"))
+# A consumer stops handling a batch this long after reading it, so no entry is
+# still being handled once it can be reclaimed; entries it didn't start stay
+# pending for the next claim. The default leaves room for an email alert's
+# full SMTP retry sequence.
+HANDLE_BUDGET_MS = CLAIM_IDLE_MS * 2 // 3
+CLAIM_INTERVAL_SECONDS = 30
+
+NOTIFICATION_GROUP = "notifications"
+# Notification rules evaluated at once per process; 0 leaves them to
+# standalone notification_worker.py processes
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS", "4"))
+
+# Record fields copied into each log entry, and the stream field they go in
+EVENT_FIELDS = {
+    "method": "m",
+    "ip": "i",
+    "status_code": "c",
+    "timestamp": "t",
+    "response_time_ms": "d",
+}
+
+def event_fields(request_data: Dict[str, Any]) -> List[Any]:
+    """Flat stream field/value pairs for the scalar fields of a capture"""
+    pairs = []
+    for name, field in EVENT_FIELDS.items():
+        value = request_data.get(name)
+        if value is not None:
+            pairs.extend((field, value))
+    return pairs
+
+def _event_record(fields: Dict[bytes, bytes]) -> Dict[str, Any]:
+    record: Dict[str, Any] = {}
+    for name, field in EVENT_FIELDS.items():
+        value = fields.get(field.encode())
+        if value is None:
+            continue
+        value = value.decode()
+        if name == "status_code":
+            record[name] = int(value)
+        elif name == "response_time_ms":
+            record[name] = float(value)
+        else:
+            record[name] = value
+    return record
+
+def capture_log_key(session_id: str) -> str:
+    return f"capture_log:{zlib.crc32(session_id.encode()) % CAPTURE_LOG_SHARDS}"
+
+def capture_log_keys() -> List[str]:
+    return [f"capture_log:{shard}" for shard in range(CAPTURE_LOG_SHARDS)]
+
+def default_consumer_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class CaptureEvent:
+    """One capture log entry: a stored request, or a filtered one with no seq.
+
+    record holds only the scalar fields in EVENT_FIELDS; the full stored
+    request is read back by seq (see CaptureStore.get_request). A filtered
+    request has no stored copy, so the rules on its headers and query that
+    matched at capture time are listed in matched_rule_ids instead.
+    """
+
+    def __init__(self, session_id: str, record: Dict[str, Any], seq: Optional[int] = None,
+                 error_message: Optional[str] = None, matched_rule_ids: Optional[List[str]] = None):
+        self.session_id = session_id
+        self.record = record
+        self.seq = seq
+        self.error_message = error_message
+        self.matched_rule_ids = matched_rule_ids or []
+
+class CaptureLogConsumer:
+    """One member of a consumer group, reading every shard of the capture log.
+
+    Entries are acknowledged once the handler returns. Handler errors are
+    logged and the entry is still acknowledged, so a bad entry cannot wedge
+    the group; entries held by a consumer that died are claimed by another
+    after CLAIM_IDLE_MS.
+    """
+
+    def __init__(self, redis_client, group: str,
+                 handler: Callable[[CaptureEvent], Awaitable[None]],
+                 consumer: Optional[str] = None, batch_size: int = 100, block_ms: Optional[int] = 5000):
+        self.redis = redis_client
+        self.group = group
+        self.handler = handler
+        self.consumer = consumer or default_consumer_name()
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+
+    async def ensure_group(self):
+        for key in capture_log_keys():
+            try:
+                # New groups start at the end of the log rather than replaying it
+                await self.redis.xgroup_create(key, self.group, id="$", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def read(self) -> List[Tuple[str, List[Tuple[bytes, Dict[bytes, bytes]]]]]:
+        """Entries delivered to no consumer yet, per shard"""
+        response = await self.redis.xreadgroup(
+            self.group, self.consumer, {key: ">" for key in capture_log_keys()},
+            count=self.batch_size, block=self.block_ms,
+        )
+        return [(key.decode() if isinstance(key, bytes) else key, entries) for key, entries in response or []]
+
+    async def claim_stale(self) -> List[Tuple[str, List[Tuple[bytes, Dict[bytes, bytes]]]]]:
+        """Take over entries another consumer received but never acknowledged"""
+        claimed = []
+        for key in capture_log_keys():
+            start = "0-0"
+            while True:
+                start, entries, *_ = await self.redis.xautoclaim(
+                    key, self.group, self.consumer, CLAIM_IDLE_MS, start_id=start, count=self.batch_size
+                )
+                if entries:
+                    claimed.append((key, entries))
+                if start in (b"0-0", "0-0"):
+                    break
+        return claimed
+
+    def decode(self, fields: Dict[bytes, bytes]) -> CaptureEvent:
+        seq = fields.get(b"q")
+        error_message = fields.get(b"e")
+        matched = fields.get(b"k")
+        return CaptureEvent(
+            fields[b"s"].decode(), _event_record(fields),
+            seq=int(seq) if seq else None,
+            error_message=error_message.decode() if error_message else None,
+            matched_rule_ids=matched.decode().split(",") if matched else None,
+        )
+
+    async def process(self, key: str, entries: List[Tuple[bytes, Dict[bytes, bytes]]],
+                      received_at: Optional[float] = None):
+        """Handle entries in order, acknowledging each as soon as it is done.
+
+        received_at is the loop time the entries were read or claimed at;
+        each handler is cut off at HANDLE_BUDGET_MS from then, and entries
+        left when the budget runs out are not started.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = (loop.time() if received_at is None else received_at) + HANDLE_BUDGET_MS / 1000
+        for entry_id, fields in entries:
+            # Trimmed entries come back from XAUTOCLAIM without fields
+            if fields:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    print(f"Capture log consumer {self.group} out of time on {key}, leaving {entry_id} for reclaim")
+                    return
+                try:
+                    await asyncio.wait_for(self.handler(self.decode(fields)), remaining)
+                except asyncio.TimeoutError:
+                    print(f"Capture log consumer {self.group} timed out on {key} {entry_id}")
+                except Exception as e:
+                    print(f"Capture log consumer {self.group} failed on {key} {entry_id}: {e}")
+            await self.redis.xack(key, self.group, entry_id)
+
+    async def run(self):
+        """Consume the log until cancelled"""
+        next_claim = 0.0
+        while True:
+            try:
+                await self.ensure_group()
+                while True:
+                    # Taken before the call, so the budget covers the time entries wait behind other shards
+                    received_at = asyncio.get_running_loop().time()
+                    if received_at >= next_claim:
+                        for key, entries in await self.claim_stale():
+                            await self.process(key, entries, received_at)
+                        next_claim = asyncio.get_running_loop().time() + CLAIM_INTERVAL_SECONDS
+                    received_at = asyncio.get_running_loop().time()
+                    batches = await self.read()
+                    if not batches:
+                        # Don't spin if the server returned without honouring BLOCK
+                        await asyncio.sleep(0.05)
+                    for key, entries in batches:
+                        await self.process(key, entries, received_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Capture log consumer {self.group} error: {e}")
+                await asyncio.sleep(1)
+
+async def run_consumer_pool(redis_client, group: str,
+                            handler: Callable[[CaptureEvent], Awaitable[None]],
+                            concurrency: int, consumer: Optional[str] = None):
+    """Run `concurrency` consumers of a group, so at most that many handlers run at once"""
+    base = consumer or default_consumer_name()
+    consumers = [
+        # Small batches so one busy consumer doesn't hold entries the others could take
+        CaptureLogConsumer(redis_client, group, handler, consumer=f"{base}-{i}", batch_size=10)
+        for i in range(concurrency)
+    ]
+    await asyncio.gather(*(c.run() for c in consumers))
+
+def _entry_age_seconds(entry_id: bytes, now_ms: float) -> float:
+    return max(now_ms - int(entry_id.split(b"-")[0]), 0) / 1000
+
+async def capture_log_metrics(redis_client, groups: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Queue depth and lag per consumer group, summed over every shard.
+
+    depth counts entries not yet acknowledged, whether delivered (pending)
+    or not; lag_seconds is the age of the oldest of them.
+    """
+    now_ms = time.time() * 1000
+    metrics = {group: {"depth": 0, "pending": 0, "undelivered": 0, "lag_seconds": 0.0} for group in groups}
+    for key in capture_log_keys():
+        try:
+            infos = await redis_client.xinfo_groups(key)
+        except ResponseError:
+            # Shard not created yet
+            continue
+        for info in infos:
+            name = info["name"].decode() if isinstance(info["name"], bytes) else info["name"]
+            if name not in metrics:
+                continue
+            group = metrics[name]
+            # lag is unknown (None) for a while after the shard is trimmed
+            undelivered = info.get("lag") or 0
+            group["undelivered"] += undelivered
+            group["pending"] += info["pending"]
+            group["depth"] += undelivered + info["pending"]
+
+            oldest = None
+            if info["pending"]:
+                oldest = (await redis_client.xpending(key, name))["min"]
+            elif undelivered:
+                last_delivered = info["last-delivered-id"]
+                if isinstance(last_delivered, bytes):
+                    last_delivered = last_delivered.decode()
+                first = await redis_client.xrange(key, f"({last_delivered}", "+", count=1)
+                oldest = first[0][0] if first else None
+            if oldest:
+                if isinstance(oldest, str):
+                    oldest = oldest.encode()
+                group["lag_seconds"] = max(group["lag_seconds"], _entry_age_seconds(oldest, now_ms))
+    return metrics
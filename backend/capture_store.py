@@ -0,0 +1,587 @@
+import base64
+import hashlib
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
+from models import SessionLifespan, SessionRetention
+from search_index import document_terms
+from capture_codec import CaptureCodec
+from capture_log import CAPTURE_LOG_MAXLEN, capture_log_key, event_fields
+from session_keys import session_key, session_key_prefix
+
+MB = 1024 * 1024
+
+# Default capture retention per session lifespan
+RETENTION_DEFAULTS = {
+    SessionLifespan.ONE_HOUR: SessionRetention(max_requests=1000, max_bytes=10 * MB, max_body_bytes=5 * MB),
+    SessionLifespan.TWENTY_FOUR_HOURS: SessionRetention(max_requests=5000, max_bytes=50 * MB, max_body_bytes=10 * MB),
+    SessionLifespan.SEVEN_DAYS: SessionRetention(max_requests=10000, max_bytes=100 * MB, max_body_bytes=10 * MB),
+    SessionLifespan.TWO_WEEKS: SessionRetention(max_requests=20000, max_bytes=200 * MB, max_body_bytes=10 * MB)
+}
+
+# Plans that get more than the lifespan defaults
+PLAN_RETENTION_OVERRIDES = {
+    "pro": SessionRetention(max_requests=50000, max_bytes=500 * MB, max_body_bytes=50 * MB)
+}
+
+def get_retention_limits(lifespan: SessionLifespan, plan: Optional[str] = None) -> SessionRetention:
+    """Resolve capture retention caps for a session"""
+    return PLAN_RETENTION_OVERRIDES.get(plan) or RETENTION_DEFAULTS[lifespan]
+
+# Sessions created before the stats hash existed kept their count in the
+# session record and have only a request list. Scripts that map seqs onto list
+# positions seed the hash from the larger of the two the first time they find
+# it without a count, so old captures keep consistent seqs.
+SEED_COUNT_FUNCTION = """
+local function request_count(session_key, list_key, stats_key)
+    local count = redis.call('HGET', stats_key, 'request_count')
+    if count then
+        return tonumber(count)
+    end
+    count = redis.call('LLEN', list_key)
+    local record = redis.call('GET', session_key)
+    if record then
+        local ok, session = pcall(cjson.decode, record)
+        if ok and type(session) == 'table' and tonumber(session.request_count) then
+            count = math.max(count, tonumber(session.request_count))
+        end
+    end
+    if count > 0 then
+        redis.call('HSET', stats_key, 'request_count', count)
+        local ttl = redis.call('PTTL', session_key)
+        if ttl > 0 then
+            redis.call('PEXPIRE', stats_key, ttl)
+        end
+    end
+    return count
+end
+"""
+
+# Commits one captured request in a single round trip. The request list and
+# the stats hash inherit the remaining TTL of the session record so captured
+# data never outlives its session. Once the list exceeds either retention
+# cap the oldest requests are evicted, but the newest one is always kept.
+#
+# Every request is also added to secondary indexes under ARGV[6], all sorted
+# sets whose members are capture sequence numbers: "time" scored by capture
+# time, and one posting set per indexed value ("method:POST", "ip:...")
+# scored by seq. The suffixes a request was indexed under are pushed onto a
+# tag list that mirrors the request list, so evicting a request removes it
+# from exactly the sets it was added to, and a set left empty is dropped from
+# the set of suffixes.
+#
+# An offloaded body is written to its own blob key and tagged "body:<id>",
+# so it counts towards the byte cap and is deleted with its request.
+#
+# The request is also counted in the rate bucket for its capture time (see
+# request_rate()).
+#
+# Posting set and blob names are built here from the prefixes in ARGV[6] and
+# ARGV[8], so they can't be declared in KEYS. Every key this script touches,
+# declared or built, carries the session's hash tag (see session_keys.py) and
+# so is in the slot of KEYS[1]. The capture log shard is in no particular
+# slot, so its entry is appended by the caller once the script returns.
+#
+# KEYS[1] session record, KEYS[2] request list, KEYS[3] session stats hash,
+# KEYS[4] index tag list, KEYS[5] time index, KEYS[6] set of index suffixes,
+# KEYS[7] rate bucket
+# ARGV[1] encoded request, ARGV[2] capture timestamp, ARGV[3] fallback TTL (ms)
+# ARGV[4] max requests, ARGV[5] max bytes, ARGV[6] index key prefix,
+# ARGV[7] capture time (epoch seconds), ARGV[8] body blob key prefix,
+# ARGV[9] request id, ARGV[10] offloaded body ('' if inline),
+# ARGV[11] rate bucket TTL (ms), ARGV[12..] posting suffixes
+CAPTURE_SCRIPT = SEED_COUNT_FUNCTION + """
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl == -2 then
+    return -1
+end
+if ttl == -1 then
+    ttl = tonumber(ARGV[3])
+end
+
+local prefix = ARGV[6]
+request_count(KEYS[1], KEYS[2], KEYS[3])
+local seq = redis.call('HINCRBY', KEYS[3], 'request_count', 1)
+redis.call('HSET', KEYS[3], 'last_request', ARGV[2])
+
+local length = redis.call('LPUSH', KEYS[2], ARGV[1])
+local bytes = redis.call('HINCRBY', KEYS[3], 'bytes', string.len(ARGV[1]))
+
+local suffixes = {}
+if ARGV[10] ~= '' then
+    redis.call('SET', ARGV[8] .. ARGV[9], ARGV[10], 'PX', ttl)
+    bytes = redis.call('HINCRBY', KEYS[3], 'bytes', string.len(ARGV[10]))
+    suffixes[1] = 'body:' .. ARGV[9]
+end
+for i = 12, #ARGV do
+    local suffix = ARGV[i]
+    suffixes[#suffixes + 1] = suffix
+    redis.call('ZADD', prefix .. suffix, seq, seq)
+    redis.call('PEXPIRE', prefix .. suffix, ttl)
+    redis.call('SADD', KEYS[6], suffix)
+end
+redis.call('LPUSH', KEYS[4], table.concat(suffixes, '\\n'))
+redis.call('ZADD', KEYS[5], ARGV[7], seq)
+
+local max_requests = tonumber(ARGV[4])
+local max_bytes = tonumber(ARGV[5])
+local evicted = 0
+while length > 1 and (length > max_requests or bytes > max_bytes) do
+    local evicted_seq = seq - length + 1
+    -- Lists written before indexing have no tags for their oldest entries
+    if redis.call('LLEN', KEYS[4]) >= length then
+        local tags = redis.call('RPOP', KEYS[4])
+        for suffix in string.gmatch(tags, '[^\\n]+') do
+            if string.sub(suffix, 1, 5) == 'body:' then
+                local blob = ARGV[8] .. string.sub(suffix, 6)
+                bytes = bytes - redis.call('STRLEN', blob)
+                redis.call('DEL', blob)
+            else
+                redis.call('ZREM', prefix .. suffix, evicted_seq)
+                if redis.call('ZCARD', prefix .. suffix) == 0 then
+                    redis.call('SREM', KEYS[6], suffix)
+                end
+            end
+        end
+    end
+    redis.call('ZREM', KEYS[5], evicted_seq)
+
+    local oldest = redis.call('RPOP', KEYS[2])
+    bytes = bytes - string.len(oldest)
+    length = length - 1
+    evicted = evicted + 1
+end
+if evicted > 0 then
+    -- Lists written before byte accounting can drive the counter negative
+    if bytes < 0 then
+        bytes = 0
+    end
+    redis.call('HSET', KEYS[3], 'bytes', bytes)
+    redis.call('HINCRBY', KEYS[3], 'evicted_count', evicted)
+end
+
+for i = 2, 6 do
+    redis.call('PEXPIRE', KEYS[i], ttl)
+end
+
+redis.call('INCR', KEYS[7])
+redis.call('PEXPIRE', KEYS[7], ARGV[11])
+return seq
+"""
+
+# Reads one chunk of the request list together with the session's request
+# count, so list positions map onto capture sequence numbers consistently.
+# The newest request has seq == request_count, and each older one is one less.
+#
+# KEYS[1] session stats hash, KEYS[2] request list, KEYS[3] session record
+# ARGV[1] only return requests with seq below this (0 = newest), ARGV[2] chunk size
+PAGE_SCRIPT = SEED_COUNT_FUNCTION + """
+local count = request_count(KEYS[3], KEYS[2], KEYS[1])
+local before = tonumber(ARGV[1])
+local start = 0
+if before > 0 then
+    start = count - before + 1
+end
+if start < 0 then
+    start = 0
+end
+local items = redis.call('LRANGE', KEYS[2], start, start + tonumber(ARGV[2]) - 1)
+return {count - start, items}
+"""
+
+# Answers a filtered listing from the secondary indexes. Time bounds are
+# turned into a seq range through the time index (captures are timestamped
+# in seq order), posting sets are intersected, and the matching records are
+# fetched by list position, all in one round trip.
+#
+# The scratch key and posting sets carry the session's hash tag like the
+# other keys (see session_keys.py), so the intersection stays in one slot.
+#
+# KEYS[1] session stats hash, KEYS[2] request list, KEYS[3] time index,
+# KEYS[4] scratch key for intersections, KEYS[5] session record,
+# KEYS[6..] posting sets
+# ARGV[1] only return requests with seq below this (0 = newest), ARGV[2] limit,
+# ARGV[3] since (epoch seconds or -inf), ARGV[4] until (epoch seconds or +inf)
+QUERY_SCRIPT = SEED_COUNT_FUNCTION + """
+local count = request_count(KEYS[5], KEYS[2], KEYS[1])
+local length = redis.call('LLEN', KEYS[2])
+local lo = count - length + 1
+local hi = count
+local before = tonumber(ARGV[1])
+if before > 0 and before - 1 < hi then
+    hi = before - 1
+end
+
+if ARGV[3] ~= '-inf' then
+    local first = redis.call('ZRANGEBYSCORE', KEYS[3], ARGV[3], '+inf', 'LIMIT', 0, 1)
+    if #first == 0 then
+        return {count, {}, {}}
+    end
+    lo = math.max(lo, tonumber(first[1]))
+end
+if ARGV[4] ~= '+inf' then
+    local last = redis.call('ZREVRANGEBYSCORE', KEYS[3], ARGV[4], '-inf', 'LIMIT', 0, 1)
+    if #last == 0 then
+        return {count, {}, {}}
+    end
+    hi = math.min(hi, tonumber(last[1]))
+end
+if hi < lo then
+    return {count, {}, {}}
+end
+
+local limit = tonumber(ARGV[2])
+local seqs = {}
+local postings = #KEYS - 5
+if postings == 0 then
+    for s = hi, math.max(lo, hi - limit + 1), -1 do
+        seqs[#seqs + 1] = s
+    end
+elseif postings == 1 then
+    seqs = redis.call('ZREVRANGEBYSCORE', KEYS[6], hi, lo, 'LIMIT', 0, limit)
+else
+    local command = {'ZINTERSTORE', KEYS[4], postings}
+    for i = 6, #KEYS do
+        command[#command + 1] = KEYS[i]
+    end
+    command[#command + 1] = 'AGGREGATE'
+    command[#command + 1] = 'MIN'
+    redis.call(unpack(command))
+    seqs = redis.call('ZREVRANGEBYSCORE', KEYS[4], hi, lo, 'LIMIT', 0, limit)
+    redis.call('DEL', KEYS[4])
+end
+
+local records = {}
+for i, s in ipairs(seqs) do
+    records[i] = redis.call('LINDEX', KEYS[2], count - tonumber(s))
+end
+return {count, seqs, records}
+"""
+
+# Reads one request by seq, or nothing once it has been evicted
+#
+# KEYS[1] session stats hash, KEYS[2] request list
+# ARGV[1] seq
+RECORD_SCRIPT = """
+local count = tonumber(redis.call('HGET', KEYS[1], 'request_count') or '0')
+local position = count - tonumber(ARGV[1])
+if position < 0 then
+    return false
+end
+return redis.call('LINDEX', KEYS[2], position)
+"""
+
+LIST_CHUNK_SIZE = 100
+
+# Bodies larger than this are stored under their own key, and the request
+# record keeps only a preview
+BODY_OFFLOAD_THRESHOLD_BYTES = int(os.getenv("BODY_OFFLOAD_THRESHOLD_BYTES", str(64 * 1024)))
+BODY_PREVIEW_BYTES = 1024
+
+def offload_body(request_data: Dict[str, Any], body: bytes, body_size: Optional[int] = None,
+                 body_sha256: Optional[str] = None) -> Optional[bytes]:
+    """Swap a large body for a preview in request_data and return the bytes to store separately
+
+    body may be just the stored head of a longer payload, in which case the
+    caller passes the full size and hash.
+    """
+    if body_size is None:
+        body_size = len(body)
+    if body_size <= BODY_OFFLOAD_THRESHOLD_BYTES:
+        return None
+
+    preview = body[:BODY_PREVIEW_BYTES].decode("utf-8", errors="ignore")
+    content_type = request_data.get("headers", {}).get("content-type", "application/octet-stream")
+    request_data.update({
+        "body": preview,
+        "body_offloaded": True,
+        "body_size": body_size,
+        "body_sha256": body_sha256 or hashlib.sha256(body).hexdigest(),
+    })
+    if body_size > len(body):
+        request_data["body_truncated"] = True
+    # The blob starts with the original content type so it can be served as-is
+    return content_type.encode() + b"\n" + body
+
+# Request rates are counted in fixed buckets, each its own expiring key, and
+# read as a sliding window over the most recent ones
+RATE_BUCKET_SECONDS = 10
+RATE_WINDOW_SECONDS = 60
+
+def rate_bucket_key(session_id: str, bucket: int) -> str:
+    return session_key("rate", session_id, bucket)
+
+def encode_cursor(seq: int) -> str:
+    return base64.urlsafe_b64encode(f"seq:{seq}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    """Return the sequence number a cursor points below, or raise ValueError"""
+    try:
+        decoded = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except Exception:
+        raise ValueError("Invalid cursor")
+    prefix, _, seq = decoded.partition(":")
+    if prefix != "seq" or not seq.isdigit():
+        raise ValueError("Invalid cursor")
+    return int(seq)
+
+def index_suffixes(request_data: Dict[str, Any], body_blob: Optional[bytes] = None) -> List[str]:
+    """Posting sets a captured request is indexed under"""
+    if body_blob:
+        # Search the offloaded body rather than its preview
+        body = body_blob.partition(b"\n")[2].decode("utf-8", errors="ignore")
+        request_data = {**request_data, "body": body}
+    return [
+        f"method:{request_data['method']}",
+        f"status:{request_data['status_code']}",
+        f"ip:{request_data['ip']}",
+        *(f"term:{term}" for term in document_terms(request_data)),
+    ]
+
+class RequestFilter:
+    """Server-side match on the fields the dashboard filters by"""
+
+    def __init__(self, method: Optional[str] = None, status_code: Optional[int] = None,
+                 ip: Optional[str] = None, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None, terms: Optional[List[str]] = None):
+        self.method = method.upper() if method else None
+        self.terms = terms or []
+        self.status_code = status_code
+        self.ip = ip
+        # Naive datetimes are local time, like capture timestamps
+        self.since = since.timestamp() if since else None
+        self.until = until.timestamp() if until else None
+
+    def posting_suffixes(self) -> List[str]:
+        suffixes = []
+        if self.method:
+            suffixes.append(f"method:{self.method}")
+        if self.status_code is not None:
+            suffixes.append(f"status:{self.status_code}")
+        if self.ip:
+            suffixes.append(f"ip:{self.ip}")
+        suffixes.extend(f"term:{term}" for term in self.terms)
+        return suffixes
+
+class CaptureStore:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._capture = redis_client.register_script(CAPTURE_SCRIPT)
+        self._page = redis_client.register_script(PAGE_SCRIPT)
+        self._query = redis_client.register_script(QUERY_SCRIPT)
+        self._record = redis_client.register_script(RECORD_SCRIPT)
+        self.codec = CaptureCodec(redis_client)
+
+    async def commit(self, session_id: str, request_data: Dict[str, Any],
+                     fallback_ttl_seconds: int, retention: SessionRetention,
+                     body_blob: Optional[bytes] = None,
+                     error_message: Optional[str] = None) -> Optional[int]:
+        """Store and index a captured request, enforce retention and bump session counters atomically.
+
+        Its capture log event is appended once the request is stored.
+        Returns the request's sequence number (the session's new request
+        count), or None if the session expired before the write landed.
+        """
+        encoded = await self.codec.encode(session_id, request_data, fallback_ttl_seconds)
+        captured_at = datetime.fromisoformat(request_data["timestamp"]).timestamp()
+        seq = await self._capture(
+            keys=[
+                f"session:{session_id}",
+                session_key("requests", session_id),
+                session_key("session_stats", session_id),
+                session_key("req_idx", session_id, "tags"),
+                session_key("req_idx", session_id, "time"),
+                session_key("req_idx", session_id, "keys"),
+                rate_bucket_key(session_id, int(captured_at // RATE_BUCKET_SECONDS)),
+            ],
+            args=[
+                encoded,
+                request_data["timestamp"],
+                fallback_ttl_seconds * 1000,
+                retention.max_requests,
+                retention.max_bytes,
+                session_key_prefix("req_idx", session_id),
+                captured_at,
+                session_key_prefix("request_body", session_id),
+                request_data["id"],
+                body_blob or b"",
+                (RATE_WINDOW_SECONDS + RATE_BUCKET_SECONDS) * 1000,
+                *index_suffixes(request_data, body_blob),
+            ],
+        )
+        if seq < 0:
+            return None
+        await self.log_event(session_id, request_data, error_message, seq=seq)
+        return seq
+
+    async def log_event(self, session_id: str, request_data: Dict[str, Any],
+                        error_message: Optional[str] = None,
+                        matched_rule_ids: Optional[List[str]] = None, seq: Optional[int] = None):
+        """Append a compact event for a request to the capture log.
+
+        seq is the stored request's seq; requests that are not stored, such
+        as filtered ones, are logged without one. matched_rule_ids lists
+        rules that already matched fields the event doesn't carry.
+        """
+        event = event_fields(request_data)
+        fields = {"s": session_id}
+        if seq is not None:
+            fields["q"] = seq
+        fields.update(zip(event[::2], event[1::2]))
+        if error_message:
+            fields["e"] = error_message
+        if matched_rule_ids:
+            fields["k"] = ",".join(matched_rule_ids)
+        await self.redis.xadd(capture_log_key(session_id), fields,
+                              maxlen=CAPTURE_LOG_MAXLEN, approximate=True)
+
+    async def request_rate(self, session_id: str, now: Optional[float] = None) -> float:
+        """Captures in the last RATE_WINDOW_SECONDS, read from a fixed number of buckets.
+
+        The oldest bucket only partly overlaps the window and is weighted by
+        how much of it does.
+        """
+        now = time.time() if now is None else now
+        current = int(now // RATE_BUCKET_SECONDS)
+        buckets = RATE_WINDOW_SECONDS // RATE_BUCKET_SECONDS
+        counts = await self.redis.mget(
+            [rate_bucket_key(session_id, bucket) for bucket in range(current - buckets, current + 1)]
+        )
+        counts = [int(count or 0) for count in counts]
+        overlap = 1 - (now % RATE_BUCKET_SECONDS) / RATE_BUCKET_SECONDS
+        return counts[0] * overlap + sum(counts[1:])
+
+    async def list_requests(self, session_id: str, limit: int, before_seq: Optional[int] = None,
+                            request_filter: Optional[RequestFilter] = None
+                            ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """Return up to `limit` requests, newest first, and the seq to resume below"""
+        if request_filter is None:
+            first_seq, items = await self._page(
+                keys=[
+                    session_key("session_stats", session_id),
+                    session_key("requests", session_id),
+                    f"session:{session_id}",
+                ],
+                args=[before_seq or 0, limit],
+            )
+            seqs = range(first_seq, first_seq - len(items), -1)
+        else:
+            _, seqs, items = await self._query(
+                keys=[
+                    session_key("session_stats", session_id),
+                    session_key("requests", session_id),
+                    session_key("req_idx", session_id, "time"),
+                    session_key("req_idx", session_id, "query"),
+                    f"session:{session_id}",
+                    *(session_key("req_idx", session_id, suffix) for suffix in request_filter.posting_suffixes()),
+                ],
+                args=[
+                    before_seq or 0,
+                    limit,
+                    request_filter.since if request_filter.since is not None else "-inf",
+                    request_filter.until if request_filter.until is not None else "+inf",
+                ],
+            )
+
+        requests = []
+        for seq, record in zip(seqs, await self.codec.decode_many(session_id, items)):
+            if record is None:
+                continue
+            record["seq"] = int(seq)
+            requests.append(record)
+
+        last_seq = int(seqs[-1]) if len(items) == limit else None
+        return requests, (last_seq if last_seq and last_seq > 1 else None)
+
+    async def get_request(self, session_id: str, seq: int) -> Optional[Dict[str, Any]]:
+        """The stored request with this seq, or None if it has been evicted"""
+        raw = await self._record(
+            keys=[session_key("session_stats", session_id), session_key("requests", session_id)], args=[seq]
+        )
+        record = (await self.codec.decode_many(session_id, [raw]))[0]
+        if record is not None:
+            record["seq"] = seq
+        return record
+
+    async def requests_since(self, session_id: str, after_seq: int,
+                             limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Return requests with seq above after_seq, oldest first.
+
+        Returns None if more than `limit` were missed or some of them have
+        already been evicted, i.e. the caller should reload instead.
+        """
+        count = int(await self.redis.hget(session_key("session_stats", session_id), "request_count") or 0)
+        missed = count - after_seq
+        if missed <= 0:
+            return []
+        if missed > limit:
+            return None
+        requests, _ = await self.list_requests(session_id, missed, before_seq=count + 1)
+        if len(requests) < missed:
+            return None
+        requests.reverse()
+        return requests
+
+    async def iter_requests(self, session_id: str,
+                            chunk_size: int = LIST_CHUNK_SIZE) -> AsyncIterator[Dict[str, Any]]:
+        """Yield every stored request, newest first, reading one chunk at a time"""
+        before = 0
+        while True:
+            first_seq, items = await self._page(
+                keys=[
+                    session_key("session_stats", session_id),
+                    session_key("requests", session_id),
+                    f"session:{session_id}",
+                ],
+                args=[before, chunk_size],
+            )
+            for offset, record in enumerate(await self.codec.decode_many(session_id, items)):
+                record["seq"] = first_seq - offset
+                yield record
+
+            before = first_seq - len(items) + 1
+            if len(items) < chunk_size or before <= 1:
+                return
+
+    async def read_body(self, session_id: str, request_id: str,
+                        chunk_size: int = 256 * 1024) -> Optional[Tuple[str, AsyncIterator[bytes]]]:
+        """Return the content type and a chunked reader for an offloaded body"""
+        key = session_key("request_body", session_id, request_id)
+        head = await self.redis.getrange(key, 0, 1023)
+        if not head:
+            return None
+        content_type, newline, _ = head.partition(b"\n")
+        if not newline:
+            return None
+        offset = len(content_type) + 1
+
+        async def chunks() -> AsyncIterator[bytes]:
+            start = offset
+            while True:
+                chunk = await self.redis.getrange(key, start, start + chunk_size - 1)
+                if not chunk:
+                    return
+                yield chunk
+                start += len(chunk)
+
+        return content_type.decode(), chunks()
+
+    async def delete_session_data(self, session_id: str):
+        """Remove a session's captured requests, counters, indexes and offloaded bodies"""
+        suffixes = await self.redis.smembers(session_key("req_idx", session_id, "keys"))
+        tags = await self.redis.lrange(session_key("req_idx", session_id, "tags"), 0, -1)
+        blobs = [
+            session_key("request_body", session_id, suffix[5:].decode())
+            for entry in tags for suffix in entry.split(b"\n") if suffix.startswith(b"body:")
+        ]
+        await self.redis.delete(
+            *blobs,
+            session_key("requests", session_id),
+            session_key("session_stats", session_id),
+            session_key("req_idx", session_id, "tags"),
+            session_key("req_idx", session_id, "time"),
+            session_key("req_idx", session_id, "keys"),
+            session_key("header_dict", session_id),
+            *(session_key("req_idx", session_id, suffix.decode()) for suffix in suffixes),
+        )
@@ -1,17 +1,144 @@
+import asyncio
+import html
+import queue
 import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+
+# Authenticated SMTP connections kept open, and threads sending on them
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+# Idle connections are checked with NOOP before reuse after this long
+SMTP_IDLE_CHECK_SECONDS = float(os.getenv("SMTP_IDLE_CHECK_SECONDS", "30"))
+SMTP_TIMEOUT_SECONDS = float(os.getenv("SMTP_TIMEOUT_SECONDS", "30"))
+SMTP_MAX_ATTEMPTS = int(os.getenv("SMTP_MAX_ATTEMPTS", "3"))
+SMTP_RETRY_BASE_SECONDS = float(os.getenv("SMTP_RETRY_BASE_SECONDS", "0.5"))
+# Refuse to send (and so to log in) without STARTTLS; only turn off for local test servers
+SMTP_REQUIRE_TLS = os.getenv("SMTP_REQUIRE_TLS", "1") != "0"
+
+def _is_transient(error: Exception) -> bool:
+    """Whether resending on a fresh connection may succeed"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        # 4xx replies are temporary; 5xx (bad recipient, auth) won't change on retry
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # SMTPException subclasses OSError; the rest (e.g. no STARTTLS offered) are configuration problems
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+class SMTPConnectionPool:
+    """Logged-in SMTP connections reused across messages.
+
+    Each send checks a connection out, so one connection carries many
+    messages instead of paying for connect, STARTTLS and login each time.
+    Thread-safe; connections are opened lazily up to max_size.
+    """
+
+    def __init__(self, host: str, port: int, username: Optional[str], password: Optional[str],
+                 max_size: int = SMTP_POOL_SIZE, timeout: float = SMTP_TIMEOUT_SECONDS,
+                 require_tls: bool = SMTP_REQUIRE_TLS):
+        self.host = host
+        self.require_tls = require_tls
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.idle: "queue.LifoQueue[tuple]" = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.opened = 0
+
+    def _open(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            # starttls() raises if the server doesn't offer it, so a stripped
+            # STARTTLS fails closed instead of sending credentials in the clear
+            if self.require_tls or server.has_extn("starttls"):
+                server.starttls()
+                server.ehlo()
+            if self.username:
+                server.login(self.username, self.password)
+        except BaseException:
+            server.close()
+            raise
+        self.opened += 1
+        return server
+
+    def _usable(self, server: smtplib.SMTP, idle_since: float) -> bool:
+        if time.monotonic() - idle_since < SMTP_IDLE_CHECK_SECONDS:
+            return True
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def acquire(self) -> smtplib.SMTP:
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    server, idle_since = self.idle.get_nowait()
+                except queue.Empty:
+                    return self._open()
+                if self._usable(server, idle_since):
+                    return server
+                self._close(server)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, server: smtplib.SMTP, healthy: bool = True):
+        if healthy:
+            self.idle.put((server, time.monotonic()))
+        else:
+            self._close(server)
+        self.slots.release()
+
+    def _close(self, server: smtplib.SMTP):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(server)
 
 class EmailService:
-    def __init__(self):
-        self.smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-        self.smtp_port = int(os.getenv("SMTP_PORT", "587"))
-        self.smtp_username = os.getenv("SMTP_USERNAME")
-        self.smtp_password = os.getenv("SMTP_PASSWORD")
+    def __init__(self, smtp_server: Optional[str] = None, smtp_port: Optional[int] = None,
+                 smtp_username: Optional[str] = None, smtp_password: Optional[str] = None,
+                 pool_size: int = SMTP_POOL_SIZE, require_tls: bool = SMTP_REQUIRE_TLS):
+        self.smtp_server = smtp_server or os.getenv("SMTP_SERVER", "smtp.gmail.com")
+        self.smtp_port = smtp_port or int(os.getenv("SMTP_PORT", "587"))
+        self.smtp_username = smtp_username or os.getenv("SMTP_USERNAME")
+        self.smtp_password = smtp_password or os.getenv("SMTP_PASSWORD")
         self.from_email = os.getenv("FROM_EMAIL", self.smtp_username)
+        self.pool = SMTPConnectionPool(self.smtp_server, self.smtp_port, self.smtp_username,
+                                       self.smtp_password, max_size=pool_size, require_tls=require_tls)
+        # One thread per pooled connection, so sends never queue behind the event loop's default executor
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="smtp")
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+    
+    async def send_notification_async(self, to_emails: List[str], subject: str,
+                                      webhook_data: Dict[Any, Any], condition_info: Dict[str, Any]) -> bool:
+        """send_notification on the SMTP thread pool, off the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.send_notification, to_emails, subject, webhook_data, condition_info
+        )
     
     def send_notification(self, to_emails: List[str], subject: str, 
                          webhook_data: Dict[Any, Any], condition_info: Dict[str, Any]):
@@ -26,21 +153,50 @@ class EmailService:
             html_body = self._create_email_template(webhook_data, condition_info)
             msg.attach(MIMEText(html_body, 'html'))
             
-            # Send email
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.smtp_username, self.smtp_password)
-                server.send_message(msg)
-                
+            self._send_with_retry(msg)
+            self.sent += 1
             return True
         except Exception as e:
+            self.failed += 1
             print(f"Failed to send email: {e}")
             return False
     
+    def _send_with_retry(self, msg: MIMEMultipart):
+        """Send on a pooled connection, retrying transient failures with exponential backoff"""
+        for attempt in range(SMTP_MAX_ATTEMPTS):
+            server = None
+            try:
+                server = self.pool.acquire()
+                server.send_message(msg)
+                self.pool.release(server)
+                return
+            except Exception as e:
+                if server is not None:
+                    # The connection's state is unknown after an error; don't hand it out again
+                    self.pool.release(server, healthy=False)
+                if not _is_transient(e) or attempt == SMTP_MAX_ATTEMPTS - 1:
+                    raise
+                self.retries += 1
+                time.sleep(SMTP_RETRY_BASE_SECONDS * 2 ** attempt)
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "connections_opened": self.pool.opened,
+            "idle_connections": self.pool.idle.qsize(),
+        }
+    
+    def close(self):
+        """Log out of idle connections; the service stays usable and reconnects on demand"""
+        self.pool.close()
+    
     def _create_email_template(self, webhook_data: Dict[Any, Any], 
                               condition_info: Dict[str, Any]) -> str:
         """Create HTML email template"""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        digest_section = self._create_digest_section(condition_info['digest']) if condition_info.get('digest') else ""
         
         return f"""
         <html>
@@ -60,7 +216,7 @@ class EmailService:
                 <p><strong>Condition:</strong> {condition_info['condition_name']}</p>
                 <p><strong>Triggered by:</strong> <span class="highlight">{condition_info['triggered_value']}</span></p>
             </div>
-            
+            {digest_section}
             <div class="content">
                 <h3>Request Details</h3>
                 <p><strong>Method:</strong> {webhook_data.get('method', 'N/A')}</p>
@@ -78,6 +234,31 @@ class EmailService:
         </body>
         </html>
         """
+    
+    def _create_digest_section(self, digest: Dict[str, Any]) -> str:
+        """Summary of the matches folded into a digest email"""
+        # Everything here comes from captured requests; escape it before it goes into HTML
+        esc = lambda value: html.escape(str(value))
+        rows = "".join(
+            f"<li>{esc(key or 'N/A')}: {count}</li>" for key, count in digest.get('top_keys', [])
+        )
+        samples = "".join(
+            f"<div class=\"code\">{esc(sample.get('timestamp'))} {esc(sample.get('method'))} "
+            f"{esc(sample.get('ip'))} {esc(sample.get('status_code'))}<br>{esc(sample.get('body', ''))}</div>"
+            for sample in digest.get('samples', [])
+        )
+        distinct = f"<p><strong>Distinct:</strong> {digest['distinct']}</p>" if digest.get('distinct') else ""
+        return f"""
+            <div class="content">
+                <h3>Digest</h3>
+                <p><strong>Matches:</strong> {digest['count']}</p>
+                <p><strong>First:</strong> {esc(digest.get('first'))} <strong>Last:</strong> {esc(digest.get('last'))}</p>
+                {distinct}
+                <ul>{rows}</ul>
+                <h3>Samples</h3>
+                {samples}
+            </div>
+        """
 
 # Initialize email service
 email_service = EmailService()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import csv
+import io
+import json
+from typing import Any, AsyncIterator, Dict
+from urllib.parse import urlencode
+
+CSV_COLUMNS = [
+    "seq", "id", "timestamp", "method", "ip", "status_code", "response_time_ms",
+    "content_type", "query_params", "headers", "body"
+]
+
+async def export_ndjson(records: AsyncIterator[Dict[str, Any]], session_id: str) -> AsyncIterator[str]:
+    """One JSON document per captured request"""
+    async for record in records:
+        yield json.dumps(record) + "\n"
+
+async def export_csv(records: AsyncIterator[Dict[str, Any]], session_id: str) -> AsyncIterator[str]:
+    """Flat CSV with headers and query params as JSON columns"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    async for record in records:
+        headers = record.get("headers", {})
+        writer.writerow([
+            record.get("seq"),
+            record.get("id"),
+            record.get("timestamp"),
+            record.get("method"),
+            record.get("ip"),
+            record.get("status_code"),
+            record.get("response_time_ms"),
+            headers.get("content-type", ""),
+            json.dumps(record.get("query_params", {})),
+            json.dumps(headers),
+            record.get("body", ""),
+        ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def _har_entry(record: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+    headers = record.get("headers", {})
+    query_params = record.get("query_params", {})
+    url = f"http://{headers.get('host', 'localhost')}/hooks/{session_id}"
+    if query_params:
+        url += "?" + urlencode(query_params)
+    body = record.get("body", "")
+
+    request = {
+        "method": record.get("method"),
+        "url": url,
+        "httpVersion": "HTTP/1.1",
+        "cookies": [],
+        "headers": [{"name": k, "value": v} for k, v in headers.items()],
+        "queryString": [{"name": k, "value": v} for k, v in query_params.items()],
+        "headersSize": -1,
+        "bodySize": len(body.encode()),
+    }
+    if body:
+        request["postData"] = {"mimeType": headers.get("content-type", ""), "text": body}
+
+    return {
+        "startedDateTime": record.get("timestamp"),
+        "time": record.get("response_time_ms", 0),
+        "request": request,
+        "response": {
+            "status": record.get("status_code", 0),
+            "statusText": "",
+            "httpVersion": "HTTP/1.1",
+            "cookies": [],
+            "headers": [],
+            "content": {"size": 0, "mimeType": "application/json"},
+            "redirectURL": "",
+            "headersSize": -1,
+            "bodySize": -1,
+        },
+        "cache": {},
+        "timings": {"send": 0, "wait": record.get("response_time_ms", 0), "receive": 0},
+        "comment": f"seq {record.get('seq')}, id {record.get('id')}",
+    }
+
+async def export_har(records: AsyncIterator[Dict[str, Any]], session_id: str) -> AsyncIterator[str]:
+    """HAR 1.2 log, streamed entry by entry"""
+    creator = json.dumps({"name": "PingForge", "version": "1.0"})
+    yield f'{{"log": {{"version": "1.2", "creator": {creator}, "entries": ['
+    separator = ""
+    async for record in records:
+        yield separator + json.dumps(_har_entry(record, session_id))
+        separator = ","
+    yield "]}}"
+
+# format -> (media type, file extension, serializer)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson", export_ndjson),
+    "har": ("application/json", "har", export_har),
+    "csv": ("text/csv", "csv", export_csv),
+}
@@ -0,0 +1,65 @@
+import codecs
+import hashlib
+import os
+from typing import Optional
+
+from fastapi import Request
+
+# Only this much of an accepted body is kept for storage. The size and hash
+# always cover the whole body.
+STORED_BODY_BYTES = int(os.getenv("STORED_BODY_BYTES", str(1024 * 1024)))
+
+class BodyTooLarge(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f"Request body exceeds {limit} bytes")
+        self.limit = limit
+
+class IngestedBody:
+    """The stored head of a request body plus the size and hash of all of it"""
+
+    def __init__(self):
+        self.data = b""
+        self.size = 0
+        self.hasher = hashlib.sha256()
+
+    @property
+    def truncated(self) -> bool:
+        return self.size > len(self.data)
+
+    @property
+    def sha256(self) -> str:
+        return self.hasher.hexdigest()
+
+    def text(self) -> str:
+        """Body as UTF-8, or a placeholder for binary payloads"""
+        if not self.size:
+            return ""
+        try:
+            # A truncated head may end partway through a character
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            return decoder.decode(self.data, final=not self.truncated)
+        except UnicodeDecodeError:
+            return f"<binary data: {self.size} bytes>"
+
+def declared_length(request: Request) -> Optional[int]:
+    value = request.headers.get("content-length", "")
+    return int(value) if value.isdigit() else None
+
+async def read_body(request: Request, max_bytes: int,
+                    keep_bytes: int = STORED_BODY_BYTES) -> IngestedBody:
+    """Read the request body chunk by chunk, raising BodyTooLarge past max_bytes"""
+    length = declared_length(request)
+    if length is not None and length > max_bytes:
+        raise BodyTooLarge(max_bytes)
+
+    body = IngestedBody()
+    head = bytearray()
+    async for chunk in request.stream():
+        body.size += len(chunk)
+        if body.size > max_bytes:
+            raise BodyTooLarge(max_bytes)
+        body.hasher.update(chunk)
+        if len(head) < keep_bytes:
+            head += chunk[:keep_bytes - len(head)]
+    body.data = bytes(head)
+    return body
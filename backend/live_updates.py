@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+from typing import Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+from capture_store import CaptureStore
+
+# Events a viewer may fall behind by before its backlog is dropped
+VIEWER_QUEUE_SIZE = int(os.getenv("VIEWER_QUEUE_SIZE", "256"))
+# A socket that takes longer than this to accept one frame is evicted
+VIEWER_SEND_TIMEOUT_SECONDS = float(os.getenv("VIEWER_SEND_TIMEOUT_SECONDS", "10"))
+
+# Most missed events a reconnecting viewer is replayed before being told to reload
+REPLAY_MAX_EVENTS = int(os.getenv("REPLAY_MAX_EVENTS", "500"))
+
+# Close code for evicted viewers, "try again later"
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Queued in place of a dropped backlog
+RESYNC = object()
+
+def capture_channel(session_id: str) -> str:
+    return f"capture_events:{session_id}"
+
+class Viewer:
+    """One WebSocket with its own bounded outbound queue and writer task"""
+
+    def __init__(self, websocket: WebSocket, session_id: str, queue_size: int = VIEWER_QUEUE_SIZE,
+                 batch_window_ms: int = 0, batch_max: int = 100):
+        self.websocket = websocket
+        self.session_id = session_id
+        # With a window set, events are coalesced into JSON array frames
+        self.batch_window = batch_window_ms / 1000
+        self.batch_max = batch_max
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # Events dropped since the pending resync notice was queued
+        self.dropped = 0
+        self.closed = False
+        self.writer: Optional[asyncio.Task] = None
+        # Live events up to this seq were already replayed from storage
+        self.replayed_through: Optional[int] = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write())
+
+    def offer(self, message: str):
+        """Queue an event without waiting; a full queue is replaced by a resync notice"""
+        if self.closed:
+            return
+        if self.dropped:
+            # The client refetches when the notice arrives, which covers this event
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped = self.queue.qsize() + 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+    async def _write(self):
+        pending = None
+        try:
+            while True:
+                message = pending if pending is not None else await self.queue.get()
+                pending = None
+                if message is RESYNC:
+                    message = json.dumps({"type": "resync", "reason": "overflow", "dropped": self.dropped})
+                    self.dropped = 0
+                elif self._already_replayed(message):
+                    continue
+                elif self.batch_window:
+                    batch, pending = await self._collect_batch(message)
+                    # Events are already serialized, so the frame is just joined
+                    message = "[" + ",".join(batch) + "]"
+                await asyncio.wait_for(self.websocket.send_text(message), VIEWER_SEND_TIMEOUT_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.closed = True
+            print(f"Evicting WebSocket viewer of session {self.session_id}: {e!r}")
+            try:
+                await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+            except Exception:
+                pass
+
+    def _already_replayed(self, message: str) -> bool:
+        if self.replayed_through is None:
+            return False
+        if json.loads(message).get("seq", 0) <= self.replayed_through:
+            return True
+        # Past the replayed range, so later events need no check
+        self.replayed_through = None
+        return False
+
+    async def replay(self, messages: List[str]):
+        """Send missed events straight to the socket before the writer starts"""
+        if self.batch_window:
+            messages = [
+                "[" + ",".join(messages[i:i + self.batch_max]) + "]"
+                for i in range(0, len(messages), self.batch_max)
+            ]
+        for message in messages:
+            await self.websocket.send_text(message)
+
+    async def _collect_batch(self, first: str):
+        """Gather events for one frame until the window closes, it fills up or a resync is due"""
+        batch = [first]
+        deadline = asyncio.get_running_loop().time() + self.batch_window
+        while len(batch) < self.batch_max:
+            timeout = deadline - asyncio.get_running_loop().time()
+            try:
+                message = await asyncio.wait_for(self.queue.get(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                break
+            if message is RESYNC:
+                return batch, message
+            if not self._already_replayed(message):
+                batch.append(message)
+        return batch, None
+
+    async def stop(self):
+        self.closed = True
+        if self.writer is not None:
+            self.writer.cancel()
+            await asyncio.gather(self.writer, return_exceptions=True)
+
+class ConnectionManager:
+    """Live capture fan-out for the WebSockets connected to this worker.
+
+    Captures are published to a per-session Redis channel, so they reach
+    viewers on every worker and instance. Each worker holds one pub/sub
+    connection and is subscribed only to the sessions it has viewers for.
+    """
+
+    def __init__(self):
+        self.active_connections: Dict[str, Set[Viewer]] = {}
+        self.pubsub = None
+        self.listener: Optional[asyncio.Task] = None
+        # Serializes subscribe, unsubscribe and close, so a viewer joining while
+        # the last one leaves never subscribes on a pub/sub that is being closed
+        self.lock = asyncio.Lock()
+
+    async def connect(self, redis_client, websocket: WebSocket, session_id: str,
+                      batch_window_ms: int = 0, batch_max: int = 100,
+                      since: Optional[int] = None) -> Viewer:
+        viewer = Viewer(websocket, session_id, batch_window_ms=batch_window_ms, batch_max=batch_max)
+        async with self.lock:
+            connections = self.active_connections.setdefault(session_id, set())
+            if not connections:
+                try:
+                    # Subscribe before accepting so the viewer misses nothing
+                    await self._subscribe(redis_client, session_id)
+                except Exception:
+                    del self.active_connections[session_id]
+                    raise
+            # Live events queue up while the socket is accepted and missed ones are replayed
+            connections.add(viewer)
+        try:
+            await websocket.accept()
+            if since is not None:
+                await self._replay(redis_client, viewer, since)
+        except Exception:
+            await self.disconnect(viewer)
+            raise
+        viewer.start()
+        return viewer
+
+    async def _replay(self, redis_client, viewer: Viewer, since: int):
+        records = await CaptureStore(redis_client).requests_since(viewer.session_id, since, REPLAY_MAX_EVENTS)
+        if records is None:
+            await viewer.websocket.send_text(json.dumps({"type": "resync", "reason": "gap_too_large"}))
+            return
+        viewer.replayed_through = records[-1]["seq"] if records else since
+        await viewer.replay([json.dumps(record) for record in records])
+
+    async def disconnect(self, viewer: Viewer):
+        await viewer.stop()
+        async with self.lock:
+            connections = self.active_connections.get(viewer.session_id)
+            if connections is None:
+                return
+            connections.discard(viewer)
+            if connections:
+                return
+            del self.active_connections[viewer.session_id]
+            if not self.active_connections:
+                # No viewers left on this worker, so drop the pub/sub connection
+                await self._close()
+            elif self.pubsub is not None:
+                await self.pubsub.unsubscribe(capture_channel(viewer.session_id))
+
+    async def publish(self, redis_client, session_id: str, message: str):
+        """Send a serialized event to the session's viewers on every worker"""
+        await redis_client.publish(capture_channel(session_id), message)
+
+    def send_to_session(self, session_id: str, message: str):
+        """Queue an event for this worker's viewers of a session without waiting on any socket"""
+        for viewer in self.active_connections.get(session_id, ()):
+            viewer.offer(message)
+
+    async def _subscribe(self, redis_client, session_id: str):
+        if self.pubsub is None:
+            self.pubsub = redis_client.pubsub()
+        await self.pubsub.subscribe(capture_channel(session_id))
+        # The listener exits if its connection drops for good; start a fresh one
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self._listen(self.pubsub))
+
+    async def _listen(self, pubsub):
+        prefix = capture_channel("")
+        while True:
+            try:
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    channel = message["channel"]
+                    data = message["data"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    if isinstance(data, bytes):
+                        data = data.decode()
+                    self.send_to_session(channel[len(prefix):], data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The pub/sub connection resubscribes when it reconnects;
+                # events published in between are lost
+                print(f"Capture fan-out listener error: {e}")
+                await asyncio.sleep(1)
+                if not pubsub.subscribed:
+                    return
+
+    async def close(self):
+        async with self.lock:
+            await self._close()
+
+    async def _close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
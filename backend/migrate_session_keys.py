@@ -0,0 +1,28 @@
+"""One-off move of capture keys to their hash-tagged names.
+
+Sessions captured to before capture keys were hash-tagged (see
+session_keys.py) keep their requests, indexes and bodies under the old
+names, where the API no longer looks. Run once while no API worker is
+capturing:
+
+    python migrate_session_keys.py
+"""
+import asyncio
+
+from notification_worker import create_redis_client
+from session_keys import migrate_session_keys
+
+async def main():
+    redis_client = create_redis_client()
+    sessions = moved = 0
+    try:
+        async for key in redis_client.scan_iter(match="session:*", count=1000):
+            session_id = key.decode()[len("session:"):]
+            moved += await migrate_session_keys(redis_client, session_id)
+            sessions += 1
+        print(f"Moved {moved} keys across {sessions} sessions")
+    finally:
+        await redis_client.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
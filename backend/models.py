@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, HttpUrl
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 from enum import Enum
@@ -19,6 +19,7 @@ class User(BaseModel):
     full_name: str
     created_at: datetime
     is_active: bool = True
+    plan: str = "free"
 
 class Token(BaseModel):
     access_token: str
@@ -100,6 +101,12 @@ class SessionFilters(BaseModel):
     allowed_methods: Optional[List[str]] = None
     blocked_ips: Optional[List[str]] = None
 
+class SessionRetention(BaseModel):
+    max_requests: int
+    max_bytes: int
+    # Largest body a single capture may send; bigger ones are rejected with 413
+    max_body_bytes: int = 10 * 1024 * 1024
+
 class Session(BaseModel):
     id: str
     name: str
@@ -108,9 +115,12 @@ class Session(BaseModel):
     created_at: str
     owner_id: str
     request_count: int = 0
+    last_request: Optional[str] = None
     is_active: bool = True
     lifespan: Optional[SessionLifespan] = SessionLifespan.TWENTY_FOUR_HOURS
     filters: Optional[Dict] = None
+    retention: Optional[SessionRetention] = None
+    evicted_count: int = 0
 
 class NotificationCondition(str, Enum):
     STATUS_CODE = "status_code"
@@ -130,8 +140,11 @@ class NotificationRule(BaseModel):
     operator: str  # "equals", "contains", "greater_than", "less_than", "in_range"
     value: Any  # The value to compare against
     email_recipients: List[str]
+    webhook_urls: List[HttpUrl] = []  # Also POST each alert as JSON to these URLs
     is_active: bool = True
     cooldown_minutes: int = 5  # Prevent spam
+    digest_minutes: Optional[int] = None  # Send one summary per window instead of one alert per match
+    dedup_fields: List[str] = []  # Capture fields that identify repeats of the same alert in a digest
     created_at: str
     last_triggered: Optional[str] = None
 
@@ -142,4 +155,7 @@ class NotificationCreate(BaseModel):
     operator: str
     value: Any
     email_recipients: List[str]
-    cooldown_minutes: int = 5
\ No newline at end of file
+    webhook_urls: List[HttpUrl] = []
+    cooldown_minutes: int = 5
+    digest_minutes: Optional[int] = None
+    dedup_fields: List[str] = []
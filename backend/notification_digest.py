@@ -0,0 +1,157 @@
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from models import NotificationRule
+
+# Example matches kept per digest, one per distinct dedup key
+DIGEST_SAMPLES = 3
+# Distinct dedup keys counted per digest; further keys only add to the total
+MAX_DIGEST_GROUPS = 100
+DIGEST_SAMPLE_BODY_CHARS = 500
+DIGEST_FLUSH_INTERVAL_SECONDS = 5
+
+# Sorted set of open digests, scored by when they are due to be sent
+DIGESTS_DUE_KEY = "notification_digests_due"
+
+# Adds one match to a rule's open digest. The first match of a window opens
+# the digest and schedules it; samples are only kept for new dedup keys.
+#
+# KEYS[1] digest hash (count, first, last), KEYS[2] dedup key counts,
+# KEYS[3] sample list, KEYS[4] due digests
+# ARGV[1] match timestamp, ARGV[2] dedup key ('' to treat every match as new),
+# ARGV[3] sample, ARGV[4] max samples, ARGV[5] due time (epoch seconds),
+# ARGV[6] due member, ARGV[7] max dedup keys, ARGV[8] key TTL (ms)
+DIGEST_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], 'count', 1)
+if count == 1 then
+    redis.call('HSET', KEYS[1], 'first', ARGV[1])
+    redis.call('ZADD', KEYS[4], ARGV[5], ARGV[6])
+end
+redis.call('HSET', KEYS[1], 'last', ARGV[1])
+
+local new_key = true
+if ARGV[2] ~= '' then
+    if redis.call('HEXISTS', KEYS[2], ARGV[2]) == 1 or redis.call('HLEN', KEYS[2]) < tonumber(ARGV[7]) then
+        new_key = redis.call('HINCRBY', KEYS[2], ARGV[2], 1) == 1
+    else
+        new_key = false
+    end
+end
+if new_key and redis.call('LLEN', KEYS[3]) < tonumber(ARGV[4]) then
+    redis.call('RPUSH', KEYS[3], ARGV[3])
+end
+
+for i = 1, 3 do
+    redis.call('PEXPIRE', KEYS[i], ARGV[8])
+end
+return count
+"""
+
+# Claims a due digest and returns its contents, or nil if another worker
+# already took it.
+#
+# KEYS[1..3] as above, KEYS[4] due digests; ARGV[1] due member
+TAKE_SCRIPT = """
+if redis.call('ZREM', KEYS[4], ARGV[1]) == 0 then
+    return false
+end
+local digest = {
+    redis.call('HGETALL', KEYS[1]),
+    redis.call('HGETALL', KEYS[2]),
+    redis.call('LRANGE', KEYS[3], 0, -1)
+}
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+return digest
+"""
+
+def digest_keys(session_id: str, rule_id: str) -> List[str]:
+    prefix = f"notification_digest:{session_id}:{rule_id}"
+    return [prefix, f"{prefix}:keys", f"{prefix}:samples", DIGESTS_DUE_KEY]
+
+def dedup_key(rule: NotificationRule, webhook_data: Dict[str, Any]) -> str:
+    return "|".join(str(webhook_data.get(field, "")) for field in rule.dedup_fields)
+
+def _pairs(flat: List[bytes]) -> Dict[str, bytes]:
+    return {flat[i].decode(): flat[i + 1] for i in range(0, len(flat), 2)}
+
+class NotificationDigest:
+    """Matches of one rule over one digest window"""
+
+    def __init__(self, session_id: str, rule_id: str, count: int, first: Optional[str],
+                 last: Optional[str], keys: Dict[str, int], samples: List[Dict[str, Any]]):
+        self.session_id = session_id
+        self.rule_id = rule_id
+        self.count = count
+        self.first = first
+        self.last = last
+        self.keys = keys
+        self.samples = samples
+
+    def summary(self) -> Dict[str, Any]:
+        top_keys = sorted(self.keys.items(), key=lambda item: item[1], reverse=True)[:10]
+        return {
+            "count": self.count,
+            "first": self.first,
+            "last": self.last,
+            "distinct": len(self.keys) or None,
+            "top_keys": top_keys,
+            "samples": self.samples,
+        }
+
+class NotificationDigests:
+    """Redis-backed digests for rules in digest mode"""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._add = redis_client.register_script(DIGEST_SCRIPT)
+        self._take = redis_client.register_script(TAKE_SCRIPT)
+
+    async def add(self, rule: NotificationRule, webhook_data: Dict[str, Any]):
+        window_seconds = rule.digest_minutes * 60
+        sample = {
+            "timestamp": webhook_data.get("timestamp"),
+            "method": webhook_data.get("method"),
+            "ip": webhook_data.get("ip"),
+            "status_code": webhook_data.get("status_code"),
+            "body": (webhook_data.get("body") or "")[:DIGEST_SAMPLE_BODY_CHARS],
+        }
+        await self._add(
+            keys=digest_keys(rule.session_id, rule.id),
+            args=[
+                webhook_data.get("timestamp") or "",
+                dedup_key(rule, webhook_data) if rule.dedup_fields else "",
+                json.dumps(sample),
+                DIGEST_SAMPLES,
+                time.time() + window_seconds,
+                f"{rule.session_id}:{rule.id}",
+                MAX_DIGEST_GROUPS,
+                # Outlive the window comfortably in case flushing falls behind
+                (window_seconds * 2 + 3600) * 1000,
+            ],
+        )
+
+    async def take_due(self, now: Optional[float] = None, limit: int = 100) -> List[NotificationDigest]:
+        """Claim digests whose window has closed"""
+        now = time.time() if now is None else now
+        members = await self.redis.zrangebyscore(DIGESTS_DUE_KEY, "-inf", now, start=0, num=limit)
+        digests = []
+        for member in members:
+            session_id, _, rule_id = member.decode().rpartition(":")
+            taken = await self._take(keys=digest_keys(session_id, rule_id), args=[member])
+            if not taken:
+                continue
+            meta, keys, samples = taken
+            meta = _pairs(meta)
+            if not meta:
+                # Expired before it was flushed
+                continue
+            digests.append(NotificationDigest(
+                session_id, rule_id,
+                count=int(meta.get("count", 0)),
+                first=meta["first"].decode() if "first" in meta else None,
+                last=meta["last"].decode() if "last" in meta else None,
+                keys={key: int(count) for key, count in _pairs(keys).items()},
+                samples=[json.loads(sample) for sample in samples],
+            ))
+        return digests
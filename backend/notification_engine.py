@@ -1,100 +1,162 @@
+import asyncio
 import json
-import re
-from datetime import datetime, timedelta
-from typing import Dict, Any, List
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Sequence
 from models import NotificationRule, NotificationCondition
+from capture_log import CaptureEvent
+from capture_store import CaptureStore
+from session_keys import session_key
+from notification_sinks import NotificationSink, default_sinks
+from notification_digest import DIGEST_FLUSH_INTERVAL_SECONDS, NotificationDigest, NotificationDigests
+from notification_rules import CONDITION_FIELDS, CompiledRuleSet, rule_sets
+
+# Sent notifications remembered per session
+NOTIFICATION_LOG_SIZE = 100
+
+def cooldown_key(rule: NotificationRule) -> str:
+    return f"notification_cooldown:{rule.session_id}:{rule.id}"
 
 class NotificationEngine:
-    def __init__(self, redis_client, email_service):
+    def __init__(self, redis_client, email_service, sinks: Optional[List[NotificationSink]] = None):
         self.redis = redis_client
         self.email_service = email_service
+        # Channels every alert goes out on; email only unless the caller adds more
+        self.sinks = sinks if sinks is not None else default_sinks(email_service)
+        self.digests = NotificationDigests(redis_client)
     
-    def evaluate_conditions(self, session_id: str, webhook_data: Dict[Any, Any]):
-        """Evaluate all notification rules for a session"""
-        rules = self._get_session_rules(session_id)
+    async def evaluate_capture(self, event: CaptureEvent):
+        """Evaluate rules against a capture read back from the capture log.
+
+        Log events only carry scalar fields. The stored request is read by
+        seq when a rule needs its headers, body or query, or once a rule has
+        matched so the alert can show them; events whose request was already
+        evicted are skipped. Filtered requests are never stored; their events
+        name the header and query rules they matched at capture time.
+        """
+        rule_set = await rule_sets.get(self.redis, event.session_id)
+        if not rule_set.rules:
+            return
+        record = event.record
+        if event.seq is not None and (rule_set.needs_record or rule_set.matching(self._webhook_data(event, record))):
+            stored = await CaptureStore(self.redis).get_request(event.session_id, event.seq)
+            if stored is not None:
+                record = stored
+            elif rule_set.needs_record:
+                return
+        body = record.get("body", "")
+        if record.get("body_offloaded") and rule_set.needs_body:
+            # Rules see the stored body, not the preview
+            blob = await self.redis.get(session_key("request_body", event.session_id, record["id"]))
+            if blob:
+                body = blob.partition(b"\n")[2].decode("utf-8", errors="ignore")
+        await self.evaluate_conditions(event.session_id, self._webhook_data(event, record, body), rule_set,
+                                       event.matched_rule_ids)
+
+    def _webhook_data(self, event: CaptureEvent, record: Dict[str, Any],
+                      body: Optional[str] = None) -> Dict[Any, Any]:
+        """The capture fields rules and alerts read"""
+        if body is None:
+            body = record.get("body", "")
+        headers = record.get("headers", {})
+        return {
+            "method": record.get("method"),
+            "ip": record.get("ip"),
+            "headers": headers,
+            "body": body,
+            "query_params": record.get("query_params", {}),
+            "status_code": record.get("status_code"),
+            "response_time_ms": record.get("response_time_ms", 0),
+            "timestamp": record.get("timestamp"),
+            "session_id": event.session_id,
+            "error_message": event.error_message,
+            "user_agent": headers.get("user-agent", ""),
+            "content_type": headers.get("content-type", ""),
+            "content_length": record.get("body_size", len(body.encode()))
+        }
+
+    async def evaluate_conditions(self, session_id: str, webhook_data: Dict[Any, Any],
+                                  rule_set: Optional[CompiledRuleSet] = None,
+                                  matched_rule_ids: Sequence[str] = ()):
+        """Evaluate all notification rules for a session.
+
+        matched_rule_ids are rules already found to match at capture time.
+        """
+        if rule_set is None:
+            rule_set = await rule_sets.get(self.redis, session_id)
+        
+        matches = rule_set.matching(webhook_data)
+        if matched_rule_ids:
+            matched = {rule.id for rule in matches} | set(matched_rule_ids)
+            matches = [rule for rule in rule_set.rules if rule.id in matched]
+        for rule in matches:
+            await self._notify(rule, webhook_data)
         
-        for rule in rules:
-            if not rule.is_active:
+        rate = None
+        for rule in rule_set.rate_rules:
+            if rate is None:
+                rate = await CaptureStore(self.redis).request_rate(session_id)
+            if not self._exceeds_rate_limit(rule, rate):
                 continue
-                
-            # Check cooldown
-            if self._is_in_cooldown(rule):
+            await self._notify(rule, {**webhook_data, "requests_per_minute": round(rate, 1)})
+    
+    async def _notify(self, rule: NotificationRule, webhook_data: Dict[Any, Any]):
+        """Alert on a match now, or add it to the rule's digest"""
+        if rule.digest_minutes:
+            await self.digests.add(rule, webhook_data)
+            return
+        # Claiming the cooldown decides which capture gets to notify
+        if not await self._claim_cooldown(rule):
+            return
+        await self._trigger_notification(rule, webhook_data)
+    
+    async def flush_digests(self):
+        """Send every digest whose window has closed"""
+        for digest in await self.digests.take_due():
+            rule_set = await rule_sets.get(self.redis, digest.session_id)
+            rule = next((r for r in rule_set.rules if r.id == digest.rule_id), None)
+            if rule is None:
+                # Deleted or paused while the digest was open
                 continue
-                
-            # Evaluate condition
-            if self._evaluate_condition(rule, webhook_data):
-                self._trigger_notification(rule, webhook_data)
+            await self._send_digest(rule, digest)
     
-    def _evaluate_condition(self, rule: NotificationRule, 
-                          webhook_data: Dict[Any, Any]) -> bool:
-        """Evaluate a single notification condition"""
-        condition = rule.condition
-        operator = rule.operator
-        value = rule.value
-        
-        if condition == NotificationCondition.STATUS_CODE:
-            actual_value = webhook_data.get('status_code')
-            return self._compare_values(actual_value, operator, value)
-            
-        elif condition == NotificationCondition.METHOD:
-            actual_value = webhook_data.get('method')
-            return self._compare_values(actual_value, operator, value)
-            
-        elif condition == NotificationCondition.IP_ADDRESS:
-            actual_value = webhook_data.get('ip')
-            return self._compare_values(actual_value, operator, value)
-            
-        elif condition == NotificationCondition.HEADER_CONTAINS:
-            headers = webhook_data.get('headers', {})
-            if operator == "contains":
-                return any(value.lower() in str(v).lower() for v in headers.values())
-            elif operator == "key_exists":
-                return value in headers
-                
-        elif condition == NotificationCondition.BODY_CONTAINS:
-            body = webhook_data.get('body', '')
-            if operator == "contains":
-                return value.lower() in body.lower()
-            elif operator == "regex":
-                return bool(re.search(value, body))
-                
-        elif condition == NotificationCondition.QUERY_PARAM:
-            query_params = webhook_data.get('query_params', {})
-            if operator == "exists":
-                return value in query_params
-            elif operator == "equals":
-                return query_params.get(value) == rule.value
-                
-        elif condition == NotificationCondition.RESPONSE_TIME:
-            response_time = webhook_data.get('response_time_ms', 0)
-            return self._compare_values(response_time, operator, value)
-            
-        elif condition == NotificationCondition.RATE_LIMIT:
-            # Check if requests exceed rate limit
-            current_time = datetime.now()
-            time_window = timedelta(minutes=int(value))
-            count = self._count_recent_requests(rule.session_id, current_time, time_window)
-            return count > int(rule.value)
-            
-        return False
+    async def run_digest_flusher(self, interval: float = DIGEST_FLUSH_INTERVAL_SECONDS):
+        """Flush due digests until cancelled"""
+        while True:
+            try:
+                await self.flush_digests()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Digest flush error: {e}")
+            await asyncio.sleep(interval)
     
-    def _compare_values(self, actual, operator: str, expected):
-        """Compare values based on operator"""
-        if operator == "equals":
-            return actual == expected
-        elif operator == "not_equals":
-            return actual != expected
-        elif operator == "greater_than":
-            return float(actual) > float(expected)
-        elif operator == "less_than":
-            return float(actual) < float(expected)
-        elif operator == "contains":
-            return str(expected).lower() in str(actual).lower()
-        elif operator == "in_list":
-            return actual in expected
-        return False
+    async def _send_digest(self, rule: NotificationRule, digest: NotificationDigest):
+        """One email summarising a digest window"""
+        summary = digest.summary()
+        subject = f"Webhook Alert Digest: {rule.name} ({digest.count} matches)"
+        condition_info = {
+            'condition_name': rule.name,
+            'triggered_value': f"{digest.count} matches from {digest.first} to {digest.last}",
+            'digest': summary,
+        }
+        # The latest sample stands in for the capture details
+        webhook_data = {**(digest.samples[-1] if digest.samples else {}), "session_id": digest.session_id}
+        success = await self._deliver(rule, subject, webhook_data, condition_info)
+        if success:
+            await self.redis.hset(f"notification_triggers:{rule.session_id}", rule.id,
+                                  datetime.now().isoformat())
+            await self._log_notification(rule.session_id, rule.id, webhook_data, digest.count)
+        else:
+            print(f"Failed to send digest for rule {rule.id} ({digest.count} matches)")
+    
+    def _exceeds_rate_limit(self, rule: NotificationRule, rate: float) -> bool:
+        """Check if the session's requests per minute exceed the rule's limit"""
+        try:
+            return rate > float(rule.value)
+        except (TypeError, ValueError):
+            return False
     
-    def _trigger_notification(self, rule: NotificationRule, webhook_data: Dict[Any, Any]):
+    async def _trigger_notification(self, rule: NotificationRule, webhook_data: Dict[Any, Any]):
         """Trigger notification email"""
         subject = f"Webhook Alert: {rule.name}"
         condition_info = {
@@ -102,48 +164,64 @@ class NotificationEngine:
             'triggered_value': self._get_triggered_value(rule, webhook_data)
         }
         
-        success = self.email_service.send_notification(
-            rule.email_recipients,
-            subject,
-            webhook_data,
-            condition_info
-        )
+        success = await self._deliver(rule, subject, webhook_data, condition_info)
         
         if success:
-            # Update last triggered time
-            rule.last_triggered = datetime.now().isoformat()
-            self._save_rule(rule)
+            # Record when it fired without rewriting the rule list
+            await self.redis.hset(f"notification_triggers:{rule.session_id}", rule.id,
+                                  datetime.now().isoformat())
             
             # Log notification
-            self._log_notification(rule.session_id, rule.id, webhook_data)
+            await self._log_notification(rule.session_id, rule.id, webhook_data)
+        else:
+            # Let the next matching capture try again
+            await self.redis.delete(cooldown_key(rule))
     
-    def _is_in_cooldown(self, rule: NotificationRule) -> bool:
-        """Check if rule is in cooldown period"""
-        if not rule.last_triggered:
-            return False
-            
-        last_triggered = datetime.fromisoformat(rule.last_triggered)
-        cooldown_period = timedelta(minutes=rule.cooldown_minutes)
-        return datetime.now() - last_triggered < cooldown_period
+    async def _deliver(self, rule: NotificationRule, subject: str, webhook_data: Dict[Any, Any],
+                       condition_info: Dict[str, Any]) -> bool:
+        """Send an alert on every sink the rule has a destination for; True if any delivered it"""
+        results = await asyncio.gather(
+            *(sink.send(rule, subject, webhook_data, condition_info) for sink in self.sinks),
+            return_exceptions=True
+        )
+        for sink, result in zip(self.sinks, results):
+            if isinstance(result, Exception):
+                print(f"Notification sink {sink.name} failed for rule {rule.id}: {result}")
+        return any(result is True for result in results)
     
-    def _get_session_rules(self, session_id: str) -> List[NotificationRule]:
-        """Get all notification rules for a session"""
-        rules_data = self.redis.get(f"notification_rules:{session_id}")
-        if not rules_data:
-            return []
-            
-        rules = json.loads(rules_data)
-        return [NotificationRule(**rule) for rule in rules]
+    def _get_triggered_value(self, rule: NotificationRule, webhook_data: Dict[Any, Any]) -> Any:
+        """The capture value a rule fired on, for the alert email"""
+        if rule.condition == NotificationCondition.RATE_LIMIT:
+            return f"{webhook_data.get('requests_per_minute')} requests/min"
+        field = CONDITION_FIELDS.get(rule.condition)
+        if field is None:
+            return rule.value
+        value = webhook_data.get(field)
+        if field == "body":
+            return (value or "")[:200]
+        return value
     
-    def _save_rule(self, rule: NotificationRule):
-        """Save updated rule to Redis"""
-        rules = self._get_session_rules(rule.session_id)
-        # Update the rule in the list
-        for i, r in enumerate(rules):
-            if r.id == rule.id:
-                rules[i] = rule
-                break
-        
-        # Save back to Redis
-        self.redis.set(f"notification_rules:{rule.session_id}", 
-                      json.dumps([r.dict() for r in rules]))
\ No newline at end of file
+    async def _claim_cooldown(self, rule: NotificationRule) -> bool:
+        """Atomically start a rule's cooldown; False if it is already cooling down"""
+        if rule.cooldown_minutes <= 0:
+            return True
+        return bool(await self.redis.set(
+            cooldown_key(rule), datetime.now().isoformat(), nx=True, px=rule.cooldown_minutes * 60 * 1000
+        ))
+    
+    async def _log_notification(self, session_id: str, rule_id: str, webhook_data: Dict[Any, Any],
+                                matches: int = 1):
+        """Keep a short history of sent notifications per session"""
+        entry = json.dumps({
+            "matches": matches,
+            "rule_id": rule_id,
+            "sent_at": datetime.now().isoformat(),
+            "method": webhook_data.get("method"),
+            "ip": webhook_data.get("ip"),
+            "status_code": webhook_data.get("status_code"),
+            "timestamp": webhook_data.get("timestamp")
+        })
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lpush(f"notification_log:{session_id}", entry)
+        pipe.ltrim(f"notification_log:{session_id}", 0, NOTIFICATION_LOG_SIZE - 1)
+        await pipe.execute()
@@ -0,0 +1,228 @@
+import json
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from cache import LRUTTLCache, invalidation_bus
+from keyword_matcher import KeywordMatcher
+from models import NotificationCondition, NotificationRule
+
+RULE_CACHE_SIZE = int(os.getenv("RULE_CACHE_SIZE", "10000"))
+RULE_CACHE_TTL_SECONDS = float(os.getenv("RULE_CACHE_TTL_SECONDS", "60"))
+
+Predicate = Callable[[Dict[str, Any]], bool]
+
+# webhook_data field each condition reads
+CONDITION_FIELDS = {
+    NotificationCondition.STATUS_CODE: "status_code",
+    NotificationCondition.METHOD: "method",
+    NotificationCondition.IP_ADDRESS: "ip",
+    NotificationCondition.HEADER_CONTAINS: "headers",
+    NotificationCondition.BODY_CONTAINS: "body",
+    NotificationCondition.QUERY_PARAM: "query_params",
+    NotificationCondition.RESPONSE_TIME: "response_time_ms",
+}
+
+# Fields read from the stored request rather than the capture log event
+RECORD_FIELDS = ("headers", "body", "query_params")
+
+# Fields of a filtered request, which is never stored, that are checked on the
+# capture path before its log event is written; they're known before the body
+FILTERED_REQUEST_FIELDS = ("headers", "query_params")
+
+# "contains" rules on these fields are matched together by one keyword automaton
+KEYWORD_FIELDS = {
+    NotificationCondition.HEADER_CONTAINS: "headers",
+    NotificationCondition.BODY_CONTAINS: "body",
+}
+
+# Joins header values for a single scan; a keyword can't span two values
+HEADER_SEPARATOR = "\x00"
+
+# Conditions whose "equals" rules are looked up by value instead of tested one by one
+INDEXED_CONDITIONS = (
+    NotificationCondition.STATUS_CODE, NotificationCondition.METHOD, NotificationCondition.IP_ADDRESS
+)
+
+def _never(webhook_data: Dict[str, Any]) -> bool:
+    return False
+
+def _compare_predicate(field: str, operator: str, expected: Any) -> Predicate:
+    """Prebuilt equivalent of comparing webhook_data[field] against expected"""
+    if operator == "equals":
+        return lambda data: data.get(field) == expected
+    if operator == "not_equals":
+        return lambda data: data.get(field) != expected
+    if operator in ("greater_than", "less_than"):
+        try:
+            bound = float(expected)
+        except (TypeError, ValueError):
+            return _never
+        def compare(data):
+            try:
+                actual = float(data.get(field))
+            except (TypeError, ValueError):
+                return False
+            return actual > bound if operator == "greater_than" else actual < bound
+        return compare
+    if operator == "contains":
+        needle = str(expected).lower()
+        return lambda data: needle in str(data.get(field)).lower()
+    if operator == "in_list":
+        try:
+            options = frozenset(expected)
+        except TypeError:
+            return lambda data: data.get(field) in expected
+        return lambda data: data.get(field) in options
+    return _never
+
+def compile_predicate(rule: NotificationRule) -> Predicate:
+    """Build a rule's test once, so captures skip operator dispatch and regex compilation"""
+    condition, operator, value = rule.condition, rule.operator, rule.value
+
+    if condition == NotificationCondition.HEADER_CONTAINS:
+        if operator == "contains":
+            needle = str(value).lower()
+            return lambda data: any(needle in str(v).lower() for v in data.get("headers", {}).values())
+        if operator == "key_exists":
+            return lambda data: value in data.get("headers", {})
+        return _never
+
+    if condition == NotificationCondition.BODY_CONTAINS:
+        if operator == "contains":
+            needle = str(value).lower()
+            return lambda data: needle in (data.get("body") or "").lower()
+        if operator == "regex":
+            try:
+                pattern = re.compile(value)
+            except (re.error, TypeError):
+                return _never
+            return lambda data: pattern.search(data.get("body") or "") is not None
+        return _never
+
+    if condition == NotificationCondition.QUERY_PARAM:
+        if operator == "exists":
+            return lambda data: value in data.get("query_params", {})
+        if operator == "equals":
+            return lambda data: data.get("query_params", {}).get(value) == value
+        return _never
+
+    field = CONDITION_FIELDS.get(condition)
+    if field is None:
+        return _never
+    return _compare_predicate(field, operator, value)
+
+class CompiledRuleSet:
+    """A session's active rules, ready to run against captures.
+
+    "equals" rules on status code, method and IP are found by value lookup,
+    and "contains" rules on the body and headers by one keyword scan per
+    field. Every other rule is grouped by the field it reads, so fields no
+    rule reads (the body, usually) are never touched. Rate limit rules
+    depend on counters outside the capture and are left to the engine.
+    """
+
+    def __init__(self, rules: List[NotificationRule]):
+        self.rules = [rule for rule in rules if rule.is_active]
+        self.by_value: Dict[str, Dict[Any, List[Tuple[int, NotificationRule]]]] = {}
+        self.by_field: Dict[str, List[Tuple[int, NotificationRule, Predicate]]] = {}
+        self.rate_rules: List[NotificationRule] = []
+        keyword_rules: Dict[str, List[Tuple[int, NotificationRule]]] = {}
+
+        for position, rule in enumerate(self.rules):
+            if rule.condition == NotificationCondition.RATE_LIMIT:
+                self.rate_rules.append(rule)
+                continue
+            field = CONDITION_FIELDS.get(rule.condition)
+            if field is None:
+                continue
+            if rule.condition in KEYWORD_FIELDS and rule.operator == "contains":
+                keyword_rules.setdefault(field, []).append((position, rule))
+                continue
+            if rule.condition in INDEXED_CONDITIONS and rule.operator == "equals":
+                try:
+                    self.by_value.setdefault(field, {}).setdefault(rule.value, []).append((position, rule))
+                    continue
+                except TypeError:
+                    # Unhashable values can't be indexed; test them like any other rule
+                    pass
+            self.by_field.setdefault(field, []).append((position, rule, compile_predicate(rule)))
+
+        # field -> (matcher, rules in keyword order)
+        self.keywords: Dict[str, Tuple[KeywordMatcher, List[Tuple[int, NotificationRule]]]] = {
+            field: (KeywordMatcher([str(rule.value).lower() for _, rule in rules]), rules)
+            for field, rules in keyword_rules.items()
+        }
+
+    @property
+    def needs_body(self) -> bool:
+        return "body" in self.by_field or "body" in self.keywords
+
+    @property
+    def needs_record(self) -> bool:
+        """Whether any rule reads a field only the stored request has, not its capture log event"""
+        return any(field in self.by_field or field in self.keywords for field in RECORD_FIELDS)
+
+    def _keyword_text(self, field: str, webhook_data: Dict[str, Any]) -> str:
+        if field == "headers":
+            return HEADER_SEPARATOR.join(str(v) for v in webhook_data.get("headers", {}).values()).lower()
+        return (webhook_data.get("body") or "").lower()
+
+    def matching(self, webhook_data: Dict[str, Any],
+                 fields: Optional[Sequence[str]] = None) -> List[NotificationRule]:
+        """Rules whose condition holds for a capture, in rule order.
+
+        fields limits the check to rules on those fields.
+        """
+        matches = []
+        for field, index in self.by_value.items():
+            if fields is not None and field not in fields:
+                continue
+            try:
+                matches.extend(index.get(webhook_data.get(field), ()))
+            except TypeError:
+                pass
+        for field, (matcher, rules) in self.keywords.items():
+            if fields is not None and field not in fields:
+                continue
+            # Each field is lower-cased and scanned once for all its keywords
+            for index in matcher.find(self._keyword_text(field, webhook_data)):
+                matches.append(rules[index])
+        for field, candidates in self.by_field.items():
+            if fields is not None and field not in fields:
+                continue
+            for position, rule, predicate in candidates:
+                if predicate(webhook_data):
+                    matches.append((position, rule))
+        matches.sort(key=lambda match: match[0])
+        return [rule for _, rule in matches]
+
+class RuleSetCache:
+    """Compiled notification rules per session, shared by every evaluation on this worker"""
+
+    namespace = "rules"
+
+    def __init__(self, max_size: int = RULE_CACHE_SIZE, ttl_seconds: float = RULE_CACHE_TTL_SECONDS):
+        self.entries = LRUTTLCache(max_size, ttl_seconds)
+        invalidation_bus.register(self.namespace, self.entries.invalidate, self.entries.clear)
+
+    async def get(self, redis_client, session_id: str) -> CompiledRuleSet:
+        cached = self.entries.get(session_id)
+        if cached is not None:
+            return cached
+
+        rules_data = await redis_client.get(f"notification_rules:{session_id}")
+        rules = [NotificationRule(**rule) for rule in json.loads(rules_data)] if rules_data else []
+        # Sessions without rules are cached too, so their captures cost one lookup
+        compiled = CompiledRuleSet(rules)
+        self.entries.set(session_id, compiled)
+        return compiled
+
+    async def invalidate(self, redis_client, session_id: str):
+        """Drop a session's compiled rules from every worker"""
+        await invalidation_bus.publish(redis_client, self.namespace, session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.entries.stats()
+
+rule_sets = RuleSetCache()
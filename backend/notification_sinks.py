@@ -0,0 +1,264 @@
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from models import NotificationRule
+
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_SINK_TIMEOUT_SECONDS", "10"))
+# Requests in flight to one destination host at a time
+WEBHOOK_CONCURRENCY_PER_HOST = int(os.getenv("WEBHOOK_SINK_CONCURRENCY_PER_HOST", "8"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_SINK_MAX_CONNECTIONS", "100"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_SINK_MAX_ATTEMPTS", "3"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_SINK_RETRY_BASE_SECONDS", "0.5"))
+# Consecutive failures that open a host's circuit, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("WEBHOOK_SINK_CIRCUIT_FAILURES", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("WEBHOOK_SINK_CIRCUIT_OPEN_SECONDS", "30"))
+
+# Destination hosts whose concurrency limit and circuit are remembered
+WEBHOOK_MAX_HOSTS = int(os.getenv("WEBHOOK_SINK_MAX_HOSTS", "1024"))
+
+WEBHOOK_BODY_CHARS = 2000
+
+def _is_internal_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%")[0])
+    return not ip.is_global or ip.is_multicast
+
+def _is_ip_literal(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+async def resolve_host(host: str) -> List[str]:
+    """Addresses a host resolves to; IP literals resolve to themselves"""
+    if _is_ip_literal(host):
+        return [host]
+    infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    return [info[4][0] for info in infos]
+
+async def resolve_webhook_destination(url: str) -> Tuple[Optional[str], Optional[str]]:
+    """The checked address to connect to for url, or None and why alerts may not go there.
+
+    Rejects hosts that are, or resolve to, loopback, private, link-local or
+    otherwise non-public addresses, so rules can't be used to reach
+    internal services.
+    """
+    host = urlsplit(url).hostname
+    if not host:
+        return None, "URL has no host"
+    if host == "localhost" or host.endswith((".localhost", ".local", ".internal")):
+        return None, f"{host} is not a public host"
+    try:
+        addresses = await resolve_host(host)
+    except socket.gaierror:
+        addresses = []
+    if not addresses:
+        return None, f"{host} does not resolve"
+    if any(_is_internal_address(address) for address in addresses):
+        return None, f"{host} is not a public address"
+    return addresses[0], None
+
+async def check_webhook_destination(url: str) -> Optional[str]:
+    """Why alerts may not be sent to url, or None if it is a public destination"""
+    return (await resolve_webhook_destination(url))[1]
+
+def create_http_client() -> httpx.AsyncClient:
+    """The shared pooled client outbound notifications go through"""
+    return httpx.AsyncClient(
+        timeout=WEBHOOK_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=WEBHOOK_MAX_CONNECTIONS, keepalive_expiry=60),
+        headers={"User-Agent": "PingForge-Notifications"},
+    )
+
+class NotificationSink(ABC):
+    """A channel alerts are delivered through.
+
+    send returns True if the alert was delivered, False if delivery failed,
+    and None if the rule has no destination on this channel.
+    """
+
+    name = "sink"
+
+    @abstractmethod
+    async def send(self, rule: NotificationRule, subject: str, webhook_data: Dict[Any, Any],
+                   condition_info: Dict[str, Any]) -> Optional[bool]:
+        ...
+
+class EmailSink(NotificationSink):
+    name = "email"
+
+    def __init__(self, email_service):
+        self.email_service = email_service
+
+    async def send(self, rule, subject, webhook_data, condition_info):
+        if not rule.email_recipients:
+            return None
+        return await self.email_service.send_notification_async(
+            rule.email_recipients, subject, webhook_data, condition_info
+        )
+
+class CircuitBreaker:
+    """Stops calls to a failing destination for a while, then lets one call probe it"""
+
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD, open_seconds: float = CIRCUIT_OPEN_SECONDS):
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.open_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+class WebhookSink(NotificationSink):
+    """POSTs alerts as JSON to each of a rule's webhook URLs.
+
+    Requests share one pooled client, are limited per destination host,
+    retried with jittered backoff on network errors, 429 and 5xx, and
+    skipped while the host's circuit is open. The host is resolved and
+    checked again on every send and the request goes to the checked
+    address, so a name that later resolves to an internal address
+    (DNS rebinding) can't redirect alerts there.
+    """
+
+    name = "webhook"
+
+    def __init__(self, http_client: httpx.AsyncClient,
+                 concurrency_per_host: int = WEBHOOK_CONCURRENCY_PER_HOST):
+        self.client = http_client
+        self.concurrency_per_host = concurrency_per_host
+        # host -> (concurrency limit, circuit), least recently used first
+        self.hosts: "OrderedDict[str, Tuple[asyncio.Semaphore, CircuitBreaker]]" = OrderedDict()
+
+    def _host(self, host: str) -> Tuple[asyncio.Semaphore, CircuitBreaker]:
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = (asyncio.Semaphore(self.concurrency_per_host), CircuitBreaker())
+            while len(self.hosts) > WEBHOOK_MAX_HOSTS:
+                # Requests in flight keep their own reference to the evicted limit
+                self.hosts.popitem(last=False)
+        self.hosts.move_to_end(host)
+        return state
+
+    def circuit(self, host: str) -> Optional[CircuitBreaker]:
+        state = self.hosts.get(host)
+        return state[1] if state else None
+
+    def payload(self, rule: NotificationRule, subject: str, webhook_data: Dict[Any, Any],
+                condition_info: Dict[str, Any]) -> Dict[str, Any]:
+        capture = {
+            key: webhook_data.get(key)
+            for key in ("method", "ip", "status_code", "timestamp", "headers", "query_params", "error_message")
+        }
+        capture["body"] = (webhook_data.get("body") or "")[:WEBHOOK_BODY_CHARS]
+        return {
+            "event": "notification",
+            "subject": subject,
+            "rule_id": rule.id,
+            "rule_name": rule.name,
+            "session_id": rule.session_id,
+            "triggered_value": condition_info.get("triggered_value"),
+            "digest": condition_info.get("digest"),
+            "capture": capture,
+        }
+
+    async def send(self, rule, subject, webhook_data, condition_info):
+        if not rule.webhook_urls:
+            return None
+        content = json.dumps(self.payload(rule, subject, webhook_data, condition_info), default=str)
+        results = await asyncio.gather(*(self.post(str(url), content) for url in rule.webhook_urls))
+        return any(results)
+
+    async def post(self, url: str, content: str) -> bool:
+        host = urlsplit(url).netloc
+        if not host:
+            print(f"Webhook sink skipping malformed URL {url}")
+            return False
+        limit, circuit = self._host(host)
+        address, problem = await resolve_webhook_destination(url)
+        if problem:
+            print(f"Webhook sink refusing {url}: {problem}")
+            return False
+        try:
+            target = httpx.URL(url)
+        except httpx.InvalidURL as e:
+            print(f"Webhook sink skipping invalid URL {url}: {e}")
+            return False
+        # Connect to the checked address; Host and TLS (SNI and certificate
+        # checks) still use the name from the rule
+        pinned = target.copy_with(host=address)
+        headers = {"Content-Type": "application/json", "Host": target.netloc.decode()}
+        extensions = {"sni_hostname": target.host} if target.scheme == "https" else {}
+        for attempt in range(WEBHOOK_MAX_ATTEMPTS):
+            if not circuit.allow():
+                print(f"Webhook sink circuit open for {host}, skipping {url}")
+                return False
+            retryable = True
+            try:
+                async with limit:
+                    response = await self.client.post(
+                        pinned, content=content, headers=headers, extensions=extensions
+                    )
+                if response.is_success:
+                    circuit.record_success()
+                    return True
+                retryable = response.status_code == 429 or response.status_code >= 500
+                error = f"HTTP {response.status_code}"
+            except (httpx.InvalidURL, httpx.UnsupportedProtocol) as e:
+                print(f"Webhook sink skipping invalid URL {url}: {e}")
+                return False
+            except httpx.HTTPError as e:
+                error = str(e) or type(e).__name__
+            if retryable:
+                circuit.record_failure()
+            else:
+                # Other 4xx replies mean the request itself is wrong: the host is up, and retrying won't help
+                circuit.record_success()
+            if not retryable or attempt == WEBHOOK_MAX_ATTEMPTS - 1:
+                print(f"Webhook sink failed for {url}: {error}")
+                return False
+            # Full jitter, so retries from many alerts don't arrive together
+            await asyncio.sleep(random.uniform(0, WEBHOOK_RETRY_BASE_SECONDS * 2 ** attempt))
+        return False
+
+def default_sinks(email_service, http_client: Optional[httpx.AsyncClient] = None) -> List[NotificationSink]:
+    sinks: List[NotificationSink] = [EmailSink(email_service)]
+    if http_client is not None:
+        sinks.append(WebhookSink(http_client))
+    return sinks
@@ -0,0 +1,48 @@
+"""Standalone notification worker.
+
+Evaluates notification rules from the capture log's "notifications"
+consumer group outside the API process, and sends digests for rules
+in digest mode. Run as many as needed:
+
+    NOTIFICATION_WORKERS=8 python notification_worker.py
+
+and set NOTIFICATION_WORKERS=0 on the API workers so they only ingest.
+"""
+import asyncio
+import os
+
+from redis import asyncio as aioredis
+
+from cache import invalidation_bus
+from capture_log import NOTIFICATION_GROUP, run_consumer_pool
+from email_service import email_service
+from notification_engine import NotificationEngine
+from notification_sinks import create_http_client, default_sinks
+
+def create_redis_client():
+    redis_url = os.getenv('UPSTASH_REDIS_URL', 'redis://localhost:6379')
+    if 'upstash.io' in redis_url:
+        # Upstash requires SSL
+        return aioredis.Redis.from_url(redis_url.replace('redis://', 'rediss://'), ssl_cert_reqs=None)
+    return aioredis.Redis.from_url(redis_url)
+
+async def main():
+    concurrency = int(os.getenv("NOTIFICATION_WORKERS", "4")) or 1
+    redis_client = create_redis_client()
+    http_client = create_http_client()
+    notification_engine = NotificationEngine(redis_client, email_service, default_sinks(email_service, http_client))
+    print(f"Notification worker started with {concurrency} consumers")
+    try:
+        await asyncio.gather(
+            run_consumer_pool(redis_client, NOTIFICATION_GROUP, notification_engine.evaluate_capture, concurrency),
+            notification_engine.run_digest_flusher(),
+            # Rule changes made through the API drop this process's compiled rule sets
+            invalidation_bus.listen(redis_client),
+        )
+    finally:
+        email_service.close()
+        await http_client.aclose()
+        await redis_client.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+import re
+from typing import Any, Dict, List
+
+# Only the start of large bodies is indexed so capture cost stays bounded
+MAX_INDEXED_TEXT_CHARS = 64 * 1024
+# Every term costs a posting set write per capture and isn't counted in the
+# byte cap, so keep it to what a search can usefully narrow on
+MAX_TERMS_PER_REQUEST = 128
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+TOKEN_PATTERN = re.compile(r"[0-9a-z_]+")
+
+# Headers whose values are indexed. They repeat across deliveries; per-request
+# values (ids, dates, lengths, signatures) would each add a posting set that
+# only ever holds one capture.
+SEARCHABLE_HEADERS = frozenset({
+    "content-type", "user-agent", "origin", "x-event-key", "x-event-type",
+    "x-github-event", "x-gitlab-event", "x-shopify-topic"
+})
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased search terms in order of first appearance, without duplicates"""
+    terms = {}
+    for match in TOKEN_PATTERN.finditer(text[:MAX_INDEXED_TEXT_CHARS].lower()):
+        term = match.group()
+        if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH:
+            terms[term] = None
+    return list(terms)
+
+def document_terms(request_data: Dict[str, Any]) -> List[str]:
+    """Terms a captured request is searchable by: its body and SEARCHABLE_HEADERS values"""
+    header_terms = tokenize("\n".join(
+        value for name, value in request_data.get("headers", {}).items() if name in SEARCHABLE_HEADERS
+    ))
+    body_terms = tokenize(request_data.get("body") or "")
+    return list(dict.fromkeys(header_terms + body_terms))[:MAX_TERMS_PER_REQUEST]
@@ -0,0 +1,77 @@
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from cache import LRUTTLCache, invalidation_bus
+from capture_store import get_retention_limits
+from models import SessionLifespan, SessionRetention
+
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "30"))
+
+class CompiledFilters:
+    """Session IP/method filters prepared for constant-time checks"""
+
+    def __init__(self, filters: Optional[Dict[str, Any]]):
+        filters = filters or {}
+        self.blocked_ips = frozenset(filters.get("blocked_ips") or ())
+        self.allowed_ips = frozenset(filters.get("allowed_ips") or ())
+        self.allowed_methods = frozenset(filters.get("allowed_methods") or ())
+
+    def check(self, client_ip: str, method: str) -> Optional[Tuple[int, str]]:
+        """Return (status_code, reason) if the request is filtered out"""
+        if client_ip in self.blocked_ips:
+            return 403, "IP address blocked"
+        if self.allowed_ips and client_ip not in self.allowed_ips:
+            return 403, "IP address not in allowlist"
+        if self.allowed_methods and method not in self.allowed_methods:
+            return 405, "Method not allowed"
+        return None
+
+class CachedSession:
+    def __init__(self, record: Dict[str, Any]):
+        self.record = record
+        self.owner_id = record.get("owner_id")
+        self.filters = CompiledFilters(record.get("filters"))
+        # Legacy anonymous sessions predate lifespans and live for 24h
+        self.lifespan = SessionLifespan(record.get("lifespan") or SessionLifespan.TWENTY_FOUR_HOURS)
+        if record.get("retention"):
+            self.retention = SessionRetention(**record["retention"])
+        else:
+            self.retention = get_retention_limits(self.lifespan)
+
+class SessionCache:
+    """Parsed session records shared by every capture on this worker"""
+
+    namespace = "session"
+
+    def __init__(self, max_size: int = SESSION_CACHE_SIZE,
+                 ttl_seconds: float = SESSION_CACHE_TTL_SECONDS):
+        self.entries = LRUTTLCache(max_size, ttl_seconds)
+        invalidation_bus.register(self.namespace, self.entries.invalidate, self.entries.clear)
+
+    async def get(self, redis_client, session_id: str) -> Optional[CachedSession]:
+        cached = self.entries.get(session_id)
+        if cached is not None:
+            return cached
+
+        session_data = await redis_client.get(f"session:{session_id}")
+        if not session_data:
+            return None
+
+        cached = CachedSession(json.loads(session_data))
+        self.entries.set(session_id, cached)
+        return cached
+
+    def discard(self, session_id: str):
+        """Drop a local entry, e.g. once Redis reports the session is gone"""
+        self.entries.invalidate(session_id)
+
+    async def invalidate(self, redis_client, session_id: str):
+        """Drop a session from every worker's cache"""
+        await invalidation_bus.publish(redis_client, self.namespace, session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.entries.stats()
+
+session_cache = SessionCache()
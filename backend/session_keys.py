@@ -0,0 +1,59 @@
+"""Names of the keys a session's captures are stored under.
+
+Every one carries the hash tag "{session:<id>}". Redis Cluster (and proxies
+that shard the same way) hash only the tagged part of a name, and that part
+is the full name of the untagged session record, so the record and all of
+its capture keys live in one slot. The capture scripts rely on this: they
+build posting set and body blob names from a prefix at run time, which is
+only safe when every such key is in the slot of the keys they declare.
+"""
+from typing import List, Tuple
+
+from redis.exceptions import ResponseError
+
+# Families keyed only by session id, and those with a further suffix
+SESSION_KEY_KINDS = ("requests", "session_stats", "header_dict")
+SUFFIXED_KEY_KINDS = ("req_idx", "request_body")
+
+def session_tag(session_id: str) -> str:
+    return "{session:" + session_id + "}"
+
+def session_key(kind: str, session_id: str, *parts) -> str:
+    """A capture key in the session's slot, e.g. session_key("req_idx", sid, "time")"""
+    return ":".join([kind, session_tag(session_id), *(str(part) for part in parts)])
+
+def session_key_prefix(kind: str, session_id: str) -> str:
+    """What a suffixed key's name starts with, for scripts that append the suffix"""
+    return session_key(kind, session_id) + ":"
+
+async def _legacy_keys(redis_client, session_id: str) -> List[Tuple[str, str]]:
+    """(untagged name, tagged name) for each of a session's keys still under its old name"""
+    moves = [(f"{kind}:{session_id}", session_key(kind, session_id)) for kind in SESSION_KEY_KINDS]
+    for kind in SUFFIXED_KEY_KINDS:
+        prefix = f"{kind}:{session_id}:"
+        async for key in redis_client.scan_iter(match=prefix + "*", count=1000):
+            suffix = key.decode()[len(prefix):]
+            moves.append((prefix + suffix, session_key(kind, session_id, suffix)))
+    return moves
+
+async def migrate_session_keys(redis_client, session_id: str) -> int:
+    """Move a session's keys from their untagged names, keeping their TTLs.
+
+    Keys are copied with DUMP/RESTORE since the old and new names can be in
+    different slots. A key that already exists under its new name is left
+    where it is. Returns the number of keys moved.
+    """
+    moved = 0
+    for old, new in await _legacy_keys(redis_client, session_id):
+        dumped = await redis_client.dump(old)
+        if dumped is None:
+            continue
+        ttl = await redis_client.pttl(old)
+        try:
+            await redis_client.restore(new, max(ttl, 0), dumped)
+        except ResponseError as e:
+            print(f"Not migrating {old}: {e}")
+            continue
+        await redis_client.delete(old)
+        moved += 1
+    return moved
@@ -1,11 +1,13 @@
 import pytest
+import pytest_asyncio
 import asyncio
 from fastapi.testclient import TestClient
-from httpx import AsyncClient
+from httpx import AsyncClient, ASGITransport
 import fakeredis
 from unittest.mock import patch
 
 from backend import app, redis_client
+from live_updates import ConnectionManager
 
 @pytest.fixture(scope="session")
 def event_loop():
@@ -16,12 +18,60 @@ def event_loop():
 
 @pytest.fixture
 def fake_redis():
-    """Mock Redis with in-memory fakeredis."""
-    fake_redis_client = fakeredis.FakeRedis()
-    with patch('backend.redis_client', fake_redis_client):
+    """Mock Redis with in-memory fakeredis.
+
+    The app talks to an async client; tests get a sync client on the same
+    fake server so they can inspect state directly. Each test also gets its
+    own WebSocket manager, since its pub/sub connection is bound to the
+    fake server and event loop of the test that opened it.
+    """
+    server = fakeredis.FakeServer()
+    fake_redis_client = fakeredis.FakeRedis(server=server)
+    fake_async_client = fakeredis.FakeAsyncRedis(server=server)
+    with patch('backend.redis_client', fake_async_client), \
+            patch('backend.manager', ConnectionManager()):
         yield fake_redis_client
 
 @pytest.fixture
 def test_client():
     """Sync test client for simple tests."""
-    return TestClient(app)
\ No newline at end of file
+    return TestClient(app)
+
+@pytest_asyncio.fixture
+async def owner_client(fake_redis):
+    """Async client for a registered user who owns one session.
+
+    Yields (client, auth headers, session id).
+    """
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        token = (await client.post("/auth/register", json={
+            "email": "owner@example.com", "password": "secret", "full_name": "Owner"
+        })).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        session_id = (await client.post("/sessions", json={"name": "Hooks"}, headers=headers)).json()["id"]
+        yield client, headers, session_id
+
+class RecordingEmail:
+    """Email service stand-in that records alerts instead of sending them.
+
+    delivered is what every send reports; reporting failure leaves the
+    rules' cooldowns untouched.
+    """
+
+    def __init__(self, delivered=True):
+        self.delivered = delivered
+        self.sent = []
+
+    async def send_notification_async(self, to_emails, subject, webhook_data, condition_info):
+        self.sent.append({"to": to_emails, "subject": subject,
+                          "webhook_data": webhook_data, "condition_info": condition_info})
+        return self.delivered
+
+    @property
+    def subjects(self):
+        return [message["subject"] for message in self.sent]
+
+@pytest.fixture
+def recording_email():
+    """Build RecordingEmail fakes, e.g. recording_email(delivered=False)"""
+    return RecordingEmail
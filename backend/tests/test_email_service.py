@@ -0,0 +1,129 @@
+import pytest
+import asyncio
+import socketserver
+import threading
+import time
+from unittest.mock import patch
+
+from email_service import EmailService
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib; no STARTTLS, and AUTH only counts attempts"""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 stub ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 stub")
+            elif command.startswith("MAIL"):
+                with server.lock:
+                    refuse = server.refuse_next > 0
+                    server.refuse_next -= refuse
+                self.reply("421 try again later" if refuse else "250 OK")
+            elif command.startswith("AUTH"):
+                with server.lock:
+                    server.auth_attempts += 1
+                self.reply("535 no")
+            elif command.startswith(("RCPT", "RSET", "NOOP")):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                time.sleep(server.latency)
+                with server.lock:
+                    server.messages += 1
+                self.reply("250 queued")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+@pytest.fixture
+def smtp_stub():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StubSMTPHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.messages = 0
+    server.refuse_next = 0
+    server.auth_attempts = 0
+    server.latency = 0.01
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+class TestEmailDelivery:
+    @pytest.mark.asyncio
+    async def test_alerts_share_pooled_connections(self, smtp_stub):
+        """Test that concurrent alerts are sent off the loop over at most pool-size connections."""
+        service = EmailService("127.0.0.1", smtp_stub.server_address[1], pool_size=3, require_tls=False)
+        condition = {"condition_name": "errors", "triggered_value": 500}
+
+        started = time.monotonic()
+        results = await asyncio.gather(*(
+            service.send_notification_async(["ops@example.com"], f"Alert {i}", {"status_code": 500}, condition)
+            for i in range(30)
+        ))
+        elapsed = time.monotonic() - started
+
+        assert all(results)
+        assert smtp_stub.messages == 30
+        assert smtp_stub.connections <= 3
+        # Three connections in parallel beat sending one by one
+        assert elapsed < 30 * smtp_stub.latency
+        assert service.stats()["sent"] == 30
+        service.close()
+
+    @pytest.mark.asyncio
+    async def test_transient_failures_are_retried(self, smtp_stub):
+        """Test that 4xx replies are retried on a fresh connection with backoff."""
+        service = EmailService("127.0.0.1", smtp_stub.server_address[1], pool_size=1, require_tls=False)
+        smtp_stub.refuse_next = 2
+
+        with patch("email_service.SMTP_RETRY_BASE_SECONDS", 0.01):
+            sent = await service.send_notification_async(
+                ["ops@example.com"], "Alert", {}, {"condition_name": "errors", "triggered_value": 500}
+            )
+
+        assert sent
+        assert smtp_stub.messages == 1
+        assert service.stats()["retries"] == 2
+        # A refused connection is discarded rather than reused
+        assert smtp_stub.connections == 3
+        service.close()
+
+    @pytest.mark.asyncio
+    async def test_login_refused_without_starttls(self, smtp_stub):
+        """Test that a server not offering STARTTLS never receives credentials."""
+        service = EmailService("127.0.0.1", smtp_stub.server_address[1], "ops", "secret", pool_size=1)
+        sent = await service.send_notification_async(
+            ["ops@example.com"], "Alert", {}, {"condition_name": "errors", "triggered_value": 500}
+        )
+        assert not sent
+        assert smtp_stub.messages == 0
+        assert smtp_stub.auth_attempts == 0
+
+    def test_digest_escapes_captured_values(self):
+        """Test that sender-controlled values in a digest can't inject HTML."""
+        service = EmailService("127.0.0.1", 25)
+        section = service._create_digest_section({
+            "count": 1, "first": "t0", "last": "t0",
+            "top_keys": [("<script>alert(1)</script>", 1)],
+            "samples": [{"ip": "<img src=x>", "body": "<b>hi</b>"}],
+        })
+        assert "<script>" not in section and "<img" not in section and "<b>hi" not in section
+        assert "&lt;script&gt;" in section
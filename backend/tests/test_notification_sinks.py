@@ -0,0 +1,138 @@
+import pytest
+import json
+from unittest.mock import patch
+
+import httpx
+
+from models import NotificationRule
+from notification_sinks import CIRCUIT_FAILURE_THRESHOLD, WebhookSink, _is_ip_literal, check_webhook_destination
+
+# Addresses hostnames resolve to in these tests; anything else is public
+resolved = {}
+
+@pytest.fixture(autouse=True)
+def fake_dns():
+    async def resolve_host(host):
+        return resolved.get(host, [host if _is_ip_literal(host) else "93.184.216.34"])
+    resolved.clear()
+    with patch("notification_sinks.resolve_host", resolve_host):
+        yield resolved
+
+def make_rule(**overrides):
+    rule = {
+        "id": "r1", "session_id": "s1", "name": "errors", "condition": "status_code",
+        "operator": "equals", "value": 500, "email_recipients": [],
+        "webhook_urls": ["https://hooks.example.com/alerts"], "created_at": "now",
+    }
+    rule.update(overrides)
+    return NotificationRule(**rule)
+
+class TestWebhookSink:
+    @pytest.mark.asyncio
+    async def test_alert_posted_as_json(self):
+        """Test that an alert is POSTed once to each URL with the capture details."""
+        received = []
+
+        def handler(request):
+            received.append((str(request.url), request, json.loads(request.content)))
+            return httpx.Response(204)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            sink = WebhookSink(client)
+            sent = await sink.send(make_rule(), "Webhook Alert: errors",
+                                   {"status_code": 500, "method": "POST", "body": "boom"},
+                                   {"triggered_value": 500})
+            # Rules without URLs are not this sink's to deliver
+            skipped = await sink.send(make_rule(webhook_urls=[]), "x", {}, {})
+
+        assert sent is True
+        assert skipped is None
+        url, request, payload = received[0]
+        # Sent to the address that was checked, under the rule's host name
+        assert url == "https://93.184.216.34/alerts"
+        assert request.headers["host"] == "hooks.example.com"
+        assert request.extensions["sni_hostname"] == "hooks.example.com"
+        assert payload["rule_id"] == "r1"
+        assert payload["capture"]["method"] == "POST"
+        assert payload["capture"]["body"] == "boom"
+
+    @pytest.mark.asyncio
+    async def test_server_errors_retried_and_circuit_opens(self):
+        """Test that 5xx replies are retried, and a host that keeps failing is skipped."""
+        calls = {"count": 0}
+
+        def handler(request):
+            calls["count"] += 1
+            # First alert: fails once, then gets through
+            if calls["count"] == 2:
+                return httpx.Response(200)
+            return httpx.Response(503)
+
+        with patch("notification_sinks.WEBHOOK_RETRY_BASE_SECONDS", 0):
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                sink = WebhookSink(client)
+                assert await sink.send(make_rule(), "x", {}, {}) is True
+                assert calls["count"] == 2
+
+                # Keep failing until the circuit opens, then requests stop
+                while sink.circuit("hooks.example.com").state == "closed":
+                    assert await sink.send(make_rule(), "x", {}, {}) is False
+                assert sink.circuit("hooks.example.com").failures == CIRCUIT_FAILURE_THRESHOLD
+                before = calls["count"]
+                assert await sink.send(make_rule(), "x", {}, {}) is False
+                assert calls["count"] == before
+
+    @pytest.mark.asyncio
+    async def test_client_errors_not_retried(self):
+        """Test that a 4xx reply fails the alert without retrying or tripping the circuit."""
+        calls = {"count": 0}
+
+        def handler(request):
+            calls["count"] += 1
+            return httpx.Response(404)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            sink = WebhookSink(client)
+            assert await sink.send(make_rule(), "x", {}, {}) is False
+
+        assert calls["count"] == 1
+        assert sink.circuit("hooks.example.com").state == "closed"
+
+    @pytest.mark.asyncio
+    async def test_internal_and_malformed_destinations_rejected(self):
+        """Test that rules can only point at well-formed, public webhook URLs."""
+        from pydantic import ValidationError
+
+        for url in ("http://", "not a url", "ftp://example.com/hook"):
+            with pytest.raises(ValidationError):
+                make_rule(webhook_urls=[url])
+
+        for url in ("http://127.0.0.1:8000/x", "http://localhost/hook", "http://10.0.0.5/",
+                    "http://[::1]/", "http://169.254.169.254/latest/meta-data", "http://redis.internal/"):
+            assert await check_webhook_destination(url) is not None
+        assert await check_webhook_destination("http://93.184.216.34/hook") is None
+
+    @pytest.mark.asyncio
+    async def test_destination_rechecked_on_every_send(self, fake_dns):
+        """Test that a host which later resolves to an internal address gets nothing."""
+        calls = {"count": 0}
+
+        def handler(request):
+            calls["count"] += 1
+            return httpx.Response(200)
+
+        assert await check_webhook_destination("https://hooks.example.com/alerts") is None
+        fake_dns["hooks.example.com"] = ["169.254.169.254"]
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            assert await WebhookSink(client).send(make_rule(), "x", {}, {}) is False
+        assert calls["count"] == 0
+
+    @pytest.mark.asyncio
+    async def test_host_state_is_bounded(self):
+        """Test that per-host limits and circuits don't grow without bound."""
+        async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200))) as client:
+            sink = WebhookSink(client)
+            with patch("notification_sinks.WEBHOOK_MAX_HOSTS", 3):
+                for i in range(10):
+                    await sink.send(make_rule(webhook_urls=[f"https://h{i}.example.com/"]), "x", {}, {})
+            assert list(sink.hosts) == ["h7.example.com", "h8.example.com", "h9.example.com"]
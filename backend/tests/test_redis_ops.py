@@ -1,6 +1,13 @@
 import pytest
+import asyncio
+import base64
 import json
+import os
 from datetime import datetime
+from unittest.mock import patch
+from redis.crc import key_slot
+
+from session_keys import session_key, session_key_prefix
 
 class TestRedisOperations:
     def test_session_expiration(self, fake_redis):
@@ -17,17 +24,332 @@ class TestRedisOperations:
         ttl = fake_redis.ttl(f"session:{session_id}")
         assert 86399 <= ttl <= 86400  # Should be close to 24 hours
 
-    def test_request_storage_limit(self, fake_redis):
-        """Test request storage behavior."""
-        session_id = "test123"
-        requests_key = f"requests:{session_id}"
+    @pytest.mark.asyncio
+    async def test_request_storage_limit(self, fake_redis):
+        """Test that captures beyond the retention cap evict the oldest requests."""
+        from httpx import AsyncClient, ASGITransport
+        from backend import app
+        
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            session_id = (await client.post("/webhooks")).json()["session_id"]
+            session = json.loads(fake_redis.get(f"session:{session_id}"))
+            session["retention"] = {"max_requests": 5, "max_bytes": 1024 * 1024}
+            fake_redis.set(f"session:{session_id}", json.dumps(session), keepttl=True)
+            
+            for i in range(10):
+                await client.post(f"/hooks/{session_id}", json={"request": i})
+        
+        from backend import redis_client
+        from capture_store import CaptureStore
+        stored = [json.loads(r["body"])["request"] async for r in CaptureStore(redis_client).iter_requests(session_id)]
+        assert stored == [9, 8, 7, 6, 5]
+        assert int(fake_redis.hget(session_key("session_stats", session_id), "evicted_count")) == 5
+
+    @pytest.mark.asyncio
+    async def test_request_storage_byte_limit(self, fake_redis):
+        """Test that the byte cap is enforced alongside the count cap."""
+        from httpx import AsyncClient, ASGITransport
+        from backend import app
+        
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            session_id = (await client.post("/webhooks")).json()["session_id"]
+            session = json.loads(fake_redis.get(f"session:{session_id}"))
+            session["retention"] = {"max_requests": 100, "max_bytes": 4096}
+            fake_redis.set(f"session:{session_id}", json.dumps(session), keepttl=True)
+            
+            for i in range(10):
+                # Incompressible bodies so stored size tracks body size
+                await client.post(f"/hooks/{session_id}", content=base64.b64encode(os.urandom(1500)))
+        
+        stats = fake_redis.hgetall(session_key("session_stats", session_id))
+        stored = fake_redis.lrange(session_key("requests", session_id), 0, -1)
+        assert int(stats[b"bytes"]) == sum(len(r) for r in stored) <= 4096
+        assert len(stored) + int(stats[b"evicted_count"]) == 10
+
+class TestRequestIndexes:
+    @pytest.mark.asyncio
+    async def test_indexed_queries_follow_eviction(self, fake_redis):
+        """Test intersected index queries and that evicted requests leave the indexes."""
+        from backend import redis_client
+        from capture_store import CaptureStore, RequestFilter
+        from models import SessionRetention
+        
+        session_id = "idx123"
+        fake_redis.setex(f"session:{session_id}", 3600, json.dumps({"id": session_id}))
+        store = CaptureStore(redis_client)
+        retention = SessionRetention(max_requests=6, max_bytes=1024 * 1024)
+        for i in range(10):
+            await store.commit(session_id, {
+                "id": str(i),
+                "timestamp": datetime(2030, 1, 1, 0, i).isoformat(),
+                "method": "POST" if i % 2 else "GET",
+                "status_code": 500 if i % 3 == 0 else 200,
+                "ip": "10.0.0.1",
+            }, 3600, retention)
+        
+        async def seqs(**kwargs):
+            requests, _ = await store.list_requests(session_id, 50, request_filter=RequestFilter(**kwargs))
+            return [r["seq"] for r in requests]
+        
+        # Only seqs 5..10 (ids 4..9) survive eviction
+        assert await seqs(status_code=500) == [10, 7]
+        assert await seqs(method="get", status_code=500, ip="10.0.0.1") == [7]
+        assert await seqs(since=datetime(2030, 1, 1, 0, 5), until=datetime(2030, 1, 1, 0, 7)) == [8, 7, 6]
+        assert fake_redis.zcard(session_key("req_idx", session_id, "ip:10.0.0.1")) == 6
+        assert fake_redis.zcard(session_key("req_idx", session_id, "time")) == 6
+        
+        await store.delete_session_data(session_id)
+        assert not fake_redis.keys(session_key_prefix("req_idx", session_id) + "*")
+
+    @pytest.mark.asyncio
+    async def test_evicted_postings_leave_the_suffix_set(self, fake_redis):
+        """Test that posting sets emptied by eviction are forgotten and per-request headers aren't indexed."""
+        from backend import redis_client
+        from capture_store import CaptureStore
+        from models import SessionRetention
+        
+        session_id = "keys123"
+        fake_redis.setex(f"session:{session_id}", 3600, json.dumps({"id": session_id}))
+        store = CaptureStore(redis_client)
+        retention = SessionRetention(max_requests=10, max_bytes=1024 * 1024)
+        for i in range(200):
+            await store.commit(session_id, {
+                "id": str(i), "timestamp": datetime.now().isoformat(), "method": "POST",
+                "status_code": 200, "ip": "10.0.0.1", "body": f"order {i:04}",
+                "headers": {"user-agent": "Stripe/1.0", "x-request-id": f"req{i}"},
+            }, 3600, retention)
+        
+        suffixes = {s.decode() for s in fake_redis.smembers(session_key("req_idx", session_id, "keys"))}
+        # method, status, ip, "order", "stripe" and one term per stored order number
+        assert len(suffixes) == 15
+        assert "term:req199" not in suffixes
+        assert all(fake_redis.exists(session_key("req_idx", session_id, suffix)) for suffix in suffixes)
+
+    @pytest.mark.asyncio
+    async def test_evicted_requests_drop_offloaded_bodies(self, fake_redis):
+        """Test that evicting a request deletes its offloaded body and frees its bytes."""
+        from backend import redis_client
+        from capture_store import CaptureStore, offload_body, BODY_OFFLOAD_THRESHOLD_BYTES
+        from models import SessionRetention
+        
+        session_id = "blob123"
+        fake_redis.setex(f"session:{session_id}", 3600, json.dumps({"id": session_id}))
+        store = CaptureStore(redis_client)
+        retention = SessionRetention(max_requests=2, max_bytes=1024 * 1024 * 1024)
+        for i in range(3):
+            record = {"id": f"r{i}", "timestamp": datetime.now().isoformat(), "method": "POST",
+                      "status_code": 200, "ip": "10.0.0.1", "headers": {}, "body": ""}
+            blob = offload_body(record, os.urandom(BODY_OFFLOAD_THRESHOLD_BYTES + 1))
+            await store.commit(session_id, record, 3600, retention, blob)
+        
+        assert not fake_redis.exists(session_key("request_body", session_id, "r0"))
+        assert fake_redis.exists(*(session_key("request_body", session_id, f"r{i}") for i in (1, 2))) == 2
+        stored = sum(len(r) for r in fake_redis.lrange(session_key("requests", session_id), 0, -1))
+        stored += sum(fake_redis.strlen(session_key("request_body", session_id, f"r{i}")) for i in (1, 2))
+        assert int(fake_redis.hget(session_key("session_stats", session_id), "bytes")) == stored
+        
+        # Blobs and posting sets the script named itself share the session record's slot
+        slots = {key_slot(key) for key in fake_redis.keys("*") if f"session:{session_id}".encode() in key}
+        assert slots == {key_slot(f"session:{session_id}".encode())}
+        
+        await store.delete_session_data(session_id)
+        assert not fake_redis.keys(session_key_prefix("request_body", session_id) + "*")
+
+class TestCaptureCodec:
+    @pytest.mark.asyncio
+    async def test_compact_records_and_legacy_json(self, fake_redis):
+        """Test that compact records round-trip and legacy JSON entries still decode."""
+        from backend import redis_client
+        from capture_codec import CaptureCodec, FORMAT_MSGPACK_ZLIB, header_dictionaries
+        
+        session_id = "codec123"
+        fake_redis.setex(f"session:{session_id}", 3600, json.dumps({"id": session_id}))
+        record = {
+            "id": "abc",
+            "method": "POST",
+            "headers": {"content-type": "application/json", "user-agent": "Stripe/1.0", "x-id": "42"},
+            "body": json.dumps({"items": list(range(200))}),
+        }
+        encoded = await CaptureCodec(redis_client).encode(session_id, record, 3600)
+        assert encoded[0] == FORMAT_MSGPACK_ZLIB
+        assert len(encoded) < len(json.dumps(record)) / 2
+        
+        # A fresh worker has to load the dictionary from Redis
+        header_dictionaries.clear()
+        legacy = json.dumps({"id": "old", "headers": {"a": "b"}}).encode()
+        decoded = await CaptureCodec(redis_client).decode_many(session_id, [encoded, legacy, None])
+        assert decoded == [record, {"id": "old", "headers": {"a": "b"}}, None]
+
+    @pytest.mark.asyncio
+    async def test_full_dictionary_stops_intern_round_trips(self, fake_redis):
+        """Test that per-request values aren't interned and a full dictionary isn't asked again."""
+        from backend import redis_client
+        from capture_codec import CaptureCodec
+        
+        session_id = "codecfull"
+        fake_redis.setex(f"session:{session_id}", 3600, json.dumps({"id": session_id}))
+        codec = CaptureCodec(redis_client)
+        calls = []
+        intern = codec._intern
+        async def counting_intern(**kwargs):
+            calls.append(kwargs["args"][2:])
+            return await intern(**kwargs)
+        codec._intern = counting_intern
+        
+        for i in range(5):
+            await codec.encode(session_id, {"headers": {"x-request-start": f"t={i}", "via": f"proxy-{i}"}}, 3600)
+        # Only the header names were ever interned
+        assert calls == [["x-request-start", "via"]]
+        
+        with patch("capture_codec.MAX_DICTIONARY_SIZE", 2):
+            await codec.encode(session_id, {"headers": {"x-new": "1"}}, 3600)
+            record = {"headers": {"x-newer": "1", "x-request-start": "t=9"}}
+            encoded = await codec.encode(session_id, record, 3600)
+        assert len(calls) == 2
+        assert (await codec.decode_many(session_id, [encoded]))[0] == record
+
+class TestCacheInvalidation:
+    @pytest.mark.asyncio
+    async def test_invalidations_reach_other_workers(self, fake_redis):
+        """Test that a published invalidation evicts the entry on a listening worker."""
+        from cache import CacheInvalidationBus, LRUTTLCache
+        from backend import redis_client
+        
+        entries = LRUTTLCache()
+        entries.set("abc", "cached")
+        worker_bus = CacheInvalidationBus()
+        worker_bus.register("session", entries.invalidate, lambda: None)
+        listener = asyncio.create_task(worker_bus.listen(redis_client))
+        await asyncio.sleep(0.05)
+        
+        await CacheInvalidationBus().publish(redis_client, "session", "abc")
+        for _ in range(50):
+            if entries.get("abc") is None:
+                break
+            await asyncio.sleep(0.01)
+        
+        listener.cancel()
+        assert entries.get("abc") is None
+
+class TestCaptureLog:
+    @pytest.mark.asyncio
+    async def test_capture_log_consumer_groups(self, fake_redis, monkeypatch):
+        """Test that captures reach consumer groups and unacknowledged entries are reclaimed."""
+        from httpx import AsyncClient, ASGITransport
+        from backend import app, redis_client
+        import capture_log
+        from capture_log import CaptureLogConsumer, capture_log_key
+        from capture_store import CaptureStore
+        
+        store = CaptureStore(redis_client)
+        handled = []
+        async def handler(event):
+            record = await store.get_request(event.session_id, event.seq)
+            handled.append((event.session_id, event.seq, json.loads(record["body"])))
+        
+        consumer = CaptureLogConsumer(redis_client, "analytics", handler, consumer="worker-a", block_ms=None)
+        await consumer.ensure_group()
+        
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            session_id = (await client.post("/webhooks")).json()["session_id"]
+            for i in range(3):
+                await client.post(f"/hooks/{session_id}", json={"n": i})
+        
+        # worker-a takes the first entry and dies before acknowledging it
+        key = capture_log_key(session_id)
+        fake_redis.xreadgroup("analytics", "worker-a", {key: ">"}, count=1)
+        
+        for shard, entries in await consumer.read():
+            await consumer.process(shard, entries)
+        assert handled == [(session_id, 2, {"n": 1}), (session_id, 3, {"n": 2})]
+        
+        monkeypatch.setattr(capture_log, "CLAIM_IDLE_MS", 0)
+        recovery = CaptureLogConsumer(redis_client, "analytics", handler, consumer="worker-b")
+        for shard, entries in await recovery.claim_stale():
+            await recovery.process(shard, entries)
+        assert handled[-1] == (session_id, 1, {"n": 0})
+        assert fake_redis.xpending(key, "analytics")["pending"] == 0
+
+    @pytest.mark.asyncio
+    async def test_slow_handlers_stop_before_entries_can_be_reclaimed(self, fake_redis, monkeypatch):
+        """Test that each entry is acknowledged on its own and a batch stops when its time runs out."""
+        from backend import redis_client
+        import capture_log
+        from capture_log import CaptureLogConsumer, capture_log_key
+        from capture_store import CaptureStore
+        from models import SessionRetention
+        
+        session_id = "slow123"
+        fake_redis.setex(f"session:{session_id}", 3600, json.dumps({"id": session_id}))
+        started = []
+        async def handler(event):
+            started.append(event.seq)
+            await asyncio.sleep(1)
+        
+        consumer = CaptureLogConsumer(redis_client, "alerts", handler, block_ms=None)
+        await consumer.ensure_group()
+        store = CaptureStore(redis_client)
+        for i in range(3):
+            await store.commit(session_id, {
+                "id": str(i), "timestamp": datetime.now().isoformat(), "method": "POST",
+                "status_code": 200, "ip": "10.0.0.1", "headers": {}, "body": "",
+            }, 3600, SessionRetention(max_requests=10, max_bytes=1024 * 1024))
+        
+        monkeypatch.setattr(capture_log, "HANDLE_BUDGET_MS", 100)
+        for shard, entries in await consumer.read():
+            await consumer.process(shard, entries)
+        # The first handler was cut off and acknowledged; the rest were never started
+        assert started == [1]
+        assert fake_redis.xpending(capture_log_key(session_id), "alerts")["pending"] == 2
+
+    @pytest.mark.asyncio
+    async def test_capture_log_events_carry_no_payload(self, fake_redis):
+        """Test that log entries hold no request data and events for evicted requests are skipped."""
+        from backend import redis_client
+        from capture_log import CaptureLogConsumer, capture_log_key
+        from capture_store import CaptureStore
+        from models import NotificationRule, SessionRetention
+        from notification_engine import NotificationEngine
+        
+        session_id = "compact123"
+        fake_redis.setex(f"session:{session_id}", 3600, json.dumps({"id": session_id}))
+        store = CaptureStore(redis_client)
+        retention = SessionRetention(max_requests=5, max_bytes=1024 * 1024)
+        for i in range(30):
+            await store.commit(session_id, {
+                "id": str(i), "timestamp": datetime.now().isoformat(), "method": "POST",
+                "status_code": 200, "ip": "10.0.0.1", "response_time_ms": 1.5,
+                "headers": {"x-secret": f"token-{i}"}, "body": "x" * 1000,
+            }, 3600, retention)
+        await store.delete_session_data(session_id)
+        
+        entries = fake_redis.xrange(capture_log_key(session_id))
+        assert len(entries) == 30
+        assert all(b"token" not in value and len(value) < 100 for _, fields in entries for value in fields.values())
         
-        # Store some requests
-        for i in range(10):  # Use smaller number for now
-            fake_redis.lpush(requests_key, json.dumps({"request": i}))
+        consumer = CaptureLogConsumer(redis_client, "analytics", None)
+        event = consumer.decode(entries[-1][1])
+        assert (event.seq, event.record["method"], event.record["status_code"]) == (30, "POST", 200)
         
-        # Test what actually happens (no limit implemented yet)
-        stored_count = fake_redis.llen(requests_key)
-        assert stored_count == 10
+        # Header rules need the stored request, which is gone
+        rule = NotificationRule(
+            id="r1", session_id=session_id, name="secret", condition="header_contains",
+            operator="contains", value="token", email_recipients=[], cooldown_minutes=0,
+            created_at=datetime.now().isoformat()
+        )
+        fake_redis.set(f"notification_rules:{session_id}", json.dumps([rule.model_dump()]))
+        engine = NotificationEngine(redis_client, None, sinks=[])
+        notified = []
+        async def notify(rule, webhook_data):
+            notified.append(webhook_data["headers"])
+        engine._notify = notify
+        await engine.evaluate_capture(event)
+        assert notified == []
         
-        # TODO: Implement request limiting in backend.py and update this test
\ No newline at end of file
+        await store.commit(session_id, {
+            "id": "new", "timestamp": datetime.now().isoformat(), "method": "POST",
+            "status_code": 200, "ip": "10.0.0.1", "headers": {"x-secret": "token-new"}, "body": "",
+        }, 3600, retention)
+        entries = fake_redis.xrange(capture_log_key(session_id))
+        await engine.evaluate_capture(consumer.decode(entries[-1][1]))
+        assert notified == [{"x-secret": "token-new"}]
@@ -3,6 +3,8 @@ import json
 from httpx import *
 from unittest.mock import patch, AsyncMock
 
+from session_keys import session_key
+
 class TestWebhookSessions:
     def test_create_webhook_session(self, test_client, fake_redis):
         """Test webhook session creation."""
@@ -51,7 +53,88 @@ class TestWebhookSessions:
                 )
                 assert response.status_code == 200
 
+    @pytest.mark.asyncio
+    async def test_concurrent_captures_update_stats(self, fake_redis):
+        """Test that concurrent captures are all counted and share the session TTL."""
+        import asyncio
+        from backend import app
+        
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post("/webhooks")
+            session_id = response.json()["session_id"]
+            
+            await asyncio.gather(*[
+                client.post(f"/hooks/{session_id}", json={"request": i}) for i in range(20)
+            ])
+            
+            assert fake_redis.llen(session_key("requests", session_id)) == 20
+            assert int(fake_redis.hget(session_key("session_stats", session_id), "request_count")) == 20
+            assert fake_redis.ttl(session_key("requests", session_id)) == fake_redis.ttl(f"session:{session_id}")
+
 class TestRequestRetrieval:
+    @pytest.mark.asyncio
+    async def test_paginate_session_requests(self, fake_redis, owner_client):
+        """Test cursor pagination and server-side filters on the request listing."""
+        
+        client, headers, session_id = owner_client
+        
+        for i in range(7):
+            await client.request("PUT" if i % 2 else "POST", f"/hooks/{session_id}", json={"request": i})
+        
+        url = f"/sessions/{session_id}/requests"
+        page = (await client.get(url, params={"limit": 3}, headers=headers)).json()
+        assert [r["seq"] for r in page["requests"]] == [7, 6, 5]
+        
+        page = (await client.get(url, params={"limit": 3, "cursor": page["next_cursor"]}, headers=headers)).json()
+        assert [r["seq"] for r in page["requests"]] == [4, 3, 2]
+        
+        page = (await client.get(url, params={"limit": 3, "cursor": page["next_cursor"]}, headers=headers)).json()
+        assert [r["seq"] for r in page["requests"]] == [1]
+        assert page["next_cursor"] is None
+        
+        page = (await client.get(url, params={"method": "put"}, headers=headers)).json()
+        assert [r["seq"] for r in page["requests"]] == [6, 4, 2]
+        
+        response = await client.get(url, params={"cursor": "bogus"}, headers=headers)
+        assert response.status_code == 400
+
+    @pytest.mark.asyncio
+    async def test_sessions_from_before_capture_stats_keep_their_requests(self, fake_redis, owner_client):
+        """Test that a session stored before the stats hash existed keeps consistent seqs and counts."""
+        from datetime import datetime
+        client, headers, session_id = owner_client
+        
+        # What the old capture path left behind: JSON entries and a counter in the session record
+        session = json.loads(fake_redis.get(f"session:{session_id}"))
+        session["request_count"] = 150
+        fake_redis.set(f"session:{session_id}", json.dumps(session), keepttl=True)
+        for i in range(150):
+            fake_redis.lpush(f"requests:{session_id}", json.dumps({
+                "id": f"old{i}", "timestamp": datetime.now().isoformat(), "method": "POST",
+                "headers": {}, "body": "", "ip": "10.0.0.1", "status_code": 200
+            }))
+        # ...under the key names used before they were hash-tagged
+        import backend
+        from session_keys import migrate_session_keys
+        assert await migrate_session_keys(backend.redis_client, session_id) == 1
+        assert not fake_redis.exists(f"requests:{session_id}")
+        assert (await client.get("/sessions", headers=headers)).json()[0]["request_count"] == 150
+        
+        await client.post(f"/hooks/{session_id}", json={"new": True})
+        
+        url = f"/sessions/{session_id}/requests"
+        page = (await client.get(url, params={"limit": 3}, headers=headers)).json()
+        assert [r["seq"] for r in page["requests"]] == [151, 150, 149]
+        assert page["requests"][1]["id"] == "old149"
+        page = (await client.get(url, params={"limit": 100, "cursor": page["next_cursor"]}, headers=headers)).json()
+        page = (await client.get(url, params={"limit": 100, "cursor": page["next_cursor"]}, headers=headers)).json()
+        assert [r["id"] for r in page["requests"]][-1] == "old0"
+        assert page["next_cursor"] is None
+        
+        ndjson = (await client.get(f"/sessions/{session_id}/export", params={"format": "ndjson"}, headers=headers)).text
+        assert len(ndjson.splitlines()) == 151
+        assert (await client.get("/sessions", headers=headers)).json()[0]["request_count"] == 151
+
     @pytest.mark.asyncio
     async def test_get_session_requests(self, fake_redis):
         """Test retrieving captured requests for a session."""
@@ -68,4 +151,393 @@ class TestRequestRetrieval:
             
             # Note: You need to implement this GET endpoint in backend.py
             get_response = await client.get(f"/webhooks/{session_id}")
-            assert get_response.status_code == 200
\ No newline at end of file
+            assert get_response.status_code == 200
+
+class TestAuthenticatedSessions:
+    @pytest.mark.asyncio
+    async def test_list_sessions_with_request_counts(self, fake_redis, owner_client):
+        """Test that owned sessions are listed with their capture counts."""
+        
+        client, headers, session_id = owner_client
+        for i in range(2):
+            await client.post(f"/hooks/{session_id}", json={"request": i})
+        
+        sessions = (await client.get("/sessions", headers=headers)).json()
+        assert [s["id"] for s in sessions] == [session_id]
+        assert sessions[0]["request_count"] == 2
+
+    @pytest.mark.asyncio
+    async def test_filter_update_invalidates_cached_session(self, fake_redis, owner_client):
+        """Test that changing filters takes effect for an already cached session."""
+        from backend import session_cache
+        
+        client, headers, session_id = owner_client
+        
+        hits_before = session_cache.stats()["hits"]
+        for _ in range(2):
+            assert (await client.post(f"/hooks/{session_id}", json={})).json()["status"] == "captured"
+        assert session_cache.stats()["hits"] == hits_before + 1
+        
+        response = await client.put(
+            f"/sessions/{session_id}/filters", json={"allowed_methods": ["PUT"]}, headers=headers
+        )
+        assert response.status_code == 200
+        
+        response = await client.post(f"/hooks/{session_id}", json={})
+        assert response.json() == {"status": "filtered", "reason": "Method not allowed"}
+
+    @pytest.mark.asyncio
+    async def test_authenticated_reads_skip_redis_until_user_changes(self, fake_redis, owner_client):
+        """Test that a token's user is cached and dropped once the user record changes."""
+        from datetime import timedelta
+        from backend import redis_client, user_cache
+        from auth import create_access_token
+        
+        client, headers, _ = owner_client
+        assert (await client.get("/auth/me", headers=headers)).json()["email"] == "owner@example.com"
+        
+        # Served from the cache, without reading the record again
+        fake_redis.delete("user:owner@example.com")
+        assert (await client.get("/auth/me", headers=headers)).status_code == 200
+        assert user_cache.stats()["tokens"]["hits"] >= 1
+        
+        await user_cache.invalidate(redis_client, "owner@example.com")
+        assert (await client.get("/auth/me", headers=headers)).status_code == 401
+        
+        # Tokens too close to expiry are verified every time rather than cached
+        expiring = create_access_token({"sub": "owner@example.com"}, timedelta(seconds=2))
+        await client.get("/auth/me", headers={"Authorization": f"Bearer {expiring}"})
+        assert user_cache.tokens.get(expiring) is None
+
+    @pytest.mark.asyncio
+    async def test_export_session_requests(self, fake_redis, owner_client):
+        """Test streaming exports in every supported format."""
+        import csv
+        
+        client, headers, session_id = owner_client
+        for i in range(150):
+            await client.post(f"/hooks/{session_id}?n={i}", json={"request": i})
+        
+        url = f"/sessions/{session_id}/export"
+        ndjson = (await client.get(url, params={"format": "ndjson"}, headers=headers)).text
+        assert [json.loads(line)["seq"] for line in ndjson.splitlines()] == list(range(150, 0, -1))
+        
+        har = (await client.get(url, params={"format": "har"}, headers=headers)).json()
+        assert len(har["log"]["entries"]) == 150
+        assert har["log"]["entries"][0]["request"]["queryString"] == [{"name": "n", "value": "149"}]
+        
+        rows = list(csv.DictReader((await client.get(url, params={"format": "csv"}, headers=headers)).text.splitlines()))
+        assert len(rows) == 150 and rows[-1]["seq"] == "1"
+        
+        response = await client.get(url, params={"format": "xml"}, headers=headers)
+        assert response.status_code == 422
+
+    @pytest.mark.asyncio
+    async def test_search_session_requests(self, fake_redis, owner_client):
+        """Test full-text search over captured bodies and searchable header values."""
+        
+        client, headers, session_id = owner_client
+        
+        ids = []
+        for order_id, event in [(1234, "order.created"), (5678, "order.created"), (1234, "order.paid")]:
+            response = await client.post(
+                f"/hooks/{session_id}", json={"event": event, "order_id": order_id},
+                headers={"User-Agent": "Acme-Hooks/1.0", "X-Request-Id": f"req{order_id}"}
+            )
+            ids.append(response.json()["request_id"])
+        
+        url = f"/sessions/{session_id}/search"
+        results = (await client.get(url, params={"q": "1234"}, headers=headers)).json()["results"]
+        assert [r["id"] for r in results] == [ids[2], ids[0]]
+        
+        results = (await client.get(url, params={"q": "ORDER.CREATED 1234"}, headers=headers)).json()["results"]
+        assert [r["id"] for r in results] == [ids[0]]
+        
+        results = (await client.get(url, params={"q": "acme"}, headers=headers)).json()["results"]
+        assert len(results) == 3
+        
+        # Per-request header values aren't indexed
+        results = (await client.get(url, params={"q": "req1234"}, headers=headers)).json()["results"]
+        assert results == []
+
+    @pytest.mark.asyncio
+    async def test_large_body_offload(self, fake_redis, owner_client):
+        """Test that large bodies are stored separately and streamed back on demand."""
+        import hashlib
+        from capture_store import BODY_OFFLOAD_THRESHOLD_BYTES, BODY_PREVIEW_BYTES
+        
+        client, headers, session_id = owner_client
+        
+        payload = ("needle " + "x" * BODY_OFFLOAD_THRESHOLD_BYTES).encode()
+        request_id = (await client.post(
+            f"/hooks/{session_id}", content=payload, headers={"Content-Type": "text/plain"}
+        )).json()["request_id"]
+        
+        record = (await client.get(f"/sessions/{session_id}/requests", headers=headers)).json()["requests"][0]
+        assert record["body_offloaded"] is True
+        assert len(record["body"]) == BODY_PREVIEW_BYTES
+        assert record["body_size"] == len(payload)
+        assert record["body_sha256"] == hashlib.sha256(payload).hexdigest()
+        
+        response = await client.get(f"/sessions/{session_id}/requests/{request_id}/body", headers=headers)
+        assert response.content == payload
+        assert response.headers["content-type"].startswith("text/plain")
+        
+        results = (await client.get(f"/sessions/{session_id}/search", params={"q": "needle"}, headers=headers)).json()
+        assert [r["id"] for r in results["results"]] == [request_id]
+
+    @pytest.mark.asyncio
+    async def test_oversized_body_rejected(self, fake_redis, owner_client):
+        """Test that bodies over the session limit get 413 whether or not they declare a length."""
+        async def chunked_body():
+            for _ in range(4):
+                yield b"x" * 400
+        
+        client, headers, session_id = owner_client
+        session = json.loads(fake_redis.get(f"session:{session_id}"))
+        session["retention"] = {"max_requests": 100, "max_bytes": 1024 * 1024, "max_body_bytes": 1000}
+        fake_redis.set(f"session:{session_id}", json.dumps(session), keepttl=True)
+        
+        response = await client.post(f"/hooks/{session_id}", content=b"x" * 1001)
+        assert response.status_code == 413
+        
+        response = await client.post(f"/hooks/{session_id}", content=chunked_body())
+        assert response.status_code == 413
+        
+        response = await client.post(f"/hooks/{session_id}", content=b"x" * 1000)
+        assert response.status_code == 200
+        
+        records = (await client.get(f"/sessions/{session_id}/requests", headers=headers)).json()["requests"]
+        assert len(records) == 1
+        assert records[0]["body"] == "x" * 1000
+
+    @pytest.mark.asyncio
+    async def test_filtered_captures_are_queued_for_notifications(self, fake_redis, owner_client):
+        """Test that filtered requests only enqueue an event and show up in queue metrics."""
+        from capture_log import NOTIFICATION_GROUP, CaptureLogConsumer, capture_log_key
+        from backend import redis_client
+        
+        await CaptureLogConsumer(redis_client, NOTIFICATION_GROUP, None).ensure_group()
+        
+        client, headers, session_id = owner_client
+        await client.put(f"/sessions/{session_id}/filters", json={"allowed_methods": ["POST"]}, headers=headers)
+        
+        response = await client.get(f"/hooks/{session_id}")
+        assert response.json() == {"status": "filtered", "reason": "Method not allowed"}
+        await client.post(f"/hooks/{session_id}", json={"ok": True})
+        
+        [(_, fields)] = fake_redis.xrange(capture_log_key(session_id))[:1]
+        assert fields[b"e"] == b"Method not allowed"
+        assert fields[b"m"] == b"GET"
+        assert b"q" not in fields and b"r" not in fields
+        
+        queue = (await client.get("/metrics")).json()["capture_log"][NOTIFICATION_GROUP]
+        assert queue["depth"] == 2
+        assert queue["undelivered"] == 2
+        assert queue["lag_seconds"] >= 0
+
+    @pytest.mark.asyncio
+    async def test_filtered_captures_match_header_and_query_rules(self, fake_redis, owner_client):
+        """Test that header and query rules still fire for filtered requests, without storing them."""
+        from backend import redis_client
+        from capture_log import CaptureLogConsumer, capture_log_key
+        from notification_engine import NotificationEngine
+        
+        client, headers, session_id = owner_client
+        await client.put(f"/sessions/{session_id}/filters", json={"allowed_methods": ["POST"]}, headers=headers)
+        for name, condition, operator, value in [
+            ("stripe", "header_contains", "contains", "stripe"), ("debug", "query_param", "exists", "debug"),
+            ("gets", "method", "equals", "GET"), ("other", "header_contains", "contains", "github"),
+        ]:
+            await client.post("/notifications/rules", json={
+                "session_id": session_id, "name": name, "condition": condition, "operator": operator,
+                "value": value, "email_recipients": ["ops@example.com"], "cooldown_minutes": 0
+            }, headers=headers)
+        
+        await client.get(f"/hooks/{session_id}?debug=1", headers={"User-Agent": "Stripe/1.0"})
+        [(_, fields)] = fake_redis.xrange(capture_log_key(session_id))
+        assert b"user-agent" not in b"".join(fields.values()).lower()
+        
+        engine = NotificationEngine(redis_client, None, sinks=[])
+        notified = []
+        async def notify(rule, webhook_data):
+            notified.append(rule.name)
+        engine._notify = notify
+        await engine.evaluate_capture(CaptureLogConsumer(redis_client, "alerts", None).decode(fields))
+        assert notified == ["stripe", "debug", "gets"]
+
+    @pytest.mark.asyncio
+    async def test_rules_reject_internal_webhook_urls(self, fake_redis, owner_client):
+        """Test that a rule can't send alerts to loopback or private addresses."""
+        
+        client, headers, session_id = owner_client
+        rule = {
+            "session_id": session_id, "name": "errors", "condition": "status_code",
+            "operator": "equals", "value": 500, "email_recipients": []
+        }
+        
+        response = await client.post("/notifications/rules", json={
+            **rule, "webhook_urls": ["http://127.0.0.1:6379/"]
+        }, headers=headers)
+        assert response.status_code == 400
+        response = await client.post("/notifications/rules", json={
+            **rule, "webhook_urls": ["not a url"]
+        }, headers=headers)
+        assert response.status_code == 422
+        assert fake_redis.get(f"notification_rules:{session_id}") is None
+
+    @pytest.mark.asyncio
+    async def test_compiled_rules_follow_rule_changes(self, fake_redis, owner_client, recording_email):
+        """Test that cached rule sets match like the rules they compile and are dropped on change."""
+        from backend import redis_client
+        from notification_engine import NotificationEngine
+        from notification_rules import rule_sets
+        
+        client, headers, session_id = owner_client
+        
+        async def add_rule(name, condition, operator, value):
+            response = await client.post("/notifications/rules", json={
+                "session_id": session_id, "name": name, "condition": condition,
+                "operator": operator, "value": value, "email_recipients": ["ops@example.com"]
+            }, headers=headers)
+            return response.json()["id"]
+        
+        await add_rule("errors", "status_code", "equals", 500)
+        panic_rule = await add_rule("panics", "body_contains", "regex", r"pani[c]")
+        await add_rule("slow", "response_time", "greater_than", "250")
+        
+        # Reporting failure keeps the rules' cooldowns untouched
+        email = recording_email(delivered=False)
+        engine = NotificationEngine(redis_client, email)
+        capture = {"status_code": 500, "method": "POST", "ip": "1.2.3.4", "headers": {},
+                   "body": "kernel panic", "query_params": {}, "response_time_ms": 10}
+        await engine.evaluate_conditions(session_id, capture)
+        assert email.subjects == ["Webhook Alert: errors", "Webhook Alert: panics"]
+        assert (await rule_sets.get(redis_client, session_id)).needs_body
+        
+        await client.delete(f"/notifications/rules/{panic_rule}", headers=headers)
+        email.sent.clear()
+        await engine.evaluate_conditions(session_id, {**capture, "response_time_ms": 300})
+        assert email.subjects == ["Webhook Alert: errors", "Webhook Alert: slow"]
+        assert not (await rule_sets.get(redis_client, session_id)).needs_body
+
+    def test_keyword_rules_match_in_one_pass(self):
+        """Test that combined keyword matching finds exactly what separate substring checks do."""
+        import random
+        from keyword_matcher import KeywordMatcher
+        from models import NotificationRule
+        from notification_rules import CompiledRuleSet
+        
+        rng = random.Random(7)
+        # Both the substring scans and the automaton
+        for scan_max in (0, 1000):
+            with patch("keyword_matcher.SUBSTRING_SCAN_MAX", scan_max):
+                for _ in range(200):
+                    keywords = ["".join(rng.choice("abc") for _ in range(rng.randint(0, 4)))
+                                for _ in range(rng.randint(1, 12))]
+                    text = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 40)))
+                    assert KeywordMatcher(keywords).find(text) == {i for i, k in enumerate(keywords) if k in text}
+        
+        def rule(rule_id, condition, value):
+            return NotificationRule(id=rule_id, session_id="s", name=rule_id, condition=condition,
+                                    operator="contains", value=value, email_recipients=[], created_at="")
+        
+        rules = [rule(f"body-{i}", "body_contains", word) for i, word in enumerate(
+            ["Timeout", "refused", "panic", "OOM", "denied", "reset"]
+        )]
+        rules.append(rule("header", "header_contains", "Hookshot"))
+        rule_set = CompiledRuleSet(rules)
+        capture = {"headers": {"user-agent": "GitHub-Hookshot/1", "host": "x"}, "body": "connection RESET, oom"}
+        assert [r.id for r in rule_set.matching(capture)] == ["body-3", "body-5", "header"]
+
+    @pytest.mark.asyncio
+    async def test_session_stats_report_request_rate(self, fake_redis, owner_client):
+        """Test that captures feed the sliding-window rate shown on the stats endpoint."""
+        from backend import redis_client
+        from capture_store import CaptureStore, RATE_BUCKET_SECONDS, rate_bucket_key
+        
+        client, headers, session_id = owner_client
+        
+        for i in range(4):
+            await client.post(f"/hooks/{session_id}", json={"n": i})
+        
+        stats = (await client.get(f"/sessions/{session_id}/stats", headers=headers)).json()
+        assert stats["request_count"] == 4
+        assert stats["requests_per_minute"] == 4
+        
+        # The oldest bucket counts only for the part of it still inside the window
+        now = 1000 * RATE_BUCKET_SECONDS + RATE_BUCKET_SECONDS / 4
+        fake_redis.set(rate_bucket_key("rated", 994), 8)
+        fake_redis.set(rate_bucket_key("rated", 1000), 1)
+        fake_redis.set(rate_bucket_key("rated", 993), 100)
+        assert await CaptureStore(redis_client).request_rate("rated", now) == 8 * 0.75 + 1
+
+    @pytest.mark.asyncio
+    async def test_cooldown_claimed_once_across_concurrent_matches(self, fake_redis, owner_client, recording_email):
+        """Test that concurrent matches send one alert and leave the stored rules untouched."""
+        import asyncio
+        from backend import redis_client
+        from notification_engine import NotificationEngine
+        
+        client, headers, session_id = owner_client
+        rule_id = (await client.post("/notifications/rules", json={
+            "session_id": session_id, "name": "errors", "condition": "status_code",
+            "operator": "equals", "value": 500, "email_recipients": ["ops@example.com"]
+        }, headers=headers)).json()["id"]
+        stored_rules = fake_redis.get(f"notification_rules:{session_id}")
+        
+        email = recording_email()
+        engine = NotificationEngine(redis_client, email)
+        capture = {"status_code": 500, "method": "POST", "ip": "1.2.3.4", "headers": {}, "body": ""}
+        await asyncio.gather(*(engine.evaluate_conditions(session_id, capture) for _ in range(5)))
+        
+        assert len(email.sent) == 1
+        assert fake_redis.get(f"notification_rules:{session_id}") == stored_rules
+        assert 0 < fake_redis.pttl(f"notification_cooldown:{session_id}:{rule_id}") <= 5 * 60 * 1000
+        assert fake_redis.llen(f"notification_log:{session_id}") == 1
+        
+        rules = (await client.get(f"/notifications/rules/{session_id}", headers=headers)).json()
+        assert rules[0]["last_triggered"] is not None
+
+    @pytest.mark.asyncio
+    async def test_digest_rule_sends_one_summary_per_window(self, fake_redis, owner_client, recording_email):
+        """Test that a digest rule folds a burst into one email with per-key counts."""
+        import time
+        from backend import redis_client
+        from notification_engine import NotificationEngine
+        
+        client, headers, session_id = owner_client
+        await client.post("/notifications/rules", json={
+            "session_id": session_id, "name": "errors", "condition": "status_code",
+            "operator": "equals", "value": 500, "email_recipients": ["ops@example.com"],
+            "digest_minutes": 10, "dedup_fields": ["ip"]
+        }, headers=headers)
+        
+        email = recording_email()
+        engine = NotificationEngine(redis_client, email)
+        for i in range(6):
+            capture = {"status_code": 500, "method": "POST", "ip": f"10.0.0.{i % 2}",
+                       "headers": {}, "body": "", "timestamp": f"t{i}"}
+            await engine.evaluate_conditions(session_id, capture)
+        
+        # Nothing is sent until the window closes
+        await engine.flush_digests()
+        assert email.sent == []
+        
+        # Close the window early
+        for member in fake_redis.zrange("notification_digests_due", 0, -1):
+            fake_redis.zadd("notification_digests_due", {member: time.time() - 1})
+        await engine.flush_digests()
+        assert len(email.sent) == 1
+        summary = email.sent[0]["condition_info"]["digest"]
+        assert summary["count"] == 6
+        assert (summary["first"], summary["last"]) == ("t0", "t5")
+        assert dict(summary["top_keys"]) == {"10.0.0.0": 3, "10.0.0.1": 3}
+        # One sample per distinct key
+        assert [s["ip"] for s in summary["samples"]] == ["10.0.0.0", "10.0.0.1"]
+        assert fake_redis.llen(f"notification_log:{session_id}") == 1
+        
+        # A flushed digest is gone, so no worker sends it twice
+        await engine.flush_digests()
+        assert len(email.sent) == 1
+        assert fake_redis.keys(f"notification_digest:{session_id}:*") == []
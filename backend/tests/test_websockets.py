@@ -30,4 +30,111 @@ class TestWebSocketConnections:
                 
                 await client.post(f"/hooks/{session_id}", json={"test": "data"})
                 
-                mock_notify.assert_called_once()
\ No newline at end of file
+                mock_notify.assert_called_once()
+
+    def test_capture_reaches_viewer_through_pubsub(self, test_client, fake_redis):
+        """Test that captures are fanned out to viewers via the session's Redis channel."""
+        with test_client:
+            session_id = test_client.post("/webhooks").json()["session_id"]
+            
+            with test_client.websocket_connect(f"/ws/{session_id}") as websocket:
+                assert fake_redis.pubsub_numsub(f"capture_events:{session_id}") == [
+                    (f"capture_events:{session_id}".encode(), 1)
+                ]
+                
+                response = test_client.post(f"/hooks/{session_id}", json={"test": "data"})
+                event = json.loads(websocket.receive_text())
+                assert event["id"] == response.json()["request_id"]
+                assert json.loads(event["body"]) == {"test": "data"}
+
+    @pytest.mark.asyncio
+    async def test_reconnect_while_last_viewer_leaves_keeps_listening(self):
+        """Test that a viewer joining while the last one disconnects still gets a live listener."""
+        import fakeredis
+        from live_updates import ConnectionManager
+        
+        class Socket:
+            async def accept(self):
+                pass
+            
+            async def send_text(self, message):
+                pass
+        
+        redis_client = fakeredis.FakeAsyncRedis()
+        manager = ConnectionManager()
+        leaving = await manager.connect(redis_client, Socket(), "s1")
+        
+        # Join once the last viewer is gone but the pub/sub is still being closed
+        leave = asyncio.create_task(manager.disconnect(leaving))
+        while "s1" in manager.active_connections:
+            await asyncio.sleep(0)
+        joined = await manager.connect(redis_client, Socket(), "s1")
+        await leave
+        
+        assert manager.pubsub is not None
+        assert manager.listener is not None and not manager.listener.done()
+        assert manager.active_connections["s1"] == {joined}
+        
+        await manager.disconnect(joined)
+        assert manager.pubsub is None and manager.listener is None
+
+    @pytest.mark.asyncio
+    async def test_slow_viewer_gets_resync_notice(self):
+        """Test that a viewer who falls behind gets its backlog replaced by a resync notice."""
+        from live_updates import Viewer
+        
+        class SlowSocket:
+            def __init__(self):
+                self.sent = []
+                self.release = asyncio.Event()
+            
+            async def send_text(self, message):
+                await self.release.wait()
+                self.sent.append(message)
+        
+        socket = SlowSocket()
+        viewer = Viewer(socket, "session", queue_size=3)
+        viewer.start()
+        for i in range(10):
+            viewer.offer(f"event-{i}")
+            # Let the writer pick up the first event and block on the socket
+            await asyncio.sleep(0)
+        
+        socket.release.set()
+        await asyncio.sleep(0.01)
+        await viewer.stop()
+        
+        assert socket.sent[:1] == ["event-0"]
+        assert json.loads(socket.sent[1]) == {"type": "resync", "reason": "overflow", "dropped": 9}
+        assert len(socket.sent) == 2
+
+    def test_batched_viewer_gets_array_frames(self, test_client, fake_redis):
+        """Test that batch mode coalesces captures into one array frame."""
+        with test_client:
+            session_id = test_client.post("/webhooks").json()["session_id"]
+            
+            with test_client.websocket_connect(f"/ws/{session_id}?batch_ms=200&batch_max=3") as websocket:
+                request_ids = [
+                    test_client.post(f"/hooks/{session_id}", json={"n": n}).json()["request_id"]
+                    for n in range(3)
+                ]
+                frame = json.loads(websocket.receive_text())
+                assert [event["id"] for event in frame] == request_ids
+
+    def test_reconnect_replays_missed_captures(self, test_client, fake_redis, monkeypatch):
+        """Test that ?since=<seq> replays missed captures before live ones, within a cap."""
+        import live_updates
+        
+        with test_client:
+            session_id = test_client.post("/webhooks").json()["session_id"]
+            for n in range(3):
+                test_client.post(f"/hooks/{session_id}", json={"n": n})
+            
+            with test_client.websocket_connect(f"/ws/{session_id}?since=1") as websocket:
+                assert [json.loads(websocket.receive_text())["seq"] for _ in range(2)] == [2, 3]
+                test_client.post(f"/hooks/{session_id}", json={"n": 3})
+                assert json.loads(websocket.receive_text())["seq"] == 4
+            
+            monkeypatch.setattr(live_updates, "REPLAY_MAX_EVENTS", 2)
+            with test_client.websocket_connect(f"/ws/{session_id}?since=1") as websocket:
+                assert json.loads(websocket.receive_text()) == {"type": "resync", "reason": "gap_too_large"}
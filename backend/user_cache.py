@@ -0,0 +1,61 @@
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+from auth import ACCESS_TOKEN_EXPIRE_MINUTES, decode_token
+from cache import LRUTTLCache, invalidation_bus
+from models import User
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# Tokens are dropped this long before they expire, so a cached token is never honoured past exp
+TOKEN_EXPIRY_MARGIN_SECONDS = float(os.getenv("TOKEN_EXPIRY_MARGIN_SECONDS", "5"))
+
+class UserCache:
+    """Resolved users for bearer tokens, shared by every request on this worker.
+
+    Tokens map to their subject until shortly before they expire, and
+    subjects to the parsed User until the record changes, so a repeat
+    request skips JWT verification and Redis entirely.
+    """
+
+    namespace = "user"
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.tokens = LRUTTLCache(max_size, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+        # Changes are pushed through the invalidation bus; the TTL is only a backstop
+        self.users = LRUTTLCache(max_size, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+        invalidation_bus.register(self.namespace, self.users.invalidate, self.users.clear)
+
+    async def get(self, redis_client, token: str) -> Optional[User]:
+        """The user a token belongs to, or None if the account no longer exists.
+
+        Raises 401 for invalid or expired tokens.
+        """
+        email = self.tokens.get(token)
+        if email is None:
+            payload = decode_token(token)
+            email = payload["sub"]
+            ttl = payload.get("exp", 0) - time.time() - TOKEN_EXPIRY_MARGIN_SECONDS
+            if ttl > 0:
+                self.tokens.set(token, email, ttl)
+
+        user = self.users.get(email)
+        if user is not None:
+            return user
+
+        user_data = await redis_client.get(f"user:{email}")
+        if not user_data:
+            return None
+        user = User(**json.loads(user_data))
+        self.users.set(email, user)
+        return user
+
+    async def invalidate(self, redis_client, email: str):
+        """Drop a user record from every worker's cache"""
+        await invalidation_bus.publish(redis_client, self.namespace, email)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"tokens": self.tokens.stats(), "users": self.users.stats()}
+
+user_cache = UserCache()
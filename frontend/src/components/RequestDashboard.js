@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useMemo } from 'react';
+import React, { useState, useEffect, useMemo, useRef } from 'react';
 import { useWebSocket } from '../hooks/useWebSocket';
 import { sessionAPI } from '../services/api';
 import RequestInspector from './RequestInspector';
@@ -12,6 +12,9 @@ import {
 const RequestDashboard = ({ session, onRequestsUpdate }) => {
   const [requests, setRequests] = useState([]);
   const [loading, setLoading] = useState(false);
+  // Cursor for the page of older requests, null once everything is loaded
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [expandedRequest, setExpandedRequest] = useState(null);
   const [showFilters, setShowFilters] = useState(false);
   
@@ -28,7 +31,7 @@ const RequestDashboard = ({ session, onRequestsUpdate }) => {
   // IP Masking hook
   const { maskingEnabled, maskingLevel, setMaskingLevel, maskIP, toggleMasking } = useIPMasking();
 
-  const { messages, isConnected } = useWebSocket(session?.id);
+  const { messages, isConnected, resyncCount } = useWebSocket(session?.id);
 
   // Load existing requests when session changes
   useEffect(() => {
@@ -36,13 +39,30 @@ const RequestDashboard = ({ session, onRequestsUpdate }) => {
       loadRequests();
     } else {
       setRequests([]);
+      setNextCursor(null);
     }
   }, [session]);
 
+  // Reload after the server dropped live events we were too slow for
+  useEffect(() => {
+    if (resyncCount > 0) {
+      loadRequests();
+    }
+  }, [resyncCount]);
+
+  // Live messages already merged into the list; several can arrive between
+  // renders, e.g. when a reconnect replays missed captures
+  const mergedCountRef = useRef(0);
+
   // Add new real-time messages
   useEffect(() => {
-    if (messages.length > 0) {
-      setRequests(prev => [messages[0], ...prev]);
+    const fresh = messages.slice(0, messages.length - mergedCountRef.current);
+    mergedCountRef.current = messages.length;
+    if (fresh.length > 0) {
+      setRequests(prev => {
+        const loaded = new Set(prev.map(r => r.id));
+        return [...fresh.filter(r => !loaded.has(r.id)), ...prev];
+      });
     }
   }, [messages]);
 
@@ -135,6 +155,7 @@ const RequestDashboard = ({ session, onRequestsUpdate }) => {
     try {
       const data = await sessionAPI.getSessionRequests(session.id);
       setRequests(data.requests || []);
+      setNextCursor(data.next_cursor || null);
     } catch (error) {
       console.error('Failed to load requests:', error);
     } finally {
@@ -142,6 +163,23 @@ const RequestDashboard = ({ session, onRequestsUpdate }) => {
     }
   };
 
+  const loadMoreRequests = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const data = await sessionAPI.getSessionRequests(session.id, { cursor: nextCursor });
+      setRequests(prev => {
+        const loaded = new Set(prev.map(r => r.id));
+        return [...prev, ...(data.requests || []).filter(r => !loaded.has(r.id))];
+      });
+      setNextCursor(data.next_cursor || null);
+    } catch (error) {
+      console.error('Failed to load more requests:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const clearAllFilters = () => {
     setFilters({
       search: '',
@@ -582,6 +620,18 @@ const RequestDashboard = ({ session, onRequestsUpdate }) => {
                 ))}
               </tbody>
             </table>
+
+            {nextCursor && (
+              <div className="border-t border-gray-200 px-6 py-3 text-center">
+                <button
+                  onClick={loadMoreRequests}
+                  disabled={loadingMore}
+                  className="text-sm text-blue-600 hover:text-blue-800 font-medium disabled:text-gray-400"
+                >
+                  {loadingMore ? 'Loading...' : 'Load older requests'}
+                </button>
+              </div>
+            )}
           </div>
         )}
       </div>
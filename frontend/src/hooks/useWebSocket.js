@@ -1,50 +1,87 @@
 import { useState, useEffect, useRef } from 'react';
 
+// Delay before reconnecting after the socket drops, doubled per failed attempt
+const RECONNECT_BASE_MS = 1000;
+const RECONNECT_MAX_MS = 30000;
+
 export const useWebSocket = (sessionId) => {
   const [messages, setMessages] = useState([]);
   const [isConnected, setIsConnected] = useState(false);
+  // Bumped when the server dropped events and the list needs reloading
+  const [resyncCount, setResyncCount] = useState(0);
   const socketRef = useRef(null);
+  // Newest capture seq received, so a reconnect replays only what was missed
+  const lastSeqRef = useRef(null);
 
   useEffect(() => {
     if (!sessionId) return;
 
-    console.log(`🔌 Connecting to WebSocket for session: ${sessionId}`);
-    
-    // Connect to WebSocket
-    socketRef.current = new WebSocket(`wss://pingforge.onrender.com/ws/${sessionId}`);
-    
-    socketRef.current.onopen = () => {
-      setIsConnected(true);
-      console.log('✅ WebSocket connected');
-    };
+    let closed = false;
+    let attempts = 0;
+    let reconnectTimer = null;
+    lastSeqRef.current = null;
 
-    socketRef.current.onmessage = (event) => {
-      console.log('📨 WebSocket message received:', event.data);
-      try {
-        const newRequest = JSON.parse(event.data);
-        setMessages(prev => [newRequest, ...prev]);
-      } catch (error) {
-        console.error('Error parsing WebSocket message:', error);
-      }
-    };
+    const connect = () => {
+      const since = lastSeqRef.current !== null ? `?since=${lastSeqRef.current}` : '';
+      console.log(`🔌 Connecting to WebSocket for session: ${sessionId}${since}`);
 
-    socketRef.current.onclose = () => {
-      setIsConnected(false);
-      console.log('❌ WebSocket disconnected');
-    };
+      const socket = new WebSocket(`wss://pingforge.onrender.com/ws/${sessionId}${since}`);
+      socketRef.current = socket;
 
-    socketRef.current.onerror = (error) => {
-      console.error('WebSocket error:', error);
-      setIsConnected(false);
+      socket.onopen = () => {
+        setIsConnected(true);
+        console.log('✅ WebSocket connected');
+        if (attempts > 0 && lastSeqRef.current === null) {
+          // Nothing to replay from, so reload whatever arrived while disconnected
+          setResyncCount(prev => prev + 1);
+        }
+        attempts = 0;
+      };
+
+      socket.onmessage = (event) => {
+        console.log('📨 WebSocket message received:', event.data);
+        try {
+          const newRequest = JSON.parse(event.data);
+          if (newRequest.type === 'resync') {
+            lastSeqRef.current = null;
+            setResyncCount(prev => prev + 1);
+            return;
+          }
+          if (typeof newRequest.seq === 'number') {
+            lastSeqRef.current = Math.max(lastSeqRef.current ?? 0, newRequest.seq);
+          }
+          setMessages(prev => [newRequest, ...prev]);
+        } catch (error) {
+          console.error('Error parsing WebSocket message:', error);
+        }
+      };
+
+      socket.onclose = () => {
+        setIsConnected(false);
+        console.log('❌ WebSocket disconnected');
+        if (closed) return;
+        const delay = Math.min(RECONNECT_BASE_MS * 2 ** attempts, RECONNECT_MAX_MS);
+        attempts += 1;
+        reconnectTimer = setTimeout(connect, delay);
+      };
+
+      socket.onerror = (error) => {
+        console.error('WebSocket error:', error);
+        setIsConnected(false);
+      };
     };
 
+    connect();
+
     // Cleanup on unmount
     return () => {
+      closed = true;
+      clearTimeout(reconnectTimer);
       if (socketRef.current) {
         socketRef.current.close();
       }
     };
   }, [sessionId]);
 
-  return { messages, isConnected };
-};
\ No newline at end of file
+  return { messages, isConnected, resyncCount };
+};
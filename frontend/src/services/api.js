@@ -82,8 +82,15 @@ export const sessionAPI = {
     return response.data;
   },
 
-  getSessionRequests: async (sessionId) => {
-    const response = await api.get(`/sessions/${sessionId}/requests`);
+  // params: limit, cursor (next_cursor of the previous page), method, status_code, ip, since, until
+  getSessionRequests: async (sessionId, params = {}) => {
+    const response = await api.get(`/sessions/${sessionId}/requests`, { params });
+    return response.data;
+  },
+
+  // request_count, evicted_count, stored_bytes, last_request, requests_per_minute
+  getSessionStats: async (sessionId) => {
+    const response = await api.get(`/sessions/${sessionId}/stats`);
     return response.data;
   },
 